@@ -0,0 +1,236 @@
+import math
+import time
+from array import array
+
+from line_protocol import Template
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_windows(spec):
+    """
+    Parses a comma separated list of window lengths like ``"1m,15m,1h"``.
+
+    Returns:
+        A list of (label, seconds) tuples.
+    """
+    windows = []
+    for label in (spec or "").split(","):
+        label = label.strip()
+        if label:
+            windows.append((label, int(label[:-1]) * _UNITS[label[-1]]))
+    return windows
+
+
+def parse_fields(spec):
+    """
+    Parses a comma separated list of ``measurement.field`` names into a set of (measurement, field) tuples.
+    """
+    return {tuple(name.strip().split(".", 1)) for name in (spec or "").split(",") if name.strip()}
+
+
+class Aggregator:
+    """
+    Rolls raw records up into fixed time windows.
+
+    For every series (template and tag values) and window length, gauge fields get ``<field>_min``, ``_max``,
+    ``_mean`` and ``_last``; cumulative counter fields get ``<field>_delta``, the sum of all increases within the
+    window (a counter going down is taken as a reset, the new value counting as the increase), and ``<field>_last``.
+    Windows are aligned to the epoch and written to ``<measurement>_<label>`` (e.g. ``shelly_power_15m``) stamped
+    with the window start, once a record of the series arrives in a later window or ``flush_expired`` finds it over.
+
+    State is kept in flat ``array('d')`` columns with one slot per series and field instead of objects per series,
+    so memory stays at a few hundred bytes per series. Slots are never freed; past ``max_series`` new series are
+    not aggregated.
+    """
+
+    def __init__(self, windows, gauges, counters, max_series=50000):
+        """
+        Args:
+            windows: List of (label, seconds) tuples, see ``parse_windows``.
+            gauges: Set of (measurement, field) tuples to aggregate as gauges.
+            counters: Set of (measurement, field) tuples to aggregate as cumulative counters.
+            max_series: Maximum number of series aggregated.
+        """
+        self._windows = list(windows)
+        self._gauges = set(gauges)
+        self._counters = set(counters)
+        self._max_series = max_series
+        self._plans = {}
+        self._series = {}
+        self._output = {}
+
+        # Per series, per window: start of the current window (NaN when nothing is pending)
+        self._starts = [array('d') for _ in self._windows]
+        # Per series: first cell index
+        self._bases = array('l')
+        # Per cell (series field), per window: running statistics
+        self._min = [array('d') for _ in self._windows]
+        self._max = [array('d') for _ in self._windows]
+        self._sum = [array('d') for _ in self._windows]
+        self._count = [array('d') for _ in self._windows]
+        # Per cell: last value seen, shared by all windows (counters need it across window boundaries)
+        self._last = array('d')
+
+        self.samples = 0
+        self.records_emitted = 0
+        self.series_rejected = 0
+
+    def stats(self):
+        """
+        Returns a snapshot of the aggregator counters.
+        """
+        return {
+            "series": len(self._series),
+            "samples": self.samples,
+            "records_emitted": self.records_emitted,
+            "series_rejected": self.series_rejected,
+        }
+
+    def _plan(self, template):
+        # (field index, is counter) for every aggregated field of a template, or None if there are none
+        try:
+            return self._plans[template]
+        except KeyError:
+            plan = tuple((i, (template.measurement, field) in self._counters)
+                         for i, field in enumerate(template.field_keys)
+                         if (template.measurement, field) in self._gauges
+                         or (template.measurement, field) in self._counters) or None
+            self._plans[template] = plan
+            return plan
+
+    def _output_template(self, template, window):
+        key = (template, window)
+        try:
+            return self._output[key]
+        except KeyError:
+            fields = []
+            for i, counter in self._plan(template):
+                field = template.field_keys[i]
+                if counter:
+                    fields += [f"{field}_delta", f"{field}_last"]
+                else:
+                    fields += [f"{field}_min", f"{field}_max", f"{field}_mean", f"{field}_last"]
+            output = Template(f"{template.measurement}_{self._windows[window][0]}", template.tag_keys, fields)
+            self._output[key] = output
+            return output
+
+    def _add_series(self, key, cells):
+        series = len(self._bases)
+        base = len(self._last)
+        self._bases.append(base)
+        for w in range(len(self._windows)):
+            self._starts[w].append(math.nan)
+            for column in (self._min[w], self._max[w], self._sum[w], self._count[w]):
+                column.extend([0.0] * cells)
+        self._last.extend([math.nan] * cells)
+        self._series[key] = series
+        return series
+
+    def add(self, record, now=None):
+        """
+        Adds a record's values to its windows.
+
+        Args:
+            record: The ``Record`` to aggregate. Other objects are ignored.
+            now: The current time in seconds since the epoch, defaults to ``time.time()``.
+
+        Returns:
+            A list of records for windows of this series that just closed.
+        """
+        template = getattr(record, "template", None)
+        if template is None:
+            return []
+        plan = self._plan(template)
+        if plan is None:
+            return []
+        if now is None:
+            now = time.time()
+
+        key = (template, record.tags)
+        series = self._series.get(key)
+        if series is None:
+            if len(self._series) >= self._max_series:
+                self.series_rejected += 1
+                return []
+            series = self._add_series(key, len(plan))
+
+        closed = []
+        base = self._bases[series]
+        fields = record.fields
+        for w, (_, length) in enumerate(self._windows):
+            start = now - now % length
+            if self._starts[w][series] != start:
+                if not math.isnan(self._starts[w][series]):
+                    closed.append(self._emit(template, record.tags, series, w))
+                self._starts[w][series] = start
+
+        for k, (i, counter) in enumerate(plan):
+            value = fields[i]
+            if value is None or value.__class__ is bool or not isinstance(value, (int, float)):
+                continue
+            cell = base + k
+            last = self._last[cell]
+            if counter:
+                increase = 0.0 if math.isnan(last) else (value - last if value >= last else value)
+            for w in range(len(self._windows)):
+                count = self._count[w]
+                if counter:
+                    self._sum[w][cell] += increase
+                elif count[cell] == 0:
+                    self._min[w][cell] = self._max[w][cell] = self._sum[w][cell] = value
+                else:
+                    if value < self._min[w][cell]:
+                        self._min[w][cell] = value
+                    if value > self._max[w][cell]:
+                        self._max[w][cell] = value
+                    self._sum[w][cell] += value
+                count[cell] += 1
+            self._last[cell] = value
+            self.samples += 1
+
+        return [record for record in closed if record is not None]
+
+    def flush_expired(self, now=None):
+        """
+        Closes windows of series that stopped receiving records.
+
+        Args:
+            now: The current time in seconds since the epoch, defaults to ``time.time()``.
+
+        Returns:
+            A list of records for the closed windows.
+        """
+        if now is None:
+            now = time.time()
+        closed = []
+        for (template, tags), series in self._series.items():
+            for w, (_, length) in enumerate(self._windows):
+                start = self._starts[w][series]
+                if not math.isnan(start) and now >= start + length:
+                    record = self._emit(template, tags, series, w)
+                    if record is not None:
+                        closed.append(record)
+                    self._starts[w][series] = math.nan
+        return closed
+
+    def _emit(self, template, tags, series, w):
+        plan = self._plan(template)
+        base = self._bases[series]
+        count, minimum, maximum, total = self._count[w], self._min[w], self._max[w], self._sum[w]
+        values = []
+        samples = 0
+        for k, (_, counter) in enumerate(plan):
+            cell = base + k
+            n = count[cell]
+            samples += n
+            last = self._last[cell] if n else None
+            if counter:
+                values += [total[cell] if n else None, last]
+            else:
+                values += [minimum[cell], maximum[cell], total[cell] / n, last] if n else [None] * 4
+            count[cell] = total[cell] = minimum[cell] = maximum[cell] = 0.0
+        if not samples:
+            return None
+        self.records_emitted += 1
+        return self._output_template(template, w).record(tags, values, int(self._starts[w][series]) * 1000000000)
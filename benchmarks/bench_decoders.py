@@ -0,0 +1,66 @@
+"""
+Compares the payload decoders: stdlib json, orjson and the typed msgspec schemas, whichever are installed.
+
+Each decoder extracts the handler values from the same recorded payloads, bytes in, tuple out.
+
+Run from the repository root:
+    python -m benchmarks.bench_decoders
+"""
+import timeit
+
+import decoders
+
+# Payloads as recorded from a Shelly Plus 1PM, a Plus H&T, a BLU Motion relayed by a Plus 1PM and a Tasmota reader
+RECORDED = [
+    ("switch",
+     b'{"id":0,"source":"timer","output":true,"apower":1843.2,"voltage":231.4,"freq":50.0,"current":7.967,'
+     b'"aenergy":{"total":158201.331,"by_minute":[30512.771,30498.210,30590.118],"minute_ts":1717592340},'
+     b'"ret_aenergy":{"total":0.000,"by_minute":[0.000,0.000,0.000],"minute_ts":1717592340},'
+     b'"temperature":{"tC":48.3,"tF":118.9}}'),
+    ("temperature", b'{"id":0,"tC":21.4,"tF":70.5}'),
+    ("humidity", b'{"id":0,"rh":54.2}'),
+    ("ble_event",
+     b'{"src":"shellyplus1pm-441793a4b2c0","dst":"shelly-blu","event":"shelly-blu",'
+     b'"payload":{"encryption":false,"BTHome_version":2,"pid":118,"battery":100,"illuminance":312,'
+     b'"motion":1,"rssi":-67,"address":"38:39:8f:70:ad:2e"}}'),
+    ("tasmota_sensor",
+     b'{"Time":"2024-06-05T14:59:05","Zaehler":{"Verbrauch1":21043.6512,"Lieferung1":9123.0041,"Pges":-1203,'
+     b'"P_L1":-512,"P_L2":-402,"P_L3":-289,"Meter_id":"0a01445a5a0000032a6b"}}'),
+]
+BATCH = 1000
+
+
+def run(decoder):
+    calls = [getattr(decoder, method) for method, _ in RECORDED]
+    payloads = [payload for _, payload in RECORDED]
+
+    def decode_all():
+        for _ in range(BATCH // len(RECORDED)):
+            for call, payload in zip(calls, payloads):
+                call(payload)
+    return decode_all
+
+
+def main():
+    available = decoders.available_decoders()
+    instances = {name: decoders.create_decoder(name) for name in available}
+
+    expected = [getattr(instances["json"], method)(payload) for method, payload in RECORDED]
+    for name, decoder in instances.items():
+        results = [getattr(decoder, method)(payload) for method, payload in RECORDED]
+        assert results == expected, f"{name} decodes differently than json"
+        # Integers have to stay integers, or the InfluxDB field types would change
+        assert [repr(result) for result in results] == [repr(result) for result in expected], \
+            f"{name} decodes different value types than json"
+
+    times = {}
+    for name in reversed(available):
+        runs = 20
+        best = min(timeit.repeat(run(instances[name]), number=runs, repeat=5)) / runs
+        times[name] = best
+        print(f"{name:>8}: {best / BATCH * 1e6:6.2f} us/msg  {BATCH / best:10.0f} msg/s  "
+              f"speedup {times['json'] / best:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Compares the compiled Fronius flattening plans with the recursive walk that built one Point per field.
+
+Run from the repository root:
+    python -m benchmarks.bench_fronius_flatten
+"""
+import timeit
+from collections import Counter
+
+from influxdb_client import Point, WritePrecision
+
+from fronius_flatten import Flattener
+
+INVERTER_IP = "192.168.1.50"
+TIMESTAMP = 1717592345000000000
+
+# Body.Data of responses recorded from a Symo GEN24
+RESPONSES = {
+    "inverter_common": {
+        "DAY_ENERGY": {"Unit": "Wh", "Value": 10512.3}, "DeviceStatus": {
+            "ErrorCode": 0, "LEDColor": 2, "LEDState": 0, "MgmtTimerRemainingTime": -1, "StateToReset": False,
+            "StatusCode": 7},
+        "FAC": {"Unit": "Hz", "Value": 49.98}, "IAC": {"Unit": "A", "Value": 7.41}, "IDC": {"Unit": "A", "Value": 4.02},
+        "IDC_2": {"Unit": "A", "Value": 3.97}, "PAC": {"Unit": "W", "Value": 5112}, "SAC": {"Unit": "VA", "Value": 5130},
+        "TOTAL_ENERGY": {"Unit": "Wh", "Value": 21533021.4}, "UAC": {"Unit": "V", "Value": 230.4},
+        "UDC": {"Unit": "V", "Value": 652.1}, "UDC_2": {"Unit": "V", "Value": 648.7},
+        "YEAR_ENERGY": {"Unit": "Wh", "Value": 2402211.7},
+    },
+    "inverter_3P": {
+        "IAC_L1": {"Unit": "A", "Value": 7.41}, "IAC_L2": {"Unit": "A", "Value": 7.38},
+        "IAC_L3": {"Unit": "A", "Value": 7.45}, "UAC_L1": {"Unit": "V", "Value": 230.4},
+        "UAC_L2": {"Unit": "V", "Value": 231.0}, "UAC_L3": {"Unit": "V", "Value": 229.8},
+    },
+    "powerflow": {
+        "Inverters": {"1": {"Battery_Mode": "normal", "DT": 1, "E_Day": None, "E_Total": 21533021.4, "P": 5112,
+                            "SOC": 71.5}},
+        "Site": {"BackupMode": False, "BatteryStandby": False, "E_Day": None, "E_Total": 21533021.4,
+                 "Meter_Location": "grid", "Mode": "bidirectional", "P_Akku": -1203.4, "P_Grid": -2210.9,
+                 "P_Load": -1698.2, "P_PV": 6315.4, "rel_Autonomy": 100.0, "rel_SelfConsumption": 43.5},
+        "Smartloads": {"Ohmpilots": {}, "OhmpilotEcos": {}},
+        "Version": "12",
+    },
+    # One record per list item, the modules share their field keys
+    "storage": {
+        "Controller": {"Capacity_Maximum": 10240, "Current_DC": -23.1, "DesignedCapacity": 10240,
+                       "Details": {"Manufacturer": "BYD", "Model": "BYD Battery-Box Premium HV", "Serial": "P3C2"},
+                       "Enable": 1, "StateOfCharge_Relative": 71.5, "Status_BatteryCell": 3, "Temperature_Cell": 19.5,
+                       "TimeStamp": 1717592345, "Voltage_DC": 409.6},
+        "Modules": [
+            {"Details": {"Serial": "M1"}, "Temperature_Cell": 19.4, "Voltage_DC": 3.1},
+            {"Details": {"Serial": "M2"}, "Temperature_Cell": 19.6, "Voltage_DC": 3.3},
+        ],
+    },
+}
+
+
+def legacy_points(measurement_name, data, points):
+    # The recursive walk write_data_to_influxdb used before compiled plans
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, (int, float)):
+                points.append(Point(measurement_name).field(key, float(value)).time(TIMESTAMP, WritePrecision.NS)
+                              .tag("inverter_ip", INVERTER_IP))
+            elif isinstance(value, dict):
+                if 'Value' in value and 'Unit' in value:
+                    if value['Value'] is not None:
+                        points.append(Point(measurement_name).field(key, float(value['Value']))
+                                      .time(TIMESTAMP, WritePrecision.NS).tag("inverter_ip", INVERTER_IP))
+                else:
+                    legacy_points(measurement_name + "_" + key, value, points)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        legacy_points(measurement_name, item, points)
+                    elif isinstance(item, (int, float)):
+                        points.append(Point(measurement_name).field(measurement_name, float(item))
+                                      .time(TIMESTAMP, WritePrecision.NS).tag("inverter_ip", INVERTER_IP))
+    return points
+
+
+def run_legacy():
+    lines = []
+    for name, data in RESPONSES.items():
+        lines.extend(point.to_line_protocol() for point in legacy_points(name, data, []))
+    return lines
+
+
+flattener = Flattener()
+
+
+def run_plans():
+    lines = []
+    for name, data in RESPONSES.items():
+        lines.extend(record.to_line_protocol()
+                     for record in flattener.flatten(name, name, data, (INVERTER_IP,), TIMESTAMP))
+    return lines
+
+
+def field_values(lines):
+    # Counts (series, field, value) without the index tag, so values of list items that collapse into one are missed
+    result = Counter()
+    for line in lines:
+        series, fields, _ = line.split(' ')
+        series = ','.join(part for part in series.split(',') if not part.startswith('index='))
+        for field in fields.split(','):
+            key, value = field.split('=')
+            result[series, key, value] += 1
+    return result
+
+
+def main():
+    legacy, plans = run_legacy(), run_plans()
+    assert field_values(legacy) == field_values(plans), "compiled plans write different data"
+    assert sum(line.startswith('storage,index=') for line in plans) == 2, "list items weren't written separately"
+
+    results = {}
+    for name, fn, lines in (("recursive", run_legacy, legacy), ("compiled", run_plans, plans)):
+        runs = 200
+        best = min(timeit.repeat(fn, number=runs, repeat=5)) / runs
+        results[name] = best
+        print(f"{name:>9}: {best * 1e6:8.1f} us/poll cycle  {len(lines):3d} lines  "
+              f"{sum(len(line) + 1 for line in lines):5d} bytes")
+    print(f"speedup: {results['recursive'] / results['compiled']:.2f}x, "
+          f"plan compiles: {flattener.compiles}, plan hits: {flattener.hits}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compares the precompiled line protocol templates with building influxdb_client Points.
+
+Both paths decode the same recorded payloads and encode a batch of lines, the way the writer thread does.
+
+Run from the repository root:
+    python -m benchmarks.bench_line_protocol
+"""
+import json
+import timeit
+
+from influxdb_client.client.write.point import Point
+
+import shelly_handlers
+from ble import BleStage
+
+# Payloads as recorded from a Shelly Plus 1PM, a Plus H&T and a BLU Motion relayed by a Plus 1PM
+RECORDED = [
+    ("shellyplus1pm-441793a4b2c0/status/switch:0",
+     b'{"id":0,"source":"timer","output":true,"apower":1843.2,"voltage":231.4,"freq":50.0,"current":7.967,'
+     b'"aenergy":{"total":158201.331,"by_minute":[30512.771,30498.210,30590.118],"minute_ts":1717592340},'
+     b'"temperature":{"tC":48.3,"tF":118.9}}'),
+    ("shellyplusht-c049ef8b3a10/status/humidity:0", b'{"id":0,"rh":54.2}'),
+    ("shellyplus1pm-441793a4b2c0/events/ble",
+     b'{"src":"shellyplus1pm-441793a4b2c0","dst":"shelly-blu","event":"shelly-blu",'
+     b'"payload":{"encryption":false,"BTHome_version":2,"pid":118,"battery":100,"illuminance":312,'
+     b'"motion":1,"rssi":-67,"address":"38:39:8f:70:ad:2e"}}'),
+]
+BATCH = 500
+
+
+def point_switch(topic_parts, payload):
+    data = json.loads(payload)
+    return [Point("shelly_power")
+            .tag("device_id", topic_parts[0])
+            .tag("channel", topic_parts[2].split(":")[1])
+            .field("output", data.get("output"))
+            .field("apower", data.get("apower"))
+            .field("voltage", data.get("voltage"))
+            .field("current", data.get("current"))
+            .field("total_energy", data["aenergy"].get("total"))
+            .field("temperature_c", data["temperature"].get("tC"))
+            .field("temperature_f", data["temperature"].get("tF"))]
+
+
+def point_humidity(topic_parts, payload):
+    data = json.loads(payload)
+    return [Point("shelly_humidity").tag("device_id", topic_parts[0]).field("humidity", data.get("rh"))]
+
+
+def point_ble(topic_parts, payload):
+    data = json.loads(payload)["payload"]
+    return [Point("ble_sensor")
+            .field("encryption", data.get("encryption"))
+            .field("BTHome_version", data.get("BTHome_version"))
+            .field("pid", data.get("pid"))
+            .field("battery", data.get("battery"))
+            .field("temperature", data.get("temperature"))
+            .field("humidity", data.get("humidity"))
+            .field("illuminance", data.get("illuminance"))
+            .field("motion", data.get("motion"))
+            .field("button", data.get("button"))
+            .field("window", data.get("window"))
+            .field("rotation", data.get("rotation"))
+            .field("rssi", data.get("rssi"))
+            .tag("address", data.get("address"))
+            .tag("gateway", topic_parts[0])]
+
+
+POINT_HANDLERS = [point_switch, point_humidity, point_ble]
+COMPONENTS = shelly_handlers.build_components()
+# Writes every advertisement right away: the recorded one repeats and would be merged and deduplicated otherwise
+BLE = BleStage(shelly_handlers.BLE_SENSOR, merge_window=0, dedup_window=0, min_interval=0)
+TEMPLATE_HANDLERS = [COMPONENTS.handle, COMPONENTS.handle, BLE.handle]
+MESSAGES = [(topic.split('/'), payload) for topic, payload in RECORDED] * (BATCH // len(RECORDED))
+
+
+def run_points():
+    lines = []
+    for i, (parts, payload) in enumerate(MESSAGES):
+        for point in POINT_HANDLERS[i % 3](parts, payload):
+            lines.append(point.time(1717592345000000000).to_line_protocol())
+    return "\n".join(lines).encode()
+
+
+def run_templates():
+    buffer = bytearray()
+    for i, (parts, payload) in enumerate(MESSAGES):
+        for record in TEMPLATE_HANDLERS[i % 3](parts, payload):
+            record.time = 1717592345000000000
+            record.encode_into(buffer)
+            buffer += b'\n'
+    return bytes(buffer)
+
+
+def main():
+    assert run_points() + b"\n" == run_templates(), "template output differs from Point output"
+
+    results = {}
+    for name, fn in (("Point", run_points), ("Template", run_templates)):
+        runs = 20
+        best = min(timeit.repeat(fn, number=runs, repeat=5)) / runs
+        results[name] = best
+        print(f"{name:>8}: {best / len(MESSAGES) * 1e6:6.2f} us/msg  {len(MESSAGES) / best:10.0f} msg/s")
+    print(f"speedup: {results['Point'] / results['Template']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Replays recorded or synthetic MQTT traffic through the bridge and reports how fast it handles it.
+
+Every message goes through main.on_message exactly as delivered by paho: routing, decoding, record building,
+aggregation, deduplication and queueing on the batch writer, which writes to a local stub of the InfluxDB v2 write
+endpoint (benchmarks/stub_influx.py). Reports messages per second, per-message latency percentiles of on_message
+and, in a second pass under tracemalloc with the pipeline state rebuilt, the memory allocated per message: peak
+bytes while handling it, and bytes and memory blocks still allocated after it.
+
+Run from the repository root:
+    python capture.py traffic.cap.gz --duration 600          # record live traffic
+    python -m benchmarks.replay traffic.cap.gz               # replay it at full speed
+    python -m benchmarks.replay --synthetic 100000 --rate 5000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from array import array
+
+from benchmarks.stub_influx import StubInflux
+from benchmarks.synthetic import synthetic_traffic
+from capture import read_capture
+
+
+class Message:
+    """
+    The attributes of ``paho.mqtt.client.MQTTMessage`` the bridge reads.
+    """
+    __slots__ = ("topic", "payload", "retain", "qos")
+
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.qos = 0
+
+
+class _NullWriter:
+    def write(self, point):
+        pass
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _load_bridge(stub):
+    # main reads its configuration on import, point it at the stub and keep the run self-contained
+    os.environ.update({
+        "INFLUXDB_HOST": "127.0.0.1",
+        "INFLUXDB_PORT": str(stub.port),
+        "INFLUXDB_TOKEN": "replay",
+        "INFLUXDB_ORGANIZATION": "replay",
+        "INFLUXDB_BUCKET": "replay",
+        "SPOOL_DIR": "",
+        "SINKS": "influx",
+        "METRICS_PORT": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import main as bridge
+    from structured_logging import configure_logging
+    configure_logging(bridge.LOG_LEVEL)
+    return bridge
+
+
+def replay(bridge, messages, rate=0.0):
+    """
+    Feeds messages to the bridge's on_message.
+
+    Args:
+        bridge: The imported main module.
+        messages: List of ``Message`` objects.
+        rate: Messages per second, 0 for as fast as possible.
+
+    Returns:
+        The total time in seconds and an array of per-message latencies in seconds.
+    """
+    on_message = bridge.on_message
+    perf_counter = time.perf_counter
+    latencies = array('d', bytes(8 * len(messages)))
+    start = perf_counter()
+    for i, message in enumerate(messages):
+        if rate:
+            delay = start + i / rate - perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        before = perf_counter()
+        on_message(None, None, message)
+        latencies[i] = perf_counter() - before
+    return perf_counter() - start, latencies
+
+
+def reset_pipeline(bridge):
+    """
+    Rebuilds the stateful stages of the bridge, so messages replayed again are handled like the first time rather
+    than suppressed by deduplication and the BLE stage.
+    """
+    import shelly_handlers
+    from aggregator import Aggregator, parse_fields
+    from ble import BleStage
+    from dedup import DeadbandFilter, parse_deadbands
+
+    if bridge.dedup is not None:
+        bridge.dedup = DeadbandFilter(parse_deadbands(bridge.DEDUP_DEADBANDS), max_silence=bridge.DEDUP_MAX_SILENCE)
+    if bridge.aggregator is not None:
+        bridge.aggregator = Aggregator(bridge.windows, parse_fields(bridge.AGGREGATE_GAUGES),
+                                       parse_fields(bridge.AGGREGATE_COUNTERS))
+    # The router holds the BLE stage's handler and the components' state
+    shelly_handlers.ble_stage = bridge.ble_stage = BleStage(shelly_handlers.BLE_SENSOR)
+    bridge.router = shelly_handlers.build_router()
+
+
+def measure_allocations(bridge, messages):
+    """
+    Replays messages under tracemalloc with writes discarded, so only the MQTT thread's allocations are counted.
+
+    The pipeline state is rebuilt first, see ``reset_pipeline``.
+
+    Returns:
+        The average peak bytes allocated while handling a message, and the average bytes and memory blocks still
+        allocated after it.
+    """
+    reset_pipeline(bridge)
+    writer = bridge.writer
+    bridge.writer = _NullWriter()
+    # Leaves out tracemalloc's own allocations, e.g. the first snapshot
+    own = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(own)
+        peak_total = 0
+        for message in messages:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            bridge.on_message(None, None, message)
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+        after = tracemalloc.take_snapshot().filter_traces(own)
+    finally:
+        tracemalloc.stop()
+        bridge.writer = writer
+    retained = after.compare_to(before, "filename")
+    retained_bytes = sum(stat.size_diff for stat in retained)
+    retained_blocks = sum(stat.count_diff for stat in retained)
+    return peak_total / len(messages), retained_bytes / len(messages), retained_blocks / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays MQTT traffic through the bridge pipeline.")
+    parser.add_argument("capture", nargs="?", help="capture file written by capture.py or benchmarks.synthetic")
+    parser.add_argument("--synthetic", type=int, default=50000,
+                        help="number of synthetic messages to replay when no capture file is given")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--allocations", type=int, default=5000,
+                        help="messages replayed again under tracemalloc, 0 to skip")
+    parser.add_argument("--max-p99", type=float, default=0,
+                        help="exit with status 1 if the p99 latency exceeds this many microseconds")
+    args = parser.parse_args()
+
+    recorded = read_capture(args.capture) if args.capture else synthetic_traffic(args.synthetic)
+    messages = [Message(topic, payload, retain) for _, topic, payload, retain in recorded]
+    if not messages:
+        sys.exit("Nothing to replay")
+
+    stub = StubInflux().start()
+    bridge = _load_bridge(stub)
+    bridge.writer = bridge.create_writer()
+    bridge.writer.start()
+    try:
+        elapsed, latencies = replay(bridge, messages, args.rate)
+    finally:
+        bridge.flush_ble(force=True)
+        bridge.writer.close(timeout=60)
+    stats = bridge.writer.stats()
+
+    ordered = sorted(latencies)
+    p99 = _percentile(ordered, 0.99) * 1e6
+    print(f"messages:    {len(messages)} in {elapsed:.2f}s, {len(messages) / elapsed:.0f} msg/s")
+    print(f"latency:     p50 {_percentile(ordered, 0.50) * 1e6:.1f}us  p99 {p99:.1f}us  "
+          f"p99.9 {_percentile(ordered, 0.999) * 1e6:.1f}us  max {ordered[-1] * 1e6:.1f}us")
+    print(f"points:      {stats['points_written']} written, {stats['points_dropped']} dropped, "
+          f"stub received {stub.lines} lines in {stub.requests} requests")
+
+    if args.allocations:
+        sample = messages[:args.allocations]
+        peak, retained, blocks = measure_allocations(bridge, sample)
+        print(f"allocations: {peak:.0f} B/msg peak, {retained:.1f} B/msg and {blocks:.2f} blocks/msg retained "
+              f"({len(sample)} messages)")
+
+    stub.shutdown()
+    if args.max_p99 and p99 > args.max_p99:
+        sys.exit(f"p99 latency {p99:.1f}us exceeds {args.max_p99:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
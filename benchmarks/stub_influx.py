@@ -0,0 +1,91 @@
+"""
+Minimal local stand-in for the InfluxDB v2 write API.
+
+Accepts ``POST /api/v2/write`` (gzip or plain line protocol) and answers 204 without storing anything, counting
+requests, lines and bytes, so the replay benchmark measures the bridge rather than a database. ``/ping`` and
+``/health`` answer like InfluxDB for clients that check them.
+
+Run from the repository root to use it with the bridge itself:
+    python -m benchmarks.stub_influx --port 8086
+"""
+import argparse
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubInflux(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, _Handler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.lines = 0
+        self.bytes = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serves requests on a daemon thread.
+        """
+        threading.Thread(target=self.serve_forever, name="stub-influx", daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0] != "/api/v2/write":
+            self._reply(404)
+            return
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        lines = body.count(b"\n") + (1 if body and not body.endswith(b"\n") else 0)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.lines += lines
+            self.server.bytes += len(body)
+        self._reply(204)
+
+    def do_GET(self):
+        if self.path.startswith("/ping"):
+            self._reply(204)
+        elif self.path.startswith("/health"):
+            self._reply(200, b'{"name":"influxdb","status":"pass"}')
+        else:
+            self._reply(404)
+
+    def _reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a stub InfluxDB v2 write endpoint.")
+    parser.add_argument("--port", type=int, default=8086)
+    args = parser.parse_args()
+
+    server = StubInflux(("127.0.0.1", args.port))
+    print(f"Accepting writes on http://127.0.0.1:{server.port}/api/v2/write")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{server.requests} requests, {server.lines} lines, {server.bytes} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Minimal in-process stand-in for an MQTT broker.
+
+Speaks enough of MQTT 3.1.1 and 5 for the bridge and its tests: CONNECT, SUBSCRIBE and UNSUBSCRIBE with wildcard
+filters, PUBLISH at QoS 0 and 1 (delivered at QoS 0), PINGREQ and DISCONNECT. Shared subscriptions
+($share/<group>/<filter>) hand each message to one member of the group, round-robin like Mosquitto. Retained
+messages, sessions and authentication aren't supported, credentials are accepted and ignored.
+
+Run from the repository root to use it with the bridge itself:
+    python -m benchmarks.stub_mqtt --port 1883
+"""
+import argparse
+import itertools
+import socketserver
+import struct
+import threading
+
+_CONNECT, _CONNACK, _PUBLISH, _PUBACK = 1, 2, 3, 4
+_SUBSCRIBE, _SUBACK, _UNSUBSCRIBE, _UNSUBACK = 8, 9, 10, 11
+_PINGREQ, _PINGRESP, _DISCONNECT = 12, 13, 14
+
+_UINT16 = struct.Struct(">H")
+
+
+def topic_matches(subscription, topic):
+    """
+    Checks a topic against a subscription filter with + and # wildcards.
+    """
+    filter_parts = subscription.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _varint(value):
+    encoded = bytearray()
+    while True:
+        value, digit = divmod(value, 128)
+        encoded.append(digit | (128 if value else 0))
+        if not value:
+            return bytes(encoded)
+
+
+def _string(data, offset):
+    (length,) = _UINT16.unpack_from(data, offset)
+    offset += 2
+    return data[offset:offset + length].decode(), offset + length
+
+
+def _skip_properties(data, offset):
+    length = multiplier = 0
+    while True:
+        digit = data[offset]
+        offset += 1
+        length += (digit & 127) << multiplier
+        multiplier += 7
+        if not digit & 128:
+            return offset + length
+
+
+class StubBroker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, _Handler)
+        self.lock = threading.Lock()
+        # Subscription filter -> connections, and (group, filter) -> (connections, round-robin counter)
+        self.subscribers = {}
+        self.groups = {}
+        self.published = 0
+        self.delivered = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serves connections on a daemon thread.
+        """
+        threading.Thread(target=self.serve_forever, name="stub-mqtt", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def subscription_count(self, subscription):
+        """
+        Returns the number of connections subscribed to a filter, including shared ones ($share/<group>/<filter>).
+        """
+        with self.lock:
+            if subscription.startswith("$share/"):
+                _, group, subscription = subscription.split("/", 2)
+                members = self.groups.get((group, subscription))
+                return len(members[0]) if members else 0
+            return len(self.subscribers.get(subscription, ()))
+
+    def subscribe(self, connection, subscription):
+        with self.lock:
+            if subscription.startswith("$share/"):
+                _, group, subscription = subscription.split("/", 2)
+                members, _ = self.groups.setdefault((group, subscription), ([], itertools.count()))
+                if connection not in members:
+                    members.append(connection)
+            else:
+                members = self.subscribers.setdefault(subscription, [])
+                if connection not in members:
+                    members.append(connection)
+
+    def unsubscribe(self, connection, subscription=None):
+        """
+        Removes one subscription of a connection, or all of them if ``subscription`` is None.
+        """
+        with self.lock:
+            for (group, shared), (members, _) in self.groups.items():
+                if connection in members and subscription in (None, f"$share/{group}/{shared}"):
+                    members.remove(connection)
+            for key, members in self.subscribers.items():
+                if connection in members and subscription in (None, key):
+                    members.remove(connection)
+
+    def publish(self, topic, payload):
+        """
+        Delivers a message to every matching plain subscription and to one member of every matching group.
+        """
+        targets = set()
+        with self.lock:
+            self.published += 1
+            for subscription, members in self.subscribers.items():
+                if members and topic_matches(subscription, topic):
+                    targets.update(members)
+            for (_, subscription), (members, turn) in self.groups.items():
+                if members and topic_matches(subscription, topic):
+                    targets.add(members[next(turn) % len(members)])
+        for connection in targets:
+            if connection.send_publish(topic, payload):
+                with self.lock:
+                    self.delivered += 1
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.version = 4
+        self.send_lock = threading.Lock()
+
+    def send(self, packet_type, body, flags=0):
+        try:
+            with self.send_lock:
+                self.request.sendall(bytes([packet_type << 4 | flags]) + _varint(len(body)) + body)
+            return True
+        except OSError:
+            return False
+
+    def send_publish(self, topic, payload):
+        encoded = topic.encode()
+        body = _UINT16.pack(len(encoded)) + encoded + (b"\x00" if self.version == 5 else b"") + payload
+        return self.send(_PUBLISH, body)
+
+    def read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed")
+            data += chunk
+        return bytes(data)
+
+    def read_packet(self):
+        header = self.read(1)[0]
+        length = multiplier = 0
+        while True:
+            digit = self.read(1)[0]
+            length += (digit & 127) << multiplier
+            multiplier += 7
+            if not digit & 128:
+                break
+        return header >> 4, header & 15, self.read(length)
+
+    def handle(self):
+        properties = b""
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type == _CONNECT:
+                    _, offset = _string(body, 0)
+                    self.version = body[offset]
+                    properties = b"\x00" if self.version == 5 else b""
+                    self.send(_CONNACK, b"\x00\x00" + properties)
+                elif packet_type == _PUBLISH:
+                    qos = flags >> 1 & 3
+                    topic, offset = _string(body, 0)
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                    if self.version == 5:
+                        offset = _skip_properties(body, offset)
+                    self.server.publish(topic, body[offset:])
+                    if qos == 1:
+                        self.send(_PUBACK, packet_id)
+                elif packet_type in (_SUBSCRIBE, _UNSUBSCRIBE):
+                    packet_id = body[:2]
+                    offset = _skip_properties(body, 2) if self.version == 5 else 2
+                    codes = bytearray()
+                    while offset < len(body):
+                        subscription, offset = _string(body, offset)
+                        if packet_type == _SUBSCRIBE:
+                            offset += 1
+                            self.server.subscribe(self, subscription)
+                        else:
+                            self.server.unsubscribe(self, subscription)
+                        codes.append(0)
+                    if packet_type == _SUBSCRIBE:
+                        self.send(_SUBACK, packet_id + properties + bytes(codes))
+                    else:
+                        self.send(_UNSUBACK, packet_id + properties + (bytes(codes) if self.version == 5 else b""))
+                elif packet_type == _PINGREQ:
+                    self.send(_PINGRESP, b"")
+                elif packet_type == _DISCONNECT:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.unsubscribe(self)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a stub MQTT broker.")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = StubBroker(("127.0.0.1", args.port))
+    print(f"Accepting MQTT connections on 127.0.0.1:{broker.port}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{broker.published} messages published, {broker.delivered} delivered")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Generates synthetic MQTT traffic shaped like a real installation, for the replay benchmark.
+
+Payloads mirror what the devices publish: Shelly Gen1 single-value topics, Gen2 status documents (including the
+components the bridge doesn't handle), BLU events relayed by Gen2 gateways and Tasmota smart meter readers.
+
+Run from the repository root to write a capture file:
+    python -m benchmarks.synthetic synthetic.cap.gz --count 200000
+"""
+import argparse
+import json
+import random
+import time
+
+from capture import CaptureWriter
+
+# Relative share of each device family in the generated traffic
+DEFAULT_MIX = {"gen1": 1, "gen2": 6, "ble": 2, "tasmota": 1}
+
+
+def _mac(rng):
+    return "".join(rng.choice("0123456789abcdef") for _ in range(12))
+
+
+def gen1_messages(rng, devices=10):
+    """
+    Yields (topic, payload) tuples of Shelly H&T Gen1 devices publishing one value per topic.
+    """
+    ids = [f"shellyht-{_mac(rng)[:6].upper()}" for _ in range(devices)]
+    while True:
+        device = rng.choice(ids)
+        yield f"shellies/{device}/sensor/temperature", f"{rng.uniform(15, 28):.2f}".encode()
+        yield f"shellies/{device}/sensor/humidity", f"{rng.uniform(30, 70):.1f}".encode()
+        yield f"shellies/{device}/sensor/battery", str(rng.randint(20, 100)).encode()
+
+
+def gen2_messages(rng, devices=20):
+    """
+    Yields (topic, payload) tuples of Shelly Plus/Pro devices publishing status documents.
+    """
+    switches = [f"shellyplus1pm-{_mac(rng)}" for _ in range(devices)]
+    sensors = [f"shellyplusht-{_mac(rng)}" for _ in range(max(1, devices // 4))]
+    energy = {device: rng.uniform(1000, 200000) for device in switches}
+    while True:
+        device = rng.choice(switches)
+        apower = round(rng.uniform(0, 2500), 1)
+        energy[device] += apower / 3600
+        minute_ts = int(time.time()) // 60 * 60
+        yield f"{device}/status/switch:0", json.dumps({
+            "id": 0, "source": "timer", "output": apower > 0, "apower": apower,
+            "voltage": round(rng.uniform(225, 240), 1), "freq": 50.0, "current": round(apower / 230, 3),
+            "aenergy": {"total": round(energy[device], 3), "by_minute": [round(rng.uniform(0, 40000), 3)] * 3,
+                        "minute_ts": minute_ts},
+            "temperature": {"tC": round(rng.uniform(30, 60), 1), "tF": round(rng.uniform(86, 140), 1)},
+        }, separators=(",", ":")).encode()
+        # Status of components the bridge doesn't write, delivered by the same +/status/+ filter
+        yield f"{device}/status/sys", json.dumps({
+            "mac": device.rsplit("-", 1)[1].upper(), "restart_required": False, "time": "12:59",
+            "unixtime": int(time.time()), "uptime": rng.randint(1000, 10 ** 7), "ram_size": 246144,
+            "ram_free": rng.randint(90000, 150000), "fs_size": 458752, "fs_free": 131072, "cfg_rev": 17,
+            "kvs_rev": 0, "schedule_rev": 1, "webhook_rev": 0, "available_updates": {}}, separators=(",", ":")).encode()
+
+        sensor = rng.choice(sensors)
+        celsius = round(rng.uniform(15, 28), 1)
+        yield f"{sensor}/status/temperature:0", json.dumps(
+            {"id": 0, "tC": celsius, "tF": round(celsius * 1.8 + 32, 1)}, separators=(",", ":")).encode()
+        yield f"{sensor}/status/humidity:0", json.dumps(
+            {"id": 0, "rh": round(rng.uniform(30, 70), 1)}, separators=(",", ":")).encode()
+
+
+def ble_messages(rng, devices=15, gateways=3):
+    """
+    Yields (topic, payload) tuples of BLU Motion, Button, Door/Window and H&T events relayed by Gen2 gateways.
+    """
+    gateway_ids = [f"shellyplus1pm-{_mac(rng)}" for _ in range(gateways)]
+    addresses = [":".join(_mac(rng)[i:i + 2] for i in range(0, 12, 2)) for _ in range(devices)]
+    kinds = {address: rng.choice(("motion", "button", "window", "ht")) for address in addresses}
+    pids = {address: rng.randint(0, 255) for address in addresses}
+    while True:
+        address = rng.choice(addresses)
+        pids[address] = (pids[address] + 1) % 256
+        payload = {"encryption": False, "BTHome_version": 2, "pid": pids[address], "battery": rng.randint(40, 100),
+                   "rssi": rng.randint(-95, -50), "address": address}
+        kind = kinds[address]
+        if kind == "motion":
+            payload.update(illuminance=rng.randint(0, 1000), motion=rng.randint(0, 1))
+        elif kind == "button":
+            payload.update(button=rng.choice((1, 2, 3, 4)))
+        elif kind == "window":
+            payload.update(illuminance=rng.randint(0, 1000), window=rng.randint(0, 1), rotation=0)
+        else:
+            payload.update(temperature=round(rng.uniform(15, 28), 1), humidity=rng.randint(30, 70))
+        gateway = rng.choice(gateway_ids)
+        yield f"{gateway}/events/ble", json.dumps(
+            {"src": gateway, "dst": "shelly-blu", "event": "shelly-blu", "payload": payload},
+            separators=(",", ":")).encode()
+
+
+def tasmota_messages(rng, devices=2):
+    """
+    Yields (topic, payload) tuples of Tasmota smart meter readers publishing tele/<device>/SENSOR.
+    """
+    meters = {f"tasmota_{_mac(rng)[:6].upper()}": [rng.uniform(1000, 50000), rng.uniform(0, 20000)]
+              for _ in range(devices)}
+    while True:
+        device = rng.choice(list(meters))
+        phases = [round(rng.uniform(-3000, 3000), 1) for _ in range(3)]
+        total = round(sum(phases), 1)
+        counters = meters[device]
+        counters[0 if total > 0 else 1] += abs(total) / 3600000
+        yield f"tele/{device}/SENSOR", json.dumps({
+            "Time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "Zaehler": {"Verbrauch1": round(counters[0], 4), "Lieferung1": round(counters[1], 4), "Pges": total,
+                        "P_L1": phases[0], "P_L2": phases[1], "P_L3": phases[2]},
+        }, separators=(",", ":")).encode()
+
+
+GENERATORS = {"gen1": gen1_messages, "gen2": gen2_messages, "ble": ble_messages, "tasmota": tasmota_messages}
+
+
+def synthetic_traffic(count, mix=None, seed=1, rate=100.0):
+    """
+    Generates a mix of messages from all device families.
+
+    Args:
+        count: The number of messages.
+        mix: Maps family names of GENERATORS to their relative share, defaults to DEFAULT_MIX.
+        seed: Seed of the random generator, the same seed gives the same traffic.
+        rate: Messages per second used for the timestamps.
+
+    Returns:
+        A list of (timestamp, topic, payload, retain) tuples like ``capture.read_capture``.
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    families = list(mix)
+    generators = [GENERATORS[family](rng) for family in families]
+    weights = [mix[family] for family in families]
+    start = time.time()
+    messages = []
+    for i in range(count):
+        topic, payload = next(rng.choices(generators, weights)[0])
+        messages.append((start + i / rate, topic, payload, False))
+    return messages
+
+
+def parse_mix(spec):
+    """
+    Parses a mix like ``"gen2=6,ble=2"``.
+    """
+    mix = {}
+    for entry in spec.split(","):
+        name, _, share = entry.partition("=")
+        mix[name.strip()] = float(share or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes synthetic Shelly/Tasmota traffic to a capture file.")
+    parser.add_argument("output", help="capture file to write, gzipped if it ends in .gz")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--mix", type=parse_mix, default=None, help='e.g. "gen1=1,gen2=6,ble=2,tasmota=1"')
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    capture = CaptureWriter(args.output)
+    for timestamp, topic, payload, retain in synthetic_traffic(args.count, args.mix, args.seed):
+        capture.write(timestamp, topic, payload, retain)
+    capture.close()
+    print(f"Wrote {capture.messages} messages to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
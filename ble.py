@@ -0,0 +1,226 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from decoders import decoder
+from device_tags import device_tags
+from structured_logging import Sampler, fields
+
+##
+# BLE ingestion stage for BLU events relayed by Shelly Gen2 gateways.
+#
+# Every gateway in range relays the same advertisement, within milliseconds of the others. Copies are recognized by
+# their (address, pid) and merged for BLE_MERGE_WINDOW seconds into one record carrying all fields of the
+# advertisement and the gateway that received it with the strongest RSSI. Copies arriving later, up to
+# BLE_DEDUP_WINDOW seconds after the first one, are dropped. Past that, pids (a one byte counter) are taken as new
+# advertisements again. BLE_MIN_INTERVAL limits how often an address is written: periodic readings arriving sooner
+# are dropped, while button presses and motion or window changes are always written.
+##
+
+BLE_MERGE_WINDOW = float(os.getenv('BLE_MERGE_WINDOW', 0.5))
+BLE_DEDUP_WINDOW = float(os.getenv('BLE_DEDUP_WINDOW', 30))
+BLE_MIN_INTERVAL = float(os.getenv('BLE_MIN_INTERVAL', 1))  # Set to 0 to write every advertisement
+BLE_MAX_ENTRIES = int(os.getenv('BLE_MAX_ENTRIES', 4096))
+
+# Field values as returned by the decoder, without the address
+_PID, _TEMPERATURE, _HUMIDITY, _MOTION, _BUTTON, _WINDOW, _RSSI = 2, 4, 5, 7, 8, 9, 11
+# Value types written as fields
+_SCALARS = (type(None), bool, int, float, str)
+
+log = logging.getLogger("ble")
+error_sampler = Sampler(1000)
+
+
+class _Pending:
+    __slots__ = ("due", "time", "gateway", "values")
+
+    def __init__(self, due, time, gateway, values):
+        self.due = due
+        self.time = time
+        self.gateway = gateway
+        self.values = values
+
+
+class BleStage:
+    """
+    Merges, deduplicates and rate-limits BLU advertisements before records are written.
+
+    Memory is bounded by ``max_entries``: advertisements waiting to be merged are written early when there are
+    more, the oldest (address, pid) keys are forgotten first, and the per-address state is reset when full.
+    """
+
+    def __init__(self, template, tags=device_tags, merge_window=BLE_MERGE_WINDOW, dedup_window=BLE_DEDUP_WINDOW,
+                 min_interval=BLE_MIN_INTERVAL, max_entries=BLE_MAX_ENTRIES):
+        """
+        Args:
+            template: The template of the records. Its tag keys are the address, the gateway and the metadata tag
+                      keys, its field keys the decoder's BLE values after the address.
+            tags: The ``DeviceTagCache`` providing the metadata tags.
+            merge_window: Seconds copies of an advertisement are merged before its record is written.
+            dedup_window: Seconds after the first copy during which later copies are dropped, 0 to disable.
+            min_interval: Minimum seconds between two records of an address without an event, 0 to disable.
+            max_entries: Maximum number of advertisements and addresses kept.
+        """
+        self._template = template
+        self._device_tags = tags
+        self._merge_window = merge_window
+        self._dedup_window = dedup_window
+        self._min_interval = min_interval
+        self._max_entries = max_entries
+        self._pending = OrderedDict()
+        self._recent = OrderedDict()
+        self._last_written = {}
+
+        self.advertisements = 0
+        self.copies_merged = 0
+        self.duplicates_dropped = 0
+        self.rate_limited = 0
+        self.records_emitted = 0
+        self.records_failed = 0
+
+    def stats(self):
+        """
+        Returns a snapshot of the stage counters.
+        """
+        return {
+            "pending": len(self._pending),
+            "advertisements": self.advertisements,
+            "copies_merged": self.copies_merged,
+            "duplicates_dropped": self.duplicates_dropped,
+            "rate_limited": self.rate_limited,
+            "records_emitted": self.records_emitted,
+            "records_failed": self.records_failed,
+        }
+
+    def handle(self, topic_parts, payload):
+        """
+        Message handler for ``<gateway>/events/ble`` topics.
+
+        Returns:
+            The records of advertisements whose merge window is over, usually not including this one.
+        """
+        data = decoder.ble_event(payload)
+        if data is not None and data[0] is not None:
+            self.add(topic_parts[0], data)
+        return self.flush()
+
+    def add(self, gateway, data, now=None):
+        """
+        Adds one copy of an advertisement.
+
+        Values are checked and converted here, so an invalid advertisement fails the message that carried it rather
+        than the flush writing it later.
+
+        Args:
+            gateway: The device that relayed it.
+            data: The decoded BLE_FIELDS values.
+            now: The current ``time.monotonic()``.
+
+        Raises:
+            ValueError, TypeError: If a value has the wrong type.
+        """
+        if now is None:
+            now = time.monotonic()
+        address = data[0]
+        values = list(data[1:])
+        for value in data:
+            if value.__class__ not in _SCALARS:
+                raise TypeError(f"Unsupported BLE value {value!r}")
+        # Temperature and humidity are written as floats like those of the Gen1 and Gen2 sensors
+        if values[_TEMPERATURE] is not None:
+            values[_TEMPERATURE] = float(values[_TEMPERATURE])
+        if values[_HUMIDITY] is not None:
+            values[_HUMIDITY] = float(values[_HUMIDITY])
+        rssi = values[_RSSI]
+        if rssi is not None and (rssi.__class__ not in (int, float)):
+            raise ValueError(f"Invalid rssi {rssi!r}")
+        key = (address, values[_PID])
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            # Another gateway's copy: fill in what the first one lacked and keep the best reception
+            self.copies_merged += 1
+            merged = pending.values
+            for i, value in enumerate(values):
+                if merged[i] is None:
+                    merged[i] = value
+            rssi = values[_RSSI]
+            if rssi is not None and (merged[_RSSI] is None or rssi > merged[_RSSI]):
+                merged[_RSSI] = rssi
+                pending.gateway = gateway
+            return
+
+        if self._dedup_window:
+            expires = self._recent.get(key)
+            if expires is not None:
+                if now < expires:
+                    self.duplicates_dropped += 1
+                    return
+                del self._recent[key]
+            self._recent[key] = now + self._dedup_window
+            while len(self._recent) > self._max_entries:
+                self._recent.popitem(last=False)
+
+        self.advertisements += 1
+        self._pending[key] = _Pending(now + self._merge_window, time.time_ns(), gateway, values)
+
+    def flush(self, now=None, force=False):
+        """
+        Builds the records of advertisements whose merge window is over.
+
+        Args:
+            now: The current ``time.monotonic()``.
+            force: Also build the records of advertisements still in their merge window, e.g. on shutdown.
+
+        Returns:
+            A list of records.
+        """
+        if not self._pending:
+            return []
+        if now is None:
+            now = time.monotonic()
+        records = []
+        # Advertisements are kept in arrival order, so the ones due are at the front
+        overflow = len(self._pending) - self._max_entries
+        while self._pending:
+            key, pending = next(iter(self._pending.items()))
+            if pending.due > now and overflow <= 0 and not force:
+                break
+            overflow -= 1
+            self._pending.popitem(last=False)
+            try:
+                record = self._record(key[0], pending)
+            except Exception as e:
+                # Flushing runs outside of any message's handling, a bad entry must not fail an unrelated message
+                self.records_failed += 1
+                if error_sampler():
+                    log.warning("Dropping BLE advertisement", extra=fields(address=key[0], error=e))
+                continue
+            if record is not None:
+                records.append(record)
+
+        while self._recent:
+            key, expires = next(iter(self._recent.items()))
+            if expires > now:
+                break
+            del self._recent[key]
+        return records
+
+    def _record(self, address, pending):
+        values = pending.values
+        events = (values[_MOTION], values[_BUTTON], values[_WINDOW])
+        if self._min_interval:
+            last = self._last_written.get(address)
+            # Button presses are events every time, motion and window states when they change
+            if last is not None and pending.due - last[0] < self._min_interval and not values[_BUTTON] \
+                    and events == last[1]:
+                self.rate_limited += 1
+                return None
+            if len(self._last_written) >= self._max_entries and address not in self._last_written:
+                self._last_written.clear()
+            self._last_written[address] = (pending.due, events)
+
+        self.records_emitted += 1
+        return self._template.record((address, pending.gateway) + self._device_tags.tags(address), values,
+                                     pending.time)
@@ -0,0 +1,130 @@
+import argparse
+import gzip
+import os
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+from shelly_handlers import build_router
+
+##
+# Records live MQTT traffic for the replay benchmark (benchmarks/replay.py).
+#
+# A capture file starts with MAGIC followed by one record per message: a header with the receive time, the retain
+# flag and the topic and payload lengths, then the raw topic and payload bytes. Files ending in .gz are gzipped.
+#
+#   python capture.py traffic.cap.gz --duration 600
+##
+
+load_dotenv()
+
+MQTT_USERNAME = os.getenv('MQTT_USERNAME')
+MQTT_PASSWORD = os.getenv('MQTT_PASSWORD')
+MQTT_SERVER = os.getenv('MQTT_SERVER')
+MQTT_PORT = int(os.getenv('MQTT_PORT', 1883))
+
+MAGIC = b"SQTTCAP1"
+# receive time (seconds since the epoch), retain flag, topic length, payload length
+_HEADER = struct.Struct("<dBHI")
+
+
+def _open(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+class CaptureWriter:
+    """
+    Appends messages to a capture file.
+    """
+
+    def __init__(self, path):
+        self._file = _open(path, "wb")
+        self._file.write(MAGIC)
+        self.messages = 0
+
+    def write(self, timestamp, topic, payload, retain=False):
+        """
+        Args:
+            timestamp: Receive time in seconds since the epoch.
+            topic: The message topic.
+            payload: The raw payload bytes.
+            retain: The message's retain flag.
+        """
+        topic = topic.encode()
+        self._file.write(_HEADER.pack(timestamp, bool(retain), len(topic), len(payload)))
+        self._file.write(topic)
+        self._file.write(payload)
+        self.messages += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Reads a capture file.
+
+    Returns:
+        A list of (timestamp, topic, payload, retain) tuples.
+    """
+    with _open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a capture file")
+
+    messages = []
+    offset = len(MAGIC)
+    view = memoryview(data)
+    while offset < len(data):
+        timestamp, retain, topic_length, payload_length = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        topic = str(view[offset:offset + topic_length], "utf-8")
+        offset += topic_length
+        messages.append((timestamp, topic, bytes(view[offset:offset + payload_length]), bool(retain)))
+        offset += payload_length
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Records MQTT traffic to a capture file for the replay benchmark.")
+    parser.add_argument("output", help="capture file to write, gzipped if it ends in .gz")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to record, 0 until interrupted")
+    parser.add_argument("--count", type=int, default=0, help="messages to record, 0 for no limit")
+    parser.add_argument("--all", action="store_true", help="record every topic (#) instead of the bridge's filters")
+    args = parser.parse_args()
+
+    subscriptions = ["#"] if args.all else build_router().subscriptions()
+    capture = CaptureWriter(args.output)
+    done = threading.Event()
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        client.subscribe([(subscription, 0) for subscription in subscriptions])
+        print(f"Recording {', '.join(subscriptions)} to {args.output}")
+
+    def on_message(client, userdata, msg):
+        capture.write(time.time(), msg.topic, msg.payload, msg.retain)
+        if args.count and capture.messages >= args.count:
+            done.set()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.connect(MQTT_SERVER, MQTT_PORT, 60)
+    client.loop_start()
+    try:
+        done.wait(args.duration or None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        capture.close()
+        print(f"Recorded {capture.messages} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+from collections import namedtuple
+
+from decoders import decoder
+from device_tags import device_tags
+from line_protocol import Template
+
+# A registered component type: the template its records use, a function extracting the field values from a
+# status payload, in template field order, and the channel written without a channel tag, if any
+ComponentType = namedtuple("ComponentType", ["template", "extract", "untagged_channel"])
+
+# Tags of component measurements: the device the status came from, the component id (e.g. 2 for switch:2) and the
+# device's metadata tags
+COMPONENT_TAGS = ("device_id", "channel") + device_tags.tag_keys
+
+
+class ComponentRegistry:
+    """
+    Handles Shelly Gen2 ``<prefix>/status/<type>:<id>`` topics for every registered component type.
+
+    Instead of one handler per component and channel, each component type is registered once with its template
+    and the status values to write. A status topic is resolved once to its component type and tag values
+    (device id, channel and device metadata) and the result is cached per topic, so handling a message of a known
+    topic is one dict lookup, one decode and one record.
+    """
+
+    def __init__(self, cache_size=65536, tags=device_tags):
+        """
+        Args:
+            cache_size: Maximum number of topics whose resolution is cached.
+            tags: The ``DeviceTagCache`` providing the metadata tags.
+        """
+        self._types = {}
+        self._cache = {}
+        self._cache_size = cache_size
+        self._device_tags = tags
+        # Metadata changes are rare, dropping all resolutions is simpler than tracking the topics of a device
+        tags.add_listener(lambda device_id: self._cache.clear())
+
+    def register(self, component_type, template, extract, untagged_channel=None):
+        """
+        Registers a component type.
+
+        Args:
+            component_type: The type as it appears in status topics, e.g. ``switch``.
+            template: The template of the records. Its tag keys are the device id, optionally the channel, and
+                      the metadata tag keys.
+            extract: Function taking a status payload and returning the field values in template field order.
+            untagged_channel: A channel, e.g. ``"0"``, whose records leave out the channel tag, so series written
+                              before the type had one continue.
+        """
+        self._types[component_type] = ComponentType(template, extract, untagged_channel)
+        self._cache.clear()
+
+    def register_fields(self, component_type, measurement, fields):
+        """
+        Registers a component type whose status values are written as they are.
+
+        Numbers are written as floats: meters report whole values like ``50`` without a fraction, and an integer
+        field would make InfluxDB reject every later ``49.98`` of the series as a field type conflict.
+
+        Args:
+            component_type: The type as it appears in status topics, e.g. ``em``.
+            measurement: The measurement written to.
+            fields: Maps field names to status keys, ``key`` or ``key.subkey`` for a value of a nested object.
+        """
+        extract = decoder.compile(tuple(fields.values()))
+
+        def extract_floats(payload):
+            return tuple(float(value) if value.__class__ is int else value for value in extract(payload))
+        self.register(component_type, Template(measurement, COMPONENT_TAGS, tuple(fields)), extract_floats)
+
+    def types(self):
+        """
+        Returns the registered component types.
+        """
+        return list(self._types)
+
+    def _resolve(self, device_id, component):
+        component_type, _, channel = component.partition(":")
+        registered = self._types.get(component_type)
+        if registered is None or not channel:
+            return None
+        template = registered.template
+        metadata = self._device_tags.tags(device_id, 2)
+        own = len(template.tag_keys) - len(metadata)
+        if channel == registered.untagged_channel:
+            channel = None
+        tags = ((device_id, channel) if own == 2 else (device_id,)) + metadata
+        return template, tags, registered.extract
+
+    def handle(self, topic_parts, payload):
+        """
+        Message handler for ``<prefix>/status/<type>:<id>`` topics.
+
+        Returns:
+            A list with the record of the status, empty for unregistered component types.
+        """
+        key = (topic_parts[0], topic_parts[2])
+        try:
+            resolved = self._cache[key]
+        except KeyError:
+            resolved = self._resolve(*key)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[key] = resolved
+
+        if resolved is None:
+            return []
+        template, tags, extract = resolved
+        return [template.record(tags, extract(payload))]
@@ -0,0 +1,309 @@
+import json
+import os
+from typing import Any, Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+##
+# JSON payload decoding for the message handlers.
+#
+# Handlers ask a decoder for exactly the values they write, decoded straight from the bytes payload. With msgspec
+# installed (pip install msgspec) payloads are decoded into typed structs declaring only those values, so the rest
+# of a Gen2 status document (by_minute arrays, sys info, ...) is skipped without building dicts for it. With orjson
+# installed, payloads are decoded into dicts faster than the standard library does; otherwise json is used.
+# JSON_DECODER selects a backend: auto (the fastest installed), msgspec, orjson or json.
+##
+
+JSON_DECODER = os.getenv('JSON_DECODER', 'auto')
+
+# Values of a BLU event payload, in the order decoders return them
+BLE_FIELDS = ("address", "encryption", "BTHome_version", "pid", "battery", "temperature", "humidity", "illuminance",
+              "motion", "button", "window", "rotation", "rssi")
+TASMOTA_FIELDS = ("Verbrauch1", "Lieferung1", "Pges", "P_L1", "P_L2", "P_L3")
+
+
+class JsonDecoder:
+    """
+    Decodes payloads with the standard library json module and picks the values out of the resulting dicts.
+    """
+    name = "json"
+    loads = staticmethod(json.loads)
+
+    def switch(self, payload):
+        """
+        Decodes a Gen2 ``switch:<id>`` status.
+
+        Returns:
+            (output, apower, voltage, current, aenergy.total, temperature.tC, temperature.tF)
+        """
+        data = self.loads(payload)
+        # Switches without power metering (Plus 1, Pro 4 relays) have no aenergy
+        aenergy = data.get("aenergy") or {}
+        temperature = data.get("temperature") or {}
+        return (data.get("output"), data.get("apower"), data.get("voltage"), data.get("current"),
+                aenergy.get("total"), temperature.get("tC"), temperature.get("tF"))
+
+    def temperature(self, payload):
+        """
+        Decodes a Gen2 ``temperature:<id>`` status.
+
+        Returns:
+            (id, tC, tF)
+        """
+        data = self.loads(payload)
+        return data.get("id"), data.get("tC"), data.get("tF")
+
+    def humidity(self, payload):
+        """
+        Decodes a Gen2 ``humidity:<id>`` status.
+
+        Returns:
+            The relative humidity.
+        """
+        return self.loads(payload).get("rh")
+
+    def ble_event(self, payload):
+        """
+        Decodes a BLU event relayed by a BLE gateway.
+
+        Returns:
+            A tuple of the BLE_FIELDS values, None for the ones missing, or None if the event has no payload.
+        """
+        data = self.loads(payload).get("payload")
+        if not isinstance(data, dict):
+            return None
+        get = data.get
+        return tuple(get(field) for field in BLE_FIELDS)
+
+    def tasmota_sensor(self, payload):
+        """
+        Decodes the ``Zaehler`` block of a Tasmota SENSOR message.
+
+        Returns:
+            A tuple of the TASMOTA_FIELDS values, or None if the message has no Zaehler block.
+        """
+        data = self.loads(payload).get("Zaehler")
+        if not isinstance(data, dict):
+            return None
+        get = data.get
+        return tuple(get(field) for field in TASMOTA_FIELDS)
+
+    def compile(self, paths):
+        """
+        Creates a function extracting values from a JSON object payload.
+
+        Args:
+            paths: Keys of the values, ``key`` or ``key.subkey`` for a value of a nested object.
+
+        Returns:
+            A function taking a payload and returning a tuple of the values, None for the ones missing.
+        """
+        keys = tuple(tuple(path.split(".", 1)) for path in paths)
+        loads = self.loads
+
+        def extract(payload):
+            get = loads(payload).get
+            values = []
+            for key in keys:
+                value = get(key[0])
+                if len(key) == 2:
+                    value = value.get(key[1]) if isinstance(value, dict) else None
+                values.append(value)
+            return tuple(values)
+        return extract
+
+
+class OrjsonDecoder(JsonDecoder):
+    """
+    Decodes payloads with orjson.
+    """
+    name = "orjson"
+    loads = staticmethod(orjson.loads) if orjson is not None else None
+
+
+if msgspec is not None:
+    # Typed schemas, declaring only the values the handlers write. Values are Any so integers stay integers and
+    # InfluxDB field types don't change.
+    class _Energy(msgspec.Struct):
+        total: Any = None
+
+    class _DeviceTemperature(msgspec.Struct):
+        tC: Any = None
+        tF: Any = None
+
+    class SwitchStatus(msgspec.Struct):
+        aenergy: Optional[_Energy] = None
+        temperature: Optional[_DeviceTemperature] = None
+        output: Any = None
+        apower: Any = None
+        voltage: Any = None
+        current: Any = None
+
+    class TemperatureStatus(msgspec.Struct):
+        id: Any = None
+        tC: Any = None
+        tF: Any = None
+
+    class HumidityStatus(msgspec.Struct):
+        rh: Any = None
+
+    class BlePayload(msgspec.Struct):
+        address: Any = None
+        encryption: Any = None
+        BTHome_version: Any = None
+        pid: Any = None
+        battery: Any = None
+        temperature: Any = None
+        humidity: Any = None
+        illuminance: Any = None
+        motion: Any = None
+        button: Any = None
+        window: Any = None
+        rotation: Any = None
+        rssi: Any = None
+
+    class BleEvent(msgspec.Struct):
+        payload: Optional[BlePayload] = None
+
+    class ZaehlerBlock(msgspec.Struct):
+        Verbrauch1: Any = None
+        Lieferung1: Any = None
+        Pges: Any = None
+        P_L1: Any = None
+        P_L2: Any = None
+        P_L3: Any = None
+
+    class TasmotaSensor(msgspec.Struct):
+        Zaehler: Optional[ZaehlerBlock] = None
+
+
+class MsgspecDecoder(JsonDecoder):
+    """
+    Decodes payloads into the typed msgspec schemas above.
+
+    Payloads that are valid JSON but don't fit a schema (e.g. a value that isn't an object) are decoded again by
+    the dict based path, so they are handled exactly like with the other decoders.
+    """
+    name = "msgspec"
+    loads = staticmethod(msgspec.json.decode) if msgspec is not None else None
+
+    def __init__(self):
+        self._switch = msgspec.json.Decoder(SwitchStatus)
+        self._temperature = msgspec.json.Decoder(TemperatureStatus)
+        self._humidity = msgspec.json.Decoder(HumidityStatus)
+        self._ble_event = msgspec.json.Decoder(BleEvent)
+        self._tasmota_sensor = msgspec.json.Decoder(TasmotaSensor)
+
+    def switch(self, payload):
+        try:
+            status = self._switch.decode(payload)
+        except msgspec.ValidationError:
+            return super().switch(payload)
+        aenergy = status.aenergy
+        temperature = status.temperature
+        return (status.output, status.apower, status.voltage, status.current,
+                aenergy.total if aenergy is not None else None,
+                temperature.tC if temperature is not None else None,
+                temperature.tF if temperature is not None else None)
+
+    def temperature(self, payload):
+        try:
+            status = self._temperature.decode(payload)
+        except msgspec.ValidationError:
+            return super().temperature(payload)
+        return status.id, status.tC, status.tF
+
+    def humidity(self, payload):
+        try:
+            return self._humidity.decode(payload).rh
+        except msgspec.ValidationError:
+            return super().humidity(payload)
+
+    def ble_event(self, payload):
+        try:
+            data = self._ble_event.decode(payload).payload
+        except msgspec.ValidationError:
+            return super().ble_event(payload)
+        if data is None:
+            return None
+        return (data.address, data.encryption, data.BTHome_version, data.pid, data.battery, data.temperature,
+                data.humidity, data.illuminance, data.motion, data.button, data.window, data.rotation, data.rssi)
+
+    def tasmota_sensor(self, payload):
+        try:
+            data = self._tasmota_sensor.decode(payload).Zaehler
+        except msgspec.ValidationError:
+            return super().tasmota_sensor(payload)
+        if data is None:
+            return None
+        return data.Verbrauch1, data.Lieferung1, data.Pges, data.P_L1, data.P_L2, data.P_L3
+
+    def compile(self, paths):
+        # A struct type declaring just these keys, with a nested struct per object holding subkeys
+        nested = {}
+        for path in paths:
+            key, _, subkey = path.partition(".")
+            subkeys = nested.setdefault(key, [])
+            if subkey and subkey not in subkeys:
+                subkeys.append(subkey)
+        fields = [(key, Optional[msgspec.defstruct(f"_{key}", [(subkey, Any, None) for subkey in subkeys])]
+                   if subkeys else Any, None) for key, subkeys in nested.items()]
+        decode = msgspec.json.Decoder(msgspec.defstruct("_Status", fields)).decode
+        keys = tuple(tuple(path.split(".", 1)) for path in paths)
+        fallback = super().compile(paths)
+
+        def extract(payload):
+            try:
+                status = decode(payload)
+            except msgspec.ValidationError:
+                return fallback(payload)
+            values = []
+            for key in keys:
+                value = getattr(status, key[0])
+                if len(key) == 2:
+                    value = getattr(value, key[1]) if value is not None else None
+                values.append(value)
+            return tuple(values)
+        return extract
+
+
+DECODERS = {"msgspec": MsgspecDecoder, "orjson": OrjsonDecoder, "json": JsonDecoder}
+_AVAILABLE = {"msgspec": msgspec is not None, "orjson": orjson is not None, "json": True}
+
+
+def available_decoders():
+    """
+    Returns the names of the installed decoders, fastest first.
+    """
+    return [name for name in DECODERS if _AVAILABLE[name]]
+
+
+def create_decoder(name="auto"):
+    """
+    Creates a payload decoder.
+
+    Args:
+        name: msgspec, orjson or json, or auto for the fastest one installed.
+
+    Returns:
+        A decoder instance.
+    """
+    if name == "auto":
+        name = available_decoders()[0]
+    if name not in DECODERS:
+        raise ValueError(f"Unknown JSON decoder {name!r}, expected one of auto, {', '.join(DECODERS)}")
+    if not _AVAILABLE[name]:
+        raise ImportError(f"JSON decoder {name!r} is not installed")
+    return DECODERS[name]()
+
+
+# The decoder used by the message handlers
+decoder = create_decoder(JSON_DECODER)
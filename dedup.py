@@ -0,0 +1,142 @@
+import time
+
+
+def parse_deadbands(spec):
+    """
+    Parses a deadband specification.
+
+    Args:
+        spec: Comma separated ``field=band`` entries. The field can be qualified with its measurement
+              (``shelly_power.apower=5``), a band ending in ``%`` is relative to the last written value
+              (``humidity=2%``), otherwise it is absolute.
+
+    Returns:
+        A dict mapping field or ``measurement.field`` names to (absolute, relative) deadbands.
+    """
+    deadbands = {}
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, band = entry.partition("=")
+        band = band.strip()
+        if band.endswith("%"):
+            deadbands[name.strip()] = (0.0, float(band[:-1]) / 100)
+        else:
+            deadbands[name.strip()] = (float(band), 0.0)
+    return deadbands
+
+
+class DeadbandFilter:
+    """
+    Drops records whose fields haven't changed meaningfully since the last record written for the same series.
+
+    For every series (template and tag values) the field values of the last record that was let through are kept.
+    A new record is let through if any field moved outside its deadband, changed type or appeared/disappeared,
+    or if nothing was written for the series for ``max_silence`` seconds (a heartbeat, so dashboards and
+    ``last()`` queries don't go stale). Comparing against the last written value rather than the last seen one
+    means slow drifts still get written once they add up to more than the deadband.
+
+    Fields without a configured deadband are only suppressed when they are exactly equal. Plain ``Point`` objects
+    are always let through.
+    """
+
+    def __init__(self, deadbands=None, max_silence=300.0, max_series=100000):
+        """
+        Args:
+            deadbands: Dict from ``parse_deadbands``.
+            max_silence: Maximum seconds between two written records of a series.
+            max_series: Maximum number of series kept before the state is reset.
+        """
+        self._deadbands = deadbands or {}
+        self._max_silence = max_silence
+        self._max_series = max_series
+        self._bands = {}
+        self._state = {}
+        self._seen_topics = set()
+
+        self.records_passed = 0
+        self.records_suppressed = 0
+        self.fields_suppressed = 0
+        self.retained_suppressed = 0
+
+    def stats(self):
+        """
+        Returns a snapshot of the filter counters.
+        """
+        return {
+            "series": len(self._state),
+            "records_passed": self.records_passed,
+            "records_suppressed": self.records_suppressed,
+            "fields_suppressed": self.fields_suppressed,
+            "retained_suppressed": self.retained_suppressed,
+        }
+
+    def suppress_retained(self, topic, retain):
+        """
+        Checks whether a message is a retained message replayed for a topic that was already handled.
+
+        Brokers resend the retained message of every topic on each (re)subscription. The first one after startup
+        is the only state we have for the topic, later ones repeat something already written.
+
+        Args:
+            topic: The message topic.
+            retain: The message's retain flag.
+
+        Returns:
+            True if the message should be dropped.
+        """
+        if retain and topic in self._seen_topics:
+            self.retained_suppressed += 1
+            return True
+        if len(self._seen_topics) >= self._max_series:
+            self._seen_topics.clear()
+        self._seen_topics.add(topic)
+        return False
+
+    def allow(self, record, now=None):
+        """
+        Checks whether a record should be written and remembers it if so.
+
+        Args:
+            record: The ``Record`` to check.
+            now: The current monotonic time, defaults to ``time.monotonic()``.
+
+        Returns:
+            True if the record should be written.
+        """
+        template = getattr(record, "template", None)
+        if template is None:
+            return True
+        if now is None:
+            now = time.monotonic()
+
+        key = (template, record.tags)
+        state = self._state.get(key)
+        fields = record.fields
+        if state is not None and now - state[1] < self._max_silence and not self._changed(template, state[0], fields):
+            self.records_suppressed += 1
+            self.fields_suppressed += sum(1 for value in fields if value is not None)
+            return False
+
+        if state is None and len(self._state) >= self._max_series:
+            self._state.clear()
+        self._state[key] = (fields, now)
+        self.records_passed += 1
+        return True
+
+    def _changed(self, template, last, fields):
+        bands = self._bands.get(template)
+        if bands is None:
+            bands = [self._deadbands.get(f"{template.measurement}.{field}", self._deadbands.get(field, (0.0, 0.0)))
+                     for field in template.field_keys]
+            self._bands[template] = bands
+
+        for value, previous, (absolute, relative) in zip(fields, last, bands):
+            if value == previous and value.__class__ is previous.__class__:
+                continue
+            if value.__class__ not in (int, float) or previous.__class__ not in (int, float):
+                return True
+            if abs(value - previous) > max(absolute, relative * abs(previous)):
+                return True
+        return False
@@ -0,0 +1,211 @@
+import json
+import logging
+import math
+import os
+import time
+
+from decoders import decoder
+from structured_logging import fields
+
+##
+# Device metadata tags (friendly name, room, model, ...) for the points of every device.
+#
+# Metadata is learned lazily from the devices themselves: Gen1 devices answer an "announce" command on
+# shellies/announce, Gen2 devices answer a Shelly.GetDeviceInfo RPC request on <DEVICE_RPC_SOURCE>/rpc. A request
+# goes out the first time a device is seen, when it comes back online and once its metadata is older than
+# DEVICE_INFO_TTL. The metadata is kept in DEVICE_CACHE_FILE, which can also be edited by hand, e.g. to add the
+# room of a device or name BLE sensors by address; values set there are only replaced by what a device reports.
+##
+
+DEVICE_TAGS = tuple(key.strip() for key in os.getenv('DEVICE_TAGS', 'name,room,model').split(',') if key.strip())
+DEVICE_CACHE_FILE = os.getenv('DEVICE_CACHE_FILE', 'devices.json')  # Set to an empty value to keep it in memory
+DEVICE_INFO_TTL = float(os.getenv('DEVICE_INFO_TTL', 24 * 3600))
+DEVICE_RPC_SOURCE = os.getenv('DEVICE_RPC_SOURCE', 'shellyqtt')
+
+log = logging.getLogger("device_tags")
+
+
+class DeviceTagCache:
+    """
+    Maps device ids and BLE addresses to metadata tag values.
+
+    The tag values of a device are precomputed as a tuple in ``tag_keys`` order, to be appended to a record's own
+    tags. Code caching tags per topic registers a listener to be told when a device's values change.
+    """
+
+    def __init__(self, tag_keys=DEVICE_TAGS, path=DEVICE_CACHE_FILE, ttl=DEVICE_INFO_TTL, source=DEVICE_RPC_SOURCE,
+                 request_interval=300.0, save_interval=60.0):
+        """
+        Args:
+            tag_keys: Metadata keys written as tags.
+            path: JSON file the metadata is kept in, None to keep it in memory only.
+            ttl: Seconds after which a device's metadata is requested again.
+            source: The ``src`` of RPC requests, responses arrive on ``<source>/rpc``.
+            request_interval: Minimum seconds between two requests to the same device.
+            save_interval: Minimum seconds between two writes of the file.
+        """
+        self.tag_keys = tuple(tag_keys)
+        self.source = source
+        self.response_topic = f"{source}/rpc"
+        # Function publishing (topic, payload), set once an MQTT connection is up
+        self.publish = None
+        self._path = path
+        self._ttl = ttl
+        self._request_interval = request_interval
+        self._save_interval = save_interval
+        self._devices = self._load()
+        self._tags = {}
+        self._seen = {}
+        self._requested = {}
+        self._listeners = []
+        self._dirty = False
+        self._next_maintenance = 0.0
+
+        self.requests_sent = 0
+        self.updates = 0
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable device cache", extra=fields(path=self._path, error=e))
+            return {}
+
+    def save(self):
+        """
+        Writes the metadata to the cache file if it changed.
+        """
+        if not self._path or not self._dirty:
+            return
+        temporary = f"{self._path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self._devices, f, indent=2, sort_keys=True)
+        os.replace(temporary, self._path)
+        self._dirty = False
+
+    def add_listener(self, listener):
+        """
+        Registers a function called with the device id whenever a device's tag values change.
+        """
+        self._listeners.append(listener)
+
+    def tags(self, device_id, generation=None):
+        """
+        Returns the metadata tag values of a device, None for unknown ones.
+
+        Args:
+            device_id: The device id (topic prefix) or BLE address.
+            generation: 1 or 2 for Shelly devices whose metadata can be requested, None for others.
+        """
+        try:
+            return self._tags[device_id]
+        except KeyError:
+            pass
+        if generation is not None and device_id not in self._seen:
+            self._seen[device_id] = generation
+            if self._stale(device_id):
+                self.request(device_id)
+        entry = self._devices.get(device_id) or {}
+        tags = tuple(entry.get(key) for key in self.tag_keys)
+        self._tags[device_id] = tags
+        return tags
+
+    def _stale(self, device_id):
+        entry = self._devices.get(device_id)
+        return entry is None or time.time() - entry.get("updated", 0) >= self._ttl
+
+    def request(self, device_id):
+        """
+        Asks a device for its metadata, unless it was asked recently or there's no connection.
+        """
+        generation = self._seen.get(device_id)
+        now = time.monotonic()
+        if self.publish is None or generation is None \
+                or now - self._requested.get(device_id, -math.inf) < self._request_interval:
+            return
+        self._requested[device_id] = now
+        self.requests_sent += 1
+        if generation == 1:
+            self.publish(f"shellies/{device_id}/command", "announce")
+        else:
+            # The response carries the request id, so the topic prefix is used as id to map it back
+            self.publish(f"{device_id}/rpc", json.dumps(
+                {"id": device_id, "src": self.source, "method": "Shelly.GetDeviceInfo"}))
+
+    def update(self, device_id, **info):
+        """
+        Stores metadata reported for a device.
+        """
+        info = {key: value for key, value in info.items() if value is not None}
+        entry = self._devices.setdefault(device_id, {})
+        changed = any(entry.get(key) != value for key, value in info.items())
+        entry.update(info)
+        entry["updated"] = int(time.time())
+        self._dirty = True
+        self.updates += 1
+        if changed and self._tags.pop(device_id, None) is not None:
+            log.info("Device metadata changed", extra=fields(device=device_id, **info))
+            for listener in self._listeners:
+                listener(device_id)
+
+    def maintain(self, now=None):
+        """
+        Requests metadata that went past its TTL and saves the file, at most every ``save_interval`` seconds.
+        """
+        if now is None:
+            now = time.monotonic()
+        if now < self._next_maintenance:
+            return
+        self._next_maintenance = now + self._save_interval
+        for device_id in self._seen:
+            if self._stale(device_id):
+                self.request(device_id)
+        try:
+            self.save()
+        except OSError as e:
+            log.warning("Failed to save device cache", extra=fields(path=self._path, error=e))
+
+    def stats(self):
+        """
+        Returns a snapshot of the cache counters.
+        """
+        return {"devices": len(self._devices), "seen": len(self._seen), "requests_sent": self.requests_sent,
+                "updates": self.updates}
+
+    # --- Message handlers for the metadata topics, they write no records ---
+
+    def handle_online(self, topic_parts, payload):
+        # <prefix>/online (Gen2) or shellies/<id>/online (Gen1), "true" when the device (re)connects
+        device_id = topic_parts[1] if topic_parts[0] == "shellies" else topic_parts[0]
+        if payload == b"true":
+            # A device coming back online may have been renamed or updated meanwhile
+            self._seen.setdefault(device_id, 1 if topic_parts[0] == "shellies" else 2)
+            self.request(device_id)
+        return []
+
+    def handle_announce(self, topic_parts, payload):
+        # Gen1: {"id": "shellyht-6A2B9C", "model": "SHHT-1", "mac": ..., "ip": ..., "fw_ver": ...}
+        data = decoder.loads(payload)
+        device_id = data.get("id")
+        if device_id:
+            self._seen.setdefault(device_id, 1)
+            self.update(device_id, model=data.get("model"), firmware=data.get("fw_ver"), generation=1)
+        return []
+
+    def handle_rpc_response(self, topic_parts, payload):
+        # Response to Shelly.GetDeviceInfo: {"id": <prefix>, "src": ..., "result": {"name": ..., "model": ...}}
+        data = decoder.loads(payload)
+        result = data.get("result")
+        device_id = data.get("id")
+        if not isinstance(result, dict) or not isinstance(device_id, str):
+            return []
+        self.update(device_id, name=result.get("name"), model=result.get("model"), app=result.get("app"),
+                    firmware=result.get("ver"), generation=result.get("gen", 2))
+        return []
+
+
+# The cache used when building records
+device_tags = DeviceTagCache()
@@ -0,0 +1,179 @@
+from line_protocol import Template
+
+##
+# Flattens Fronius Solar API responses into one multi-field record per measurement.
+#
+# The rules are the ones write_data_to_influxdb always used:
+#   - numbers become fields of the current measurement
+#   - {"Value": ..., "Unit": ...} dicts become a field holding the value
+#   - other dicts are flattened into the measurement "<measurement>_<key>"
+#   - dicts inside lists are flattened into the current measurement, numbers inside lists become the field
+#     "<measurement>"
+#
+# Values of list items would share their measurement and field keys, so each item gets its own record tagged with
+# its position in the list, "index=<n>" (or "<n>.<m>" for lists within list items). The recursive walk used to
+# keep them apart by writing each item's points with its own timestamp.
+#
+# Walking the response and type-checking every value on every poll is wasted work, since the shape of an
+# endpoint's response practically never changes. So the walk is done once to compile a plan: a tree mirroring the
+# response that only holds, for each leaf, the record and field its value goes to. Polls then just follow the
+# plan. Every dict and list the plan visits is checked against the length it had when the plan was compiled, and a
+# missing key or unexpected type also aborts extraction, so a changed shape triggers a recompile.
+##
+
+_SCALAR = 0
+_VALUE = 1
+_DICT = 2
+_LIST = 3
+
+
+class ShapeChanged(Exception):
+    pass
+
+
+class FlattenPlan:
+    """
+    A compiled extraction plan for one response shape.
+    """
+
+    def __init__(self, measurement_name, data, tag_keys):
+        """
+        Args:
+            measurement_name: The measurement name of the top level of the response.
+            data: A response to compile the plan from.
+            tag_keys: The tag keys of the produced records.
+        """
+        # (measurement, list index or None) -> {field key: position}
+        self._fields = {}
+        self._tree = self._compile(measurement_name, data, None)
+        tag_keys = tuple(tag_keys)
+        self.templates = [Template(measurement, tag_keys if index is None else tag_keys + ("index",), fields)
+                          for (measurement, index), fields in self._fields.items()]
+        # The extra tag value of each template, None for values outside of lists
+        self.indexes = [index for _, index in self._fields]
+
+    def _slot(self, measurement, index, field):
+        fields = self._fields.setdefault((measurement, index), {})
+        position = fields.setdefault(field, len(fields))
+        return list(self._fields).index((measurement, index)), position
+
+    def _compile(self, measurement_name, data, index):
+        if isinstance(data, dict):
+            steps = []
+            for key, value in data.items():
+                if isinstance(value, dict):
+                    if 'Value' in value and 'Unit' in value:
+                        steps.append((key, _VALUE, self._slot(measurement_name, index, key)))
+                    else:
+                        steps.append((key, _DICT, self._compile(measurement_name + "_" + key, value, index)))
+                elif isinstance(value, list):
+                    steps.append((key, _LIST, self._compile_list(measurement_name, value, index)))
+                else:
+                    steps.append((key, _SCALAR, self._slot(measurement_name, index, key)))
+            return len(data), steps
+        return None
+
+    def _compile_list(self, measurement_name, items, parent_index):
+        steps = []
+        for position, item in enumerate(items):
+            index = str(position) if parent_index is None else f"{parent_index}.{position}"
+            if isinstance(item, dict):
+                steps.append((position, _DICT, self._compile(measurement_name, item, index)))
+            elif isinstance(item, list):
+                steps.append((position, _LIST, None))
+            else:
+                steps.append((position, _SCALAR, self._slot(measurement_name, index, measurement_name)))
+        return len(items), steps
+
+    def extract(self, data):
+        """
+        Extracts the field values of a response with the compiled shape.
+
+        Returns:
+            One list of field values per template, aligned with the template's field keys.
+
+        Raises:
+            ShapeChanged: If the response doesn't have the compiled shape.
+        """
+        values = [[None] * len(template.field_keys) for template in self.templates]
+        self._extract(self._tree, data, values)
+        return values
+
+    def _extract(self, node, data, values):
+        if node is None:
+            return
+        length, steps = node
+        if len(data) != length:
+            raise ShapeChanged()
+        try:
+            for key, kind, target in steps:
+                value = data[key]
+                if kind == _SCALAR:
+                    if value.__class__ is dict or value.__class__ is list:
+                        raise ShapeChanged()
+                    if isinstance(value, (int, float)):
+                        values[target[0]][target[1]] = float(value)
+                elif kind == _VALUE:
+                    value = value['Value']
+                    if isinstance(value, (int, float)):
+                        values[target[0]][target[1]] = float(value)
+                elif kind == _DICT:
+                    if value.__class__ is not dict:
+                        raise ShapeChanged()
+                    self._extract(target, value, values)
+                else:
+                    if value.__class__ is not list:
+                        raise ShapeChanged()
+                    self._extract(target, value, values)
+        except (KeyError, IndexError, TypeError):
+            raise ShapeChanged()
+
+
+class Flattener:
+    """
+    Caches one ``FlattenPlan`` per endpoint and recompiles it when the response shape changes.
+    """
+
+    def __init__(self, tag_keys=("inverter_ip",)):
+        """
+        Args:
+            tag_keys: The tag keys of the produced records.
+        """
+        self._tag_keys = tuple(tag_keys)
+        self._plans = {}
+        self.compiles = 0
+        self.hits = 0
+
+    def flatten(self, key, measurement_name, data, tags, timestamp=None):
+        """
+        Flattens a response into records.
+
+        Args:
+            key: Identifies the endpoint the response came from, plans are cached under it.
+            measurement_name: The measurement name of the top level of the response.
+            data: The ``Body.Data`` part of the response.
+            tags: Tag values in ``tag_keys`` order.
+            timestamp: Optional timestamp in nanoseconds for all records.
+
+        Returns:
+            A list of records, one per measurement and list item that has at least one value. Records of list items
+            carry their position as an additional "index" tag.
+        """
+        plan = self._plans.get(key)
+        values = None
+        if plan is not None:
+            try:
+                values = plan.extract(data)
+                self.hits += 1
+            except ShapeChanged:
+                pass
+        if values is None:
+            plan = FlattenPlan(measurement_name, data, self._tag_keys)
+            self._plans[key] = plan
+            self.compiles += 1
+            values = plan.extract(data)
+
+        tags = tuple(tags)
+        return [template.record(tags if index is None else tags + (index,), fields, timestamp)
+                for template, index, fields in zip(plan.templates, plan.indexes, values)
+                if any(value is not None for value in fields)]
@@ -1,122 +1,246 @@
 import requests
+import functools
+import heapq
 import json
+import logging
 import os
+import signal
 import time
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+try:
+    from influxdb_client import InfluxDBClient
+    from influxdb_client.client.write_api import SYNCHRONOUS
+except ImportError:
+    # Only needed by the influx sink
+    InfluxDBClient = None
+
+import metrics
+from fronius_flatten import Flattener
+from influx_writer import BatchWriter
+from sinks import SINKS, create_sinks
+from spool import Spool
+from structured_logging import configure_logging, fields
+
 # Load environment variables from .env file
 load_dotenv()
 
 # InfluxDB Configuration
 INFLUXDB_HOST = os.getenv("INFLUXDB_HOST")
-INFLUXDB_PORT = int(os.getenv("INFLUXDB_PORT"))
+INFLUXDB_PORT = int(os.getenv("INFLUXDB_PORT", 8086))
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORGANIZATION = os.getenv("INFLUXDB_ORGANIZATION")
 INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET")
 
+# Spool Configuration, set SPOOL_DIR to an empty value to disable
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", 1024 * 1024 * 1024))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024))
+
 # Fronius Inverter Configuration
 FRONIUS_INVERTER_IP = os.getenv("FRONIUS_INVERTER_IP")
+# Comma separated list to poll several inverters, defaults to FRONIUS_INVERTER_IP
+FRONIUS_INVERTER_IPS = [ip.strip() for ip in os.getenv("FRONIUS_INVERTER_IPS", FRONIUS_INVERTER_IP or "").split(",")
+                        if ip.strip()]
+FRONIUS_TIMEOUT = float(os.getenv("FRONIUS_TIMEOUT", 10))
+
+# Observability, set FRONIUS_METRICS_PORT to 0 to disable /metrics. Below the bridge's METRICS_PORT, since MQTT
+# workers take the ports above it
+FRONIUS_METRICS_PORT = int(os.getenv("FRONIUS_METRICS_PORT", 9104))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+log = logging.getLogger("fronius")
+
+# measurement name: (endpoint, poll interval in seconds), be mindful of API rate limits
+ENDPOINTS = {
+    "inverter_common": ("InverterRealtimeData.cgi?Scope=Device&DeviceId=1&DataCollection=CommonInverterData", 60),
+    #replace DeviceID=1 with your ID if needed
+    "inverter_3P": ("InverterRealtimeData.cgi?Scope=Device&DeviceId=1&DataCollection=3PInverterData", 60),
+    "inverter_minmax": ("InverterRealtimeData.cgi?Scope=Device&DeviceId=1&DataCollection=MinMaxInverterData", 300),
+    #"storage": ("StorageRealtimeData.cgi?Scope=Device&DeviceId=0", 60), #replace DeviceID=0 with your ID if needed
+    #"meter": ("MeterRealtimeData.cgi?Scope=Device&DeviceId=0", 60), #replace DeviceID=0 with your ID if needed
+    #"powerflow": ("PowerFlowRealtimeData.fcgi", 5),
+    #"system_common": ("InverterRealtimeData.cgi?Scope=System&DataCollection=CommonInverterData", 60),
+    #"system_cumulation": ("InverterRealtimeData.cgi?Scope=System&DataCollection=CumulationInverterData", 60),
+    #"system_minmax": ("InverterRealtimeData.cgi?Scope=System&DataCollection=MinMaxInverterData", 300),
+}
+
 
 # --- InfluxDB Client Setup ---
-client = InfluxDBClient(url=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}", token=INFLUXDB_TOKEN, org=INFLUXDB_ORGANIZATION)
-write_api = client.write_api(write_options=SYNCHRONOUS)
+def create_influx_sink():
+    """
+    Creates the InfluxDB sink, only called when SINKS selects it.
+    """
+    if InfluxDBClient is None:
+        raise ImportError("The influx sink needs influxdb_client: pip install influxdb-client")
+    client = InfluxDBClient(url=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}", token=INFLUXDB_TOKEN,
+                            org=INFLUXDB_ORGANIZATION)
+    # Spools to disk while InfluxDB is unavailable
+    return BatchWriter(client.write_api(write_options=SYNCHRONOUS), bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORGANIZATION,
+                       spool=Spool(os.path.join(SPOOL_DIR, "fronius"), segment_bytes=SPOOL_SEGMENT_BYTES,
+                                   max_bytes=SPOOL_MAX_BYTES) if SPOOL_DIR else None)
+
+
+# Points are written in the background to the sinks selected by SINKS, created by main() (or by the service) so
+# importing this module opens no InfluxDB client or spool
+writer = None
+# Compiled extraction plans per inverter and endpoint
+flattener = Flattener(tag_keys=("inverter_ip",))
+
+
+def create_session(pool_size):
+    """
+    Creates a keep-alive HTTP session for one inverter.
+
+    Args:
+        pool_size: Number of connections kept open, one per endpoint polled concurrently.
+
+    Returns:
+        A ``requests.Session``.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    return session
 
 
-def get_fronius_data(endpoint):
+def get_fronius_data(endpoint, inverter_ip=None, session=None):
     """
     Fetches data from the Fronius Solar API.
 
     Args:
         endpoint: The specific API endpoint to query (e.g., "PowerFlowRealtimeData.fcgi").
+        inverter_ip: The inverter to query, defaults to FRONIUS_INVERTER_IP.
+        session: Optional ``requests.Session`` to reuse connections.
 
     Returns:
         The JSON response from the API, or None if there's an error.
     """
-    url = f"http://{FRONIUS_INVERTER_IP}/solar_api/v1/Get{endpoint}"
+    url = f"http://{inverter_ip or FRONIUS_INVERTER_IP}/solar_api/v1/Get{endpoint}"
     try:
-        response = requests.get(url, timeout=10)
+        response = (session or requests).get(url, timeout=FRONIUS_TIMEOUT)
         response.raise_for_status()  # Raise an exception for bad status codes
         return response.json()
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching data from Fronius API: {e}")
+        log.warning("Error fetching data from Fronius API", extra=fields(url=url, error=e))
         return None
 
 
-def write_data_to_influxdb(measurement_name, data):
+def write_data_to_influxdb(measurement_name, data, inverter_ip=None):
     """
-    Writes data to InfluxDB.
+    Writes data to InfluxDB, or whichever sinks are configured.
+
+    Nested dicts end up in their own "<measurement>_<key>" measurement, and all values of one measurement are
+    written as a single multi-field point. See fronius_flatten for the rules.
 
     Args:
         measurement_name: The name of the measurement in InfluxDB.
         data: A dictionary of data to write.
+        inverter_ip: The inverter the data came from, defaults to FRONIUS_INVERTER_IP.
     """
-    points = []
-    timestamp = time.time_ns()
-
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, (int, float)):
-                point = Point(measurement_name).field(key, float(value)).time(timestamp, WritePrecision.NS).tag("inverter_ip",
-                                                                                                         FRONIUS_INVERTER_IP)
-                points.append(point)
-            elif isinstance(value, dict):
-                # Check for 'Value' and 'Unit' and handle accordingly
-                if 'Value' in value and 'Unit' in value:
-                    if value['Value'] is not None:
-                        point = Point(measurement_name).field(key, float(value['Value'])).time(timestamp,
-                                                                                               WritePrecision.NS).tag(
-                            "inverter_ip", FRONIUS_INVERTER_IP)
-                        points.append(point)
-
-
-                else:
-                    # Handle other nested dictionaries recursively
-                    write_data_to_influxdb(measurement_name + "_" + key, value)
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        write_data_to_influxdb(measurement_name, item)
-                    elif isinstance(item, (int, float)):
-                        point = Point(measurement_name).field(measurement_name, float(item)).time(timestamp,
-                                                                                                  WritePrecision.NS).tag(
-                            "inverter_ip", FRONIUS_INVERTER_IP)
-                        points.append(point)
+    inverter_ip = inverter_ip or FRONIUS_INVERTER_IP
+    records = flattener.flatten((inverter_ip, measurement_name), measurement_name, data, (inverter_ip,),
+                                time.time_ns())
 
-    try:
-        write_api.write(bucket=INFLUXDB_BUCKET, record=points)
-        print(f"Successfully wrote data to InfluxDB: {measurement_name}")
-    except Exception as e:
-        print(f"Error writing to InfluxDB: {e}")
+    for record in records:
+        writer.write(record)
+    log.debug("Queued data for InfluxDB", extra=fields(measurement=measurement_name, points=len(records)))
+
+
+def poll_endpoint(session, inverter_ip, measurement_name, endpoint):
+    """
+    Fetches one endpoint of one inverter and writes its data.
+    """
+    start = time.perf_counter()
+    fronius_data = get_fronius_data(endpoint, inverter_ip, session)
+    metrics.FRONIUS_POLL_SECONDS.observe(time.perf_counter() - start, inverter_ip, measurement_name)
+    if fronius_data:
+        if 'Body' in fronius_data and 'Data' in fronius_data['Body']:
+            write_data_to_influxdb(measurement_name, fronius_data['Body']['Data'], inverter_ip)
+
+
+def poll_forever(inverter_ips, endpoints):
+    """
+    Polls every endpoint of every inverter concurrently, each at its own interval.
+
+    Polls are scheduled on a fixed grid (start + n * interval) so slow responses don't make the cycle drift. A
+    poll that is still running when its next slot comes up is skipped rather than queued behind it.
+
+    Args:
+        inverter_ips: The inverters to poll.
+        endpoints: Maps measurement names to (endpoint, interval in seconds) tuples.
+
+    Raises:
+        ValueError: If there are no inverters or endpoints to poll.
+    """
+    if not inverter_ips:
+        raise ValueError("No inverters to poll, set FRONIUS_INVERTER_IP or FRONIUS_INVERTER_IPS")
+    if not endpoints:
+        raise ValueError("No endpoints to poll, enable at least one in ENDPOINTS")
+
+    def poll_done(future, ip, measurement_name):
+        # Nothing else looks at the result, an exception would go unnoticed until its poll is replaced
+        if future.cancelled() or future.exception() is None:
+            return
+        log.error("Poll failed", extra=fields(inverter=ip, measurement=measurement_name), exc_info=future.exception())
+
+    sessions = {ip: create_session(len(endpoints)) for ip in inverter_ips}
+    running = {}
+    schedule = []
+    start = time.monotonic()
+    for ip in inverter_ips:
+        for measurement_name, (endpoint, interval) in endpoints.items():
+            heapq.heappush(schedule, (start, ip, measurement_name))
+
+    with ThreadPoolExecutor(max_workers=len(inverter_ips) * len(endpoints),
+                            thread_name_prefix="fronius") as executor:
+        while True:
+            due, ip, measurement_name = heapq.heappop(schedule)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            endpoint, interval = endpoints[measurement_name]
+            key = (ip, measurement_name)
+            if key in running and not running[key].done():
+                log.warning("Skipping poll, previous poll still running",
+                            extra=fields(inverter=ip, measurement=measurement_name))
+            else:
+                future = executor.submit(poll_endpoint, sessions[ip], ip, measurement_name, endpoint)
+                future.add_done_callback(functools.partial(poll_done, ip=ip, measurement_name=measurement_name))
+                running[key] = future
+
+            # Next slot on the grid, skipping slots that were missed entirely
+            due += interval
+            now = time.monotonic()
+            if due < now:
+                due += ((now - due) // interval + 1) * interval
+            heapq.heappush(schedule, (due, ip, measurement_name))
 
 
 def main():
     """
     Main function to fetch and store Fronius data.
     """
-    endpoints = {
-        "inverter_common": "InverterRealtimeData.cgi?Scope=Device&DeviceId=1&DataCollection=CommonInverterData",
-        #replace DeviceID=1 with your ID if needed
-        "inverter_3P": "InverterRealtimeData.cgi?Scope=Device&DeviceId=1&DataCollection=3PInverterData",
-        "inverter_minmax": "InverterRealtimeData.cgi?Scope=Device&DeviceId=1&DataCollection=MinMaxInverterData",
-        #"storage": "StorageRealtimeData.cgi?Scope=Device&DeviceId=0", #replace DeviceID=0 with your ID if needed
-        #"meter": "MeterRealtimeData.cgi?Scope=Device&DeviceId=0", #replace DeviceID=0 with your ID if needed
-        #"powerflow": "PowerFlowRealtimeData.fcgi",
-        #"system_common": "InverterRealtimeData.cgi?Scope=System&DataCollection=CommonInverterData",
-        #"system_cumulation": "InverterRealtimeData.cgi?Scope=System&DataCollection=CumulationInverterData",
-        #"system_minmax": "InverterRealtimeData.cgi?Scope=System&DataCollection=MinMaxInverterData",
-    }
-
-    while True:
-        for measurement_name, endpoint in endpoints.items():
-            fronius_data = get_fronius_data(endpoint)
-            if fronius_data:
-                if 'Body' in fronius_data and 'Data' in fronius_data['Body']:
-                    write_data_to_influxdb(measurement_name, fronius_data['Body']['Data'])
-
-        # Adjust the sleep time as needed, but be mindful of API rate limits
-        time.sleep(60)
+    global writer
+    configure_logging(LOG_LEVEL)
+    if not FRONIUS_INVERTER_IPS:
+        raise SystemExit("Set FRONIUS_INVERTER_IP or FRONIUS_INVERTER_IPS to the inverters to poll")
+    # Treat SIGTERM like Ctrl+C so queued points are written or spooled on shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    writer = create_sinks(SINKS, "fronius", create_influx_sink)
+    writer.start()
+    if FRONIUS_METRICS_PORT:
+        metrics.start_http_server(FRONIUS_METRICS_PORT)
+    try:
+        poll_forever(FRONIUS_INVERTER_IPS, ENDPOINTS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Write or spool everything still queued before exiting
+        writer.close()
 
 
 if __name__ == "__main__":
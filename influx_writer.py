@@ -0,0 +1,183 @@
+import logging
+import queue
+import time
+
+import metrics
+from sinks import QueuedSink, encode_lines
+from structured_logging import fields
+
+log = logging.getLogger("influx_writer")
+
+# HTTP status codes InfluxDB answers for data that will never be accepted
+_REJECTED_STATUS = (400, 422)
+# Answered for requests over a size limit, often a proxy's (nginx defaults to 1 MiB), the data itself is fine
+_TOO_LARGE_STATUS = 413
+
+
+class BatchWriter(QueuedSink):
+    """
+    Long-lived InfluxDB v2 sink that batches points off the caller's thread.
+
+    Points are encoded as line protocol into one buffer per batch and written
+    with one request, see ``QueuedSink`` for the batching and the bounded
+    queue.
+
+    With a ``Spool`` attached, batches that can't be written are appended to
+    disk instead of being lost, as are all new batches while older ones are
+    still waiting, so points reach InfluxDB in order.  The spool is replayed
+    in large writes with exponential backoff once InfluxDB accepts writes
+    again.  When the queue fills up faster than InfluxDB takes batches, it is
+    spilled to the spool as well rather than dropping points.
+
+    Requests answered with 413 (too large) are split in halves and retried,
+    and replays stay at the smaller size from then on.  Only a single line
+    that is too large on its own is dropped.
+    """
+    name = "influx"
+
+    def __init__(self, write_api, bucket, org, batch_size=500, flush_interval=1.0, max_queue=10000,
+                 report_interval=60.0, spool=None, replay_bytes=4 * 1024 * 1024, retry_interval=1.0,
+                 max_retry_interval=60.0):
+        """
+        Args:
+            write_api: A synchronous ``influxdb_client`` write API.
+            bucket: The InfluxDB bucket to write to.
+            org: The InfluxDB organization.
+            batch_size: Maximum number of points per write request.
+            flush_interval: Maximum time in seconds a point waits before it is flushed.
+            max_queue: Maximum number of points buffered in memory.
+            report_interval: Seconds between queue depth / flush latency reports, 0 to disable.
+            spool: Optional ``Spool`` for batches that can't be written right away.
+            replay_bytes: Maximum size of one write when replaying the spool.
+            retry_interval: Initial delay in seconds before retrying a failed replay.
+            max_retry_interval: Maximum delay in seconds between replay retries.
+        """
+        super().__init__(batch_size=batch_size, flush_interval=flush_interval, max_queue=max_queue,
+                         report_interval=report_interval)
+        self._write_api = write_api
+        self._bucket = bucket
+        self._org = org
+        self._spill_threshold = max(1, max_queue * 8 // 10)
+        self._spool = spool
+        self._replay_bytes = replay_bytes
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        self._retry_delay = retry_interval
+        self._next_replay = 0.0
+        self._buffer = bytearray()
+
+        self.points_rejected = 0
+        self.points_spooled = 0
+
+    def stats(self):
+        """
+        Returns a snapshot of the writer counters, including the spool's if one is attached.
+        """
+        stats = super().stats()
+        stats["points_rejected"] = self.points_rejected
+        stats["points_spooled"] = self.points_spooled
+        if self._spool is not None:
+            stats.update({f"spool_{key}": value for key, value in self._spool.stats().items()})
+        return stats
+
+    def close(self, timeout=10.0):
+        super().close(timeout)
+        if self._spool is not None:
+            self._spool.close()
+
+    def _backlog_due(self):
+        return self._spool is not None and bool(self._spool) and time.monotonic() >= self._next_replay
+
+    def _after_flush(self, backlog_due):
+        if self._spool is not None:
+            if self.queue_depth() >= self._spill_threshold:
+                self._spill()
+            if backlog_due:
+                self._replay()
+
+    def _spill(self):
+        # InfluxDB can't keep up, move everything queued to disk
+        while True:
+            batch = []
+            try:
+                while len(batch) < self._batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self._flush(batch, spill=True)
+            if len(batch) < self._batch_size:
+                break
+
+    def _replay(self):
+        peeked = self._spool.peek(self._replay_bytes)
+        if peeked is None:
+            return
+        data, _, position = peeked
+        if self._post(data, data.count(b'\n')):
+            self._spool.commit(position)
+            self._retry_delay = self._retry_interval
+        else:
+            self._next_replay = time.monotonic() + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, self._max_retry_interval)
+
+    def _write(self, batch, spill=False):
+        # Encode the whole batch into one reusable buffer
+        lines, invalid = encode_lines(batch, self._buffer)
+        self.points_invalid += invalid
+        if not lines:
+            return
+
+        data = bytes(self._buffer)
+        if self._spool is not None and (spill or self._spool):
+            # Spilling, or older batches are still waiting on disk and the order has to be kept
+            self._spool.append(data)
+            self.points_spooled += lines
+        elif not self._post(data, lines) and self._spool is not None:
+            self._spool.append(data)
+            self.points_spooled += lines
+            self._next_replay = time.monotonic() + self._retry_delay
+
+    def _post(self, data, lines):
+        """
+        Writes line protocol data to InfluxDB, in halves if the request is too large.
+
+        If one half fails after the other was written, the whole data is retried. Rewriting points is harmless,
+        see ``Spool``.
+
+        Returns:
+            True if the data is done with (written, or rejected as invalid), False if it should be retried.
+        """
+        start = time.perf_counter()
+        try:
+            self._write_api.write(bucket=self._bucket, org=self._org, record=data)
+            self.points_written += lines
+            return True
+        except Exception as e:
+            self.flush_errors += 1
+            metrics.WRITE_ERRORS.inc()
+            status = getattr(e, "status", None)
+            if status == _TOO_LARGE_STATUS and lines > 1:
+                log.warning("InfluxDB request too large, splitting batch",
+                            extra=fields(points=lines, bytes=len(data), error=e))
+            elif status in _REJECTED_STATUS or status == _TOO_LARGE_STATUS:
+                # Retrying malformed data, field type conflicts or a line over the size limit would fail forever
+                self.points_rejected += lines
+                log.error("InfluxDB rejected batch", extra=fields(points=lines, status=status, error=e))
+                return True
+            else:
+                log.warning("Error writing batch to InfluxDB", extra=fields(points=lines, error=e))
+                return False
+        finally:
+            # Flush counts and latencies are kept by QueuedSink._flush, these cover every request including replays
+            metrics.WRITE_BATCH_POINTS.observe(lines)
+            metrics.WRITE_SECONDS.observe(time.perf_counter() - start)
+
+        # Replays are kept below the size that was too large, batches are split every time
+        self._replay_bytes = max(1, min(self._replay_bytes, len(data) // 2))
+        head = lines // 2
+        middle = -1
+        for _ in range(head):
+            middle = data.index(b'\n', middle + 1)
+        middle += 1
+        return self._post(data[:middle], head) and self._post(data[middle:], lines - head)
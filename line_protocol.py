@@ -0,0 +1,180 @@
+import math
+from functools import lru_cache
+
+##
+# Precompiled InfluxDB line protocol encoding for fixed measurement schemas.
+#
+# The output is byte for byte what influxdb_client's Point.to_line_protocol() produces (tags and fields sorted by
+# key, whole floats without ".0", integers with an "i" suffix, None values skipped), so both can be mixed freely
+# in one write.
+##
+
+_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_STRING = str.maketrans({'"': r'\"', '\\': r'\\'})
+
+
+def escape_key(key):
+    return str(key).translate(_ESCAPE_KEY)
+
+
+@lru_cache(maxsize=16384)
+def escape_tag_value(value):
+    """
+    Escapes a tag value. Cached, since tag values (device ids, addresses) repeat on every message.
+    """
+    escaped = str(value).translate(_ESCAPE_KEY)
+    if escaped.endswith('\\'):
+        escaped += ' '
+    return escaped
+
+
+def format_field_value(value):
+    """
+    Formats a field value for line protocol.
+
+    Returns:
+        The encoded value, or None if the value can't be written (None, NaN or infinite floats).
+    """
+    cls = value.__class__
+    if cls is float:
+        if not math.isfinite(value):
+            return None
+        s = repr(value)
+        return s[:-2] if s.endswith('.0') else s
+    if cls is bool:
+        return 'true' if value else 'false'
+    if cls is int:
+        return f'{value}i'
+    if cls is str:
+        return f'"{value.translate(_ESCAPE_STRING)}"'
+    if value is None:
+        return None
+    if isinstance(value, float):
+        return format_field_value(float(value))
+    if isinstance(value, int):
+        return format_field_value(int(value))
+    raise ValueError(f'Type: "{type(value)}" of field value is not supported.')
+
+
+class Template:
+    """
+    A measurement with a fixed set of tag and field keys.
+
+    The escaped measurement and key names are encoded once, and the ``measurement,tags `` prefix is cached per
+    distinct set of tag values, so encoding a record only has to format its field values.
+    """
+
+    def __init__(self, measurement, tag_keys, field_keys, prefix_cache_size=16384):
+        """
+        Args:
+            measurement: The measurement name.
+            tag_keys: The tag keys, in the order tag values are passed.
+            field_keys: The field keys, in the order field values are passed.
+            prefix_cache_size: Maximum number of cached tag prefixes before the cache is reset.
+        """
+        self.measurement = measurement
+        self.tag_keys = tuple(tag_keys)
+        self.field_keys = tuple(field_keys)
+
+        self._measurement = measurement.translate(_ESCAPE_MEASUREMENT)
+        self._tag_order = sorted(range(len(self.tag_keys)), key=lambda i: self.tag_keys[i])
+        self._tag_names = [escape_key(key) for key in self.tag_keys]
+        field_order = sorted(range(len(self.field_keys)), key=lambda i: self.field_keys[i])
+        self._fields = [(i, f'{escape_key(self.field_keys[i])}='.encode()) for i in field_order]
+        self._prefixes = {}
+        self._prefix_cache_size = prefix_cache_size
+
+    def record(self, tags, fields, time=None):
+        """
+        Creates a record of this template.
+
+        Args:
+            tags: Tag values in ``tag_keys`` order.
+            fields: Field values in ``field_keys`` order.
+            time: Optional timestamp in nanoseconds.
+        """
+        return Record(self, tags, fields, time)
+
+    def prefix(self, tags):
+        """
+        Returns the encoded ``measurement,tag=value,... `` prefix for a tuple of tag values.
+        """
+        try:
+            return self._prefixes[tags]
+        except KeyError:
+            pass
+
+        parts = [self._measurement]
+        for i in self._tag_order:
+            value = tags[i]
+            if value is None:
+                continue
+            value = escape_tag_value(value)
+            if value and self._tag_names[i]:
+                parts.append(f'{self._tag_names[i]}={value}')
+        prefix = (','.join(parts) + ' ').encode()
+
+        if len(self._prefixes) >= self._prefix_cache_size:
+            self._prefixes.clear()
+        self._prefixes[tags] = prefix
+        return prefix
+
+    def encode_into(self, buffer, tags, fields, time=None):
+        """
+        Appends one line to a bytearray.
+
+        Args:
+            buffer: The bytearray to append to.
+            tags: Tag values in ``tag_keys`` order.
+            fields: Field values in ``field_keys`` order.
+            time: Optional timestamp in nanoseconds.
+
+        Returns:
+            True if a line was written, False if the record had no writable field.
+        """
+        start = len(buffer)
+        buffer += self.prefix(tags)
+        body = len(buffer)
+        for i, key in self._fields:
+            value = fields[i]
+            if value is None:
+                continue
+            value = format_field_value(value)
+            if value is None:
+                continue
+            if len(buffer) != body:
+                buffer += b','
+            buffer += key
+            buffer += value.encode()
+        if len(buffer) == body:
+            del buffer[start:]
+            return False
+        if time is not None:
+            buffer += b' %d' % time
+        return True
+
+
+class Record:
+    """
+    One line of a ``Template``: tag and field values aligned with the template keys.
+    """
+
+    __slots__ = ("template", "tags", "fields", "time")
+
+    def __init__(self, template, tags, fields, time=None):
+        self.template = template
+        self.tags = tuple(tags)
+        self.fields = tuple(fields)
+        self.time = time
+
+    def encode_into(self, buffer):
+        return self.template.encode_into(buffer, self.tags, self.fields, self.time)
+
+    def to_line_protocol(self):
+        buffer = bytearray()
+        self.encode_into(buffer)
+        return buffer.decode()
+
+    def __str__(self):
+        return self.to_line_protocol()
@@ -1,13 +1,28 @@
 import paho.mqtt.client as mqtt
+import logging
 import os
-
-import json
+import signal
+import time
+from collections import Counter
 
 from dotenv import load_dotenv
-import influxdb_client
 
-from influxdb_client.client.write.point import Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+try:
+    import influxdb_client
+    from influxdb_client.client.write_api import SYNCHRONOUS
+except ImportError:
+    # Only needed by the influx sink
+    influxdb_client = None
+
+from aggregator import Aggregator, parse_fields, parse_windows
+from dedup import DeadbandFilter, parse_deadbands
+from device_tags import device_tags
+from influx_writer import BatchWriter
+import metrics
+from shelly_handlers import ble_stage, build_router
+from sinks import SINKS, create_sinks
+from spool import Spool
+from structured_logging import Sampler, configure_logging, fields
 
 load_dotenv()
 ##
@@ -15,335 +30,317 @@ load_dotenv()
 ##
 # Read values from .env file
 INFLUXDB_HOST = os.getenv('INFLUXDB_HOST')
-INFLUXDB_PORT = int(os.getenv('INFLUXDB_PORT'))
+INFLUXDB_PORT = int(os.getenv('INFLUXDB_PORT', 8086))
 INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
 INFLUXDB_ORGANIZATION = os.getenv('INFLUXDB_ORGANIZATION')
 INFLUXDB_BUCKET = os.getenv('INFLUXDB_BUCKET')
 MQTT_USERNAME = os.getenv('MQTT_USERNAME')
 MQTT_PASSWORD = os.getenv('MQTT_PASSWORD')
 MQTT_SERVER = os.getenv('MQTT_SERVER')  # Use the MQTT_SERVER variable from .env
-
-# Initialize InfluxDB client
-influx_client = influxdb_client.InfluxDBClient(
-    url=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
-    token=INFLUXDB_TOKEN,
-    org=INFLUXDB_ORGANIZATION
-)
+MQTT_PORT = int(os.getenv('MQTT_PORT', 1883))
+INFLUXDB_BATCH_SIZE = int(os.getenv('INFLUXDB_BATCH_SIZE', 500))
+INFLUXDB_FLUSH_INTERVAL = float(os.getenv('INFLUXDB_FLUSH_INTERVAL', 1.0))
+INFLUXDB_MAX_QUEUE = int(os.getenv('INFLUXDB_MAX_QUEUE', 10000))
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')  # Set to an empty value to disable the on-disk spool
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', 1024 * 1024 * 1024))
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', 16 * 1024 * 1024))
+SUBSCRIPTION_REPORT_INTERVAL = float(os.getenv('SUBSCRIPTION_REPORT_INTERVAL', 300))
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+DEDUP_DEADBANDS = os.getenv('DEDUP_DEADBANDS', '')  # e.g. "apower=5,voltage=1,temperature_c=0.5,humidity=2%"
+DEDUP_MAX_SILENCE = float(os.getenv('DEDUP_MAX_SILENCE', 300))  # Write every series at least this often
+AGGREGATE_WINDOWS = os.getenv('AGGREGATE_WINDOWS', '1m,15m,1h')  # Set to an empty value to disable roll-ups
+AGGREGATE_GAUGES = os.getenv('AGGREGATE_GAUGES',
+                             'shelly_power.apower,shelly_power.Pges,shelly_power.P_L1,shelly_power.P_L2,'
+                             'shelly_power.P_L3')
+AGGREGATE_COUNTERS = os.getenv('AGGREGATE_COUNTERS',
+                               'shelly_power.total_energy,shelly_power.Verbrauch,shelly_power.Lieferung')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9105))  # Serves /metrics, 0 disables it
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 1000))
+MQTT_RECONNECT_MIN_DELAY = float(os.getenv('MQTT_RECONNECT_MIN_DELAY', 1))
+MQTT_RECONNECT_MAX_DELAY = float(os.getenv('MQTT_RECONNECT_MAX_DELAY', 60))
+MQTT_WORKERS = int(os.getenv('MQTT_WORKERS', 1))  # More than 1 spreads devices over worker processes, see workers
+
+# InfluxDB client, created when the first influx sink needs it
+influx_client = None
+
+
+def create_influx_client():
+    global influx_client
+    if influx_client is None:
+        if influxdb_client is None:
+            raise ImportError("The influx sink needs influxdb_client: pip install influxdb-client")
+        influx_client = influxdb_client.InfluxDBClient(
+            url=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
+            token=INFLUXDB_TOKEN,
+            org=INFLUXDB_ORGANIZATION
+        )
+    return influx_client
+
+
+def create_writer(spool_name='mqtt', write_api=None):
+    """
+    Creates the sinks of this process, see sinks.SINKS.
+
+    Args:
+        spool_name: Subdirectory of SPOOL_DIR for the on-disk spool and name of the archive files. Every writer
+                    needs its own.
+        write_api: The write API of the influx sink, defaults to a synchronous one of influx_client.
+    """
+    def create_influx_sink():
+        return BatchWriter(
+            write_api or create_influx_client().write_api(write_options=SYNCHRONOUS),
+            bucket=INFLUXDB_BUCKET,
+            org=INFLUXDB_ORGANIZATION,
+            batch_size=INFLUXDB_BATCH_SIZE,
+            flush_interval=INFLUXDB_FLUSH_INTERVAL,
+            max_queue=INFLUXDB_MAX_QUEUE,
+            # Points that can't be written while InfluxDB is down or too slow wait on disk
+            spool=Spool(os.path.join(SPOOL_DIR, spool_name), segment_bytes=SPOOL_SEGMENT_BYTES,
+                        max_bytes=SPOOL_MAX_BYTES) if SPOOL_DIR else None,
+        )
+    return create_sinks(SINKS, spool_name, create_influx_sink, batch_size=INFLUXDB_BATCH_SIZE,
+                        flush_interval=INFLUXDB_FLUSH_INTERVAL, max_queue=INFLUXDB_MAX_QUEUE)
+
+
+# One long-lived writer (sink) shared by every message handler, flushing batches off the MQTT thread. Created by
+# main() (or by the worker processes and the service) rather than on import, so importing the bridge opens no
+# InfluxDB client, spool or archive file
+writer = None
+
+# Maps topic patterns to the handlers of each device family
+router = build_router()
+
+# Rolls raw values up into min/max/mean/last (and counter deltas) per window, fed before deduplication so the
+# roll-ups see every sample
+windows = parse_windows(AGGREGATE_WINDOWS)
+aggregator = Aggregator(windows, parse_fields(AGGREGATE_GAUGES), parse_fields(AGGREGATE_COUNTERS)) if windows else None
+
+# Drops redundant status updates before they reach the writer
+dedup = DeadbandFilter(parse_deadbands(DEDUP_DEADBANDS), max_silence=DEDUP_MAX_SILENCE) if DEDUP_ENABLED else None
+
+
+def register_metrics():
+    """
+    Registers the scrape-time views of the pipeline components.
+
+    Called by the process that serves /metrics rather than on import: worker processes import this module a second
+    time next to the copy multiprocessing runs as __mp_main__, and both would register every family. The writer is
+    looked up on each scrape since main(), the workers and the service create it.
+    """
+    metrics.Gauge("shellyqtt_writer_queue_depth", "Points waiting in the writer queue",
+                  callback=lambda: writer.queue_depth())
+    metrics.Gauge("shellyqtt_spool_pending_bytes", "Bytes waiting in the on-disk spool",
+                  callback=lambda: writer.stats().get("spool_pending_bytes", 0))
+    metrics.CounterFunc("shellyqtt_points_written_total", "Points written by the sinks",
+                        callback=lambda: writer.points_written)
+    metrics.CounterFunc("shellyqtt_points_dropped_total", "Points dropped because the writer queue was full",
+                        callback=lambda: writer.points_dropped)
+    metrics.CounterFunc("shellyqtt_points_invalid_total", "Points skipped because they couldn't be encoded",
+                        callback=lambda: writer.stats().get("points_invalid", 0))
+    metrics.CounterFunc("shellyqtt_points_spooled_total", "Points written to the on-disk spool",
+                        callback=lambda: writer.stats().get("points_spooled", 0))
+    if dedup is not None:
+        metrics.CounterFunc("shellyqtt_dedup_suppressed_total", "Records dropped by the deadband filter",
+                            callback=lambda: dedup.records_suppressed)
+    metrics.CounterFunc("shellyqtt_ble_copies_total",
+                        "Copies of BLE advertisements merged into or dropped after the first",
+                        callback=lambda: ble_stage.copies_merged + ble_stage.duplicates_dropped)
+    metrics.CounterFunc("shellyqtt_ble_rate_limited_total", "BLE advertisements dropped by the per-address rate limit",
+                        callback=lambda: ble_stage.rate_limited)
+    if aggregator is not None:
+        metrics.CounterFunc("shellyqtt_rollups_written_total", "Aggregated window records written",
+                            callback=lambda: aggregator.records_emitted)
+
+
+log = logging.getLogger("bridge")
+# Per-message log lines are sampled, 1 in LOG_SAMPLE_EVERY
+point_sampler = Sampler(LOG_SAMPLE_EVERY)
+decode_failure_sampler = Sampler(LOG_SAMPLE_EVERY)
+connected_before = False
+
+# Messages received per subscription filter since the last report
+subscription_counts = Counter()
+next_subscription_report = time.monotonic() + SUBSCRIPTION_REPORT_INTERVAL
+next_aggregate_flush = time.monotonic()
 
 
 # The callback for when the client receives a CONNACK response from the server.
-def on_connect(client, userdata, flags, rc):
-    print("Connected with result code " + str(rc))
-    # Subscribing to all Shelly topics
-    client.subscribe("#")
+def on_connect(client, userdata, flags, rc, properties=None):
+    global connected_before
+    if connected_before:
+        metrics.RECONNECTS.inc()
+    connected_before = True
+    # Lets the device tag cache request metadata from the devices
+    device_tags.publish = client.publish
+    log.info("Connected", extra=fields(server=MQTT_SERVER, rc=rc))
+    # Subscribing only to the topics our handlers can consume
+    subscriptions = router.subscriptions()
+    client.subscribe([(subscription, 0) for subscription in subscriptions])
+    log.info("Subscribed", extra=fields(subscriptions=",".join(subscriptions)))
+
+
+def report_counts():
+    global next_subscription_report
+    now = time.monotonic()
+    if now < next_subscription_report:
+        return
+    elapsed = now - next_subscription_report + SUBSCRIPTION_REPORT_INTERVAL
+    next_subscription_report = now + SUBSCRIPTION_REPORT_INTERVAL
+    log.info("Messages per subscription", extra=fields(
+        seconds=round(elapsed), **{subscription: f"{count / elapsed:.1f}/s"
+                                   for subscription, count in subscription_counts.most_common()}))
+    subscription_counts.clear()
+    if aggregator is not None:
+        log.info("Aggregation", extra=fields(**aggregator.stats()))
+    if dedup is not None:
+        log.info("Deduplication", extra=fields(**dedup.stats()))
+    log.info("Device tags", extra=fields(**device_tags.stats()))
+    log.info("BLE", extra=fields(**ble_stage.stats()))
+
+
+def flush_aggregates():
+    # Close the windows of series that went quiet, checked every few seconds
+    global next_aggregate_flush
+    now = time.monotonic()
+    if now < next_aggregate_flush:
+        return
+    next_aggregate_flush = now + 10
+    for record in aggregator.flush_expired():
+        writer.write(record)
+
+
+def flush_ble(force=False):
+    # Writes the BLE advertisements whose merge window is over, or all of them on shutdown. Runs outside the
+    # handler's error handling, so BleStage validates values when they're added and flush skips bad entries.
+    write_points(ble_stage.flush(force=force), "ble")
+
+
+def write_points(points, topic):
+    for point in points:
+        if aggregator is not None:
+            for record in aggregator.add(point):
+                writer.write(record)
+        # Skip values that didn't change since the last write of the same series
+        if dedup is not None and not dedup.allow(point):
+            continue
+        # Hand to the sinks
+        writer.write(point)
+        if point_sampler() and log.isEnabledFor(logging.DEBUG):
+            log.debug("Queued point", extra=fields(topic=topic, line=point))
 
 
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
-    if msg.topic.startswith("shelly"):
-
-        topic_parts = msg.topic.split('/')
-        if len(topic_parts) >= 3:
-            device_type = topic_parts[0]
-            device_update = topic_parts[1]
-            topic = "/".join(topic_parts[2:])
-            # We are only interested in 'status' topics for each device
-            if 'status' in device_update:
-                # We are filtering messages based on device type
-                if 'switch:0' in topic:
-                    payload = msg.payload.decode("utf-8")
-
-                    try:
-                        data = json.loads(payload)
-
-                        # Extract relevant fields
-                        id = device_type
-
-                        output = data.get("output")
-                        apower = data.get("apower")
-                        voltage = data.get("voltage")
-                        current = data.get("current")
-                        total_energy = data["aenergy"].get("total")
-                        temperature_c = data["temperature"].get("tC")
-                        temperature_f = data["temperature"].get("tF")
-
-                        # Create an InfluxDB point
-                        point = Point("shelly_power") \
-                            .tag("device_id", id) \
-                            .field("output", output) \
-                            .field("apower", apower) \
-                            .field("voltage", voltage) \
-                            .field("current", current) \
-                            .field("total_energy", total_energy) \
-                            .field("temperature_c", temperature_c) \
-                            .field("temperature_f", temperature_f)
-
-                        # Write to InfluxDB
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    except json.JSONDecodeError:
-                        print(f"Failed to decode JSON payload: {payload}")
-
-                elif 'temperature' in topic:
-                    payload = msg.payload.decode("utf-8")
-
-                    try:
-                        data = json.loads(payload)
-
-                        # Extract relevant fields
-                        id = device_type
-
-                        temperature_c = data.get("tC")
-                        temperature_f = data.get("tF")
-                        sensor_id = data.get("id")
-
-                        # Create an InfluxDB point
-                        point = Point("shelly_temperature") \
-                            .tag("device_id", id) \
-                            .tag("sensor_id", sensor_id) \
-                            .field("temperature_c", float(temperature_c)) \
-                            .field("temperature_f", float(temperature_f))
-
-                        # Write to InfluxDB
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    except json.JSONDecodeError:
-                        print(f"Failed to decode JSON payload: {payload}")
-
-
-
-                elif 'humidity:0' in topic:
-                    payload = msg.payload.decode("utf-8")
-
-                    try:
-                        data = json.loads(payload)
-
-                        # Extract relevant fields
-                        id = device_type
-
-                        humidity = data.get("rh")
-
-                        # Create an InfluxDB point
-                        point = Point("shelly_humidity") \
-                            .tag("device_id", id) \
-                            .field("humidity", humidity)
-
-                        # Write to InfluxDB
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    except json.JSONDecodeError:
-                        print(f"Failed to decode JSON payload: {payload}")
-
-            elif 'events' in device_update:
-                if len(topic_parts) >= 3 and topic_parts[2] == 'ble':
-                    data = msg.payload.decode("utf-8")
-                    data = json.loads(data)
-                    data = data.get("payload")
-
-                    if 'temperature' in data:
-                        point = Point("shelly_temperature") \
-                            .tag("device_id", str(data.get('address'))) \
-                            .field("temperature_c", float(data.get('temperature'))) \
-                            .field("temperature_f", float((data.get('temperature') * 1.8 + 32.0)))
-
-                        # Write to InfluxDB
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-
-                        print(f"Data written to InfluxDB: {point}")
-
-
-                    if 'humidity' in data:
-                        point = Point("shelly_humidity") \
-                            .tag("device_id", data.get('address')) \
-                            .field("humidity", float(data.get('humidity')))
-
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    if 'motion' in data:
-
-                        point = Point("motion_sensor") \
-                            .field("encryption", data.get("encryption")) \
-                            .field("BTHome_version", data.get("BTHome_version")) \
-                            .field("pid", data.get("pid")) \
-                            .field("battery", data.get("battery")) \
-                            .field("temperature", data.get("temperature")) \
-                            .field("illuminance", data.get("illuminance")) \
-                            .field("motion", data.get("motion")) \
-                            .field("rssi", data.get("rssi")) \
-                            .tag("address", data.get("address"))
-
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    elif 'button' in data:
-
-                        point = Point("button") \
-                            .field("encryption", data.get("encryption")) \
-                            .field("BTHome_version", data.get("BTHome_version")) \
-                            .field("pid", data.get("pid")) \
-                            .field("battery", data.get("battery")) \
-                            .field("button", data.get("button")) \
-                            .field("rssi", data.get("rssi")) \
-                            .tag("address", data.get("address"))
-
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    elif 'window' in data:
-
-                        point = Point("door") \
-                            .field("encryption", data.get("encryption")) \
-                            .field("BTHome_version", data.get("BTHome_version")) \
-                            .field("pid", data.get("pid")) \
-                            .field("battery", data.get("battery")) \
-                            .field("illuminance", data.get("illuminance")) \
-                            .field("window", data.get("window")) \
-                            .field("rotation", data.get("rotation")) \
-                            .field("rssi", data.get("rssi")) \
-                            .tag("address", data.get("address"))
-
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(org=INFLUXDB_ORGANIZATION,
-                                         bucket=INFLUXDB_BUCKET,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-    elif msg.topic.startswith('shellies'):
-
-        topic_parts = msg.topic.split('/')
-        if len(topic_parts) >= 4:
-            device_type = topic_parts[1]
-            device_update = topic_parts[2]
-            topic = "/".join(topic_parts[3:])
-            if topic == 'temperature':
-                try:
-                    payload = msg.payload.decode("utf-8")
-                    point = Point("shelly_temperature") \
-                        .tag("device_id", device_type) \
-                        .field("temperature_c", float(payload))
-
-                    # Write to InfluxDB
-                    with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                        writer.write(org=INFLUXDB_ORGANIZATION,
-                                     bucket=INFLUXDB_BUCKET,
-                                     record=point,
-                                     )
-                    print(f"Data written to InfluxDB: {point}")
-                    pass
-                except:
-                    pass
-            elif topic == 'humidity':
-                try:
-                    payload = msg.payload.decode("utf-8")
-                    point = Point("shelly_humidity") \
-                        .tag("device_id", device_type) \
-                        .field("humidity", float(payload))
-
-                    # Write to InfluxDB
-                    with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                        writer.write(org=INFLUXDB_ORGANIZATION,
-                                     bucket=INFLUXDB_BUCKET,
-                                     record=point,
-                                     )
-                    print(f"Data written to InfluxDB: {point}")
-                    pass
-                except:
-                    pass
-    elif msg.topic.startswith('tele'):
-        topic_parts = msg.topic.split('/')
-
-        if len(topic_parts) >= 3:
-            try:
-                device_type = topic_parts[1]
-                device_update = topic_parts[2]
-                payload = msg.payload.decode("utf-8")
-                if device_update == 'SENSOR':
-                    try:
-                        data = json.loads(payload)
-                        data = data['Zaehler']
-
-                        # Extract relevant fields
-                        id = device_type
-
-                        Verbrauch = data.get("Verbrauch1")
-                        Lieferung = data.get("Lieferung1")
-                        Pges = data.get("Pges")
-                        P_L1 = data.get("P_L1")
-                        P_L2 = data.get("P_L2")
-                        P_L3 = data.get("P_L3")
-
-
-                        # Create an InfluxDB point
-                        point = Point("shelly_power") \
-                            .tag("device_id", id) \
-                            .field("Verbrauch", Verbrauch) \
-                            .field("Lieferung", Lieferung) \
-                            .field("Pges", Pges) \
-                            .field("P_L1", P_L1) \
-                            .field("P_L2", P_L2) \
-                            .field("P_L3", P_L3)
-
-
-                        # Write to InfluxDB
-                        with influx_client.write_api(write_options=SYNCHRONOUS) as writer:
-                            writer.write(bucket=INFLUXDB_BUCKET,
-                                         org=INFLUXDB_ORGANIZATION,
-                                         record=point,
-                                         )
-                        print(f"Data written to InfluxDB: {point}")
-
-                    except json.JSONDecodeError:
-                        print(f"Failed to decode JSON payload: {payload}")
-            except:
-                pass
-
-
-while True:
+    if SUBSCRIPTION_REPORT_INTERVAL:
+        report_counts()
+    if aggregator is not None:
+        flush_aggregates()
+    device_tags.maintain()
+    flush_ble()
+
+    match = router.route(msg.topic)
+    if match is None:
+        # Delivered by a wildcard filter but not handled, e.g. another component of a Gen2 device
+        subscription_counts["(unrouted)"] += 1
+        metrics.MESSAGES.inc("unrouted")
+        return
+    family = match.pattern
+    subscription_counts[match.subscription] += 1
+    metrics.MESSAGES.inc(family)
+    if dedup is not None and dedup.suppress_retained(msg.topic, msg.retain):
+        return
+
+    start = time.perf_counter()
     try:
-        client = mqtt.Client()
-        client.on_connect = on_connect
-        client.on_message = on_message
-        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-
-        client.connect(MQTT_SERVER, 1883, 60)
-
-        # Blocking call that processes network traffic, dispatches callbacks and handles reconnecting.
-        client.loop_forever()
-
-    except:
+        points = match.handler(match.parts, msg.payload)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        # json.JSONDecodeError is a ValueError
+        metrics.DECODE_FAILURES.inc(family)
+        if decode_failure_sampler():
+            log.warning("Failed to handle message", extra=fields(topic=msg.topic, error=e, payload=msg.payload[:200]))
+        return
+    metrics.POINTS_BUILT.inc(family, amount=len(points))
+
+    write_points(points, msg.topic)
+    metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, family)
+
+
+def create_client(client_id="", protocol=mqtt.MQTTv311):
+    """
+    Creates an MQTT client with the bridge callbacks installed.
+
+    Args:
+        client_id: The MQTT client id, a random one is used if empty.
+        protocol: The MQTT protocol version.
+    """
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=protocol)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.reconnect_delay_set(int(MQTT_RECONNECT_MIN_DELAY), int(MQTT_RECONNECT_MAX_DELAY))
+    return client
+
+
+def connect_forever(client_factory):
+    """
+    Connects to the broker and processes messages, reconnecting with a new client whenever the loop ends.
+
+    Failed connection attempts are retried with exponential backoff between MQTT_RECONNECT_MIN_DELAY and
+    MQTT_RECONNECT_MAX_DELAY seconds.
+
+    Args:
+        client_factory: Callable returning a configured MQTT client.
+    """
+    delay = MQTT_RECONNECT_MIN_DELAY
+    while True:
+        try:
+            client = client_factory()
+
+            client.connect(MQTT_SERVER, MQTT_PORT, 60)
+            delay = MQTT_RECONNECT_MIN_DELAY
+
+            # Blocking call that processes network traffic, dispatches callbacks and handles reconnecting.
+            client.loop_forever()
+
+        except KeyboardInterrupt:
+            raise
+
+        except Exception as e:
+            log.warning("MQTT connection failed", extra=fields(server=MQTT_SERVER, error=e, retry_in=delay))
+
+        finally:
+            log.info("Closing connection")
+
+        time.sleep(delay)
+        delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
+
+
+def main():
+    global writer
+    configure_logging(LOG_LEVEL)
+    if MQTT_WORKERS > 1:
+        from workers import supervise
+        supervise(MQTT_WORKERS)
+        return
+
+    # Treat SIGTERM like Ctrl+C so queued points are drained on shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    writer = create_writer()
+    writer.start()
+    if METRICS_PORT:
+        register_metrics()
+        metrics.start_http_server(METRICS_PORT)
+    try:
+        connect_forever(create_client)
+    except KeyboardInterrupt:
         pass
-
     finally:
-        print("Closing connection")
+        # Drain queued points before exiting
+        flush_ble(force=True)
+        writer.close()
+        device_tags.save()
+
+
+if __name__ == "__main__":
+    main()
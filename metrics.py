@@ -0,0 +1,197 @@
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+##
+# Minimal Prometheus/OpenMetrics instrumentation without extra dependencies.
+#
+# Metrics are module level objects updated from the hot path (a dict update under a lock) and rendered in the
+# Prometheus text format by a small HTTP server running on its own daemon thread, so scraping never touches the
+# MQTT network thread.
+##
+
+_registry = []
+_registry_lock = threading.Lock()
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            # A family is rendered once, a later registration of the same name replaces the earlier one
+            _registry[:] = [metric for metric in _registry if metric.name != name]
+            _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing count, optionally per label values.
+    """
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down. With a callback the value is read at scrape time instead of being set.
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """
+        Args:
+            callback: Optional function returning the value, or a dict from label value tuples to values.
+        """
+        super().__init__(name, documentation, labelnames)
+        self._callback = callback
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        if self._callback is not None:
+            try:
+                value = self._callback()
+            except Exception:
+                return []
+            with self._lock:
+                self._values = dict(value) if isinstance(value, dict) else {(): value}
+        return super().render()
+
+
+class CounterFunc(Gauge):
+    """
+    A counter read from a callback at scrape time, e.g. from a component's ``stats()``.
+    """
+    type = "counter"
+
+
+class Histogram(_Metric):
+    """
+    Counts observations into cumulative buckets, optionally per label values.
+    """
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self._buckets), 0.0, 0]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = [(labels, (list(state[0]), state[1], state[2])) for labels, state in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self._buckets, counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def render():
+    """
+    Renders all metrics in the Prometheus text exposition format.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address="0.0.0.0"):
+    """
+    Serves ``/metrics`` on a daemon thread.
+
+    Returns:
+        The HTTP server.
+    """
+    server = ThreadingHTTPServer((address, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+# --- Bridge metrics ---
+MESSAGES = Counter("shellyqtt_messages_total", "MQTT messages received per topic family", ("family",))
+HANDLER_SECONDS = Histogram("shellyqtt_handler_seconds", "Time spent handling one message per topic family",
+                            ("family",))
+DECODE_FAILURES = Counter("shellyqtt_decode_failures_total", "Messages whose payload could not be decoded",
+                          ("family",))
+POINTS_BUILT = Counter("shellyqtt_points_built_total", "Points built from messages per topic family", ("family",))
+RECONNECTS = Counter("shellyqtt_mqtt_reconnects_total", "MQTT connections established after the first one")
+WRITE_BATCH_POINTS = Histogram("shellyqtt_write_batch_points", "Points per InfluxDB write request",
+                               buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000))
+WRITE_SECONDS = Histogram("shellyqtt_write_seconds", "Duration of InfluxDB write requests")
+WRITE_ERRORS = Counter("shellyqtt_write_errors_total", "Failed InfluxDB write requests")
+FRONIUS_POLL_SECONDS = Histogram("shellyqtt_fronius_poll_seconds", "Duration of Fronius API polls per endpoint",
+                                 ("inverter", "endpoint"))
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import fronius_influx as fronius
+import main as bridge
+import metrics
+from device_tags import device_tags
+from structured_logging import Sampler, configure_logging, fields
+
+##
+# Single process service running the MQTT bridge, the Fronius poller and the InfluxDB writers in one event loop.
+#
+# MQTT ingestion (aiomqtt) and one polling task per inverter and endpoint are cooperating asyncio tasks. All HTTP
+# traffic, Fronius polls and InfluxDB writes alike, goes through one pooled aiohttp session. The batch writers keep
+# their flush threads (batching, spooling and replay work as before) but hand their requests to the event loop.
+# Lost connections are retried with exponential backoff and SIGINT/SIGTERM cancel the tasks and drain the writers.
+#
+#   pip install aiomqtt aiohttp
+#   python service.py
+##
+
+SERVICE_MQTT_ENABLED = os.getenv('SERVICE_MQTT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SERVICE_FRONIUS_ENABLED = os.getenv('SERVICE_FRONIUS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 16))
+
+log = logging.getLogger("service")
+# Errors of one message or poll are logged and skipped, sampled since a broken device repeats them
+error_sampler = Sampler(bridge.LOG_SAMPLE_EVERY)
+
+
+class Message:
+    """
+    The attributes of a paho message ``main.on_message`` reads, taken from an aiomqtt message.
+    """
+    __slots__ = ("topic", "payload", "retain")
+
+    def __init__(self, topic, payload, retain):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+
+
+class LoopWriteApi:
+    """
+    Synchronous ``write_api`` for a ``BatchWriter`` that posts through the event loop's aiohttp session.
+
+    The writer's flush thread blocks on the request while the loop keeps serving every other task.
+    """
+
+    def __init__(self, loop, session, url, token, timeout=30.0):
+        self._loop = loop
+        self._session = session
+        self._url = f"{url}/api/v2/write"
+        self._headers = {"Authorization": f"Token {token}", "Content-Type": "text/plain; charset=utf-8"}
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def _post(self, bucket, org, data):
+        async with self._session.post(self._url, params={"bucket": bucket, "org": org, "precision": "ns"},
+                                      data=data, headers=self._headers, timeout=self._timeout) as response:
+            if response.status >= 300:
+                # raise_for_status() without the body would hide InfluxDB's explanation
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                  message=await response.text())
+
+    def write(self, bucket, org, record):
+        asyncio.run_coroutine_threadsafe(self._post(bucket, org, record), self._loop).result()
+
+
+async def run_mqtt():
+    """
+    Receives MQTT messages and feeds them to the bridge, reconnecting with exponential backoff.
+    """
+    subscriptions = bridge.router.subscriptions()
+    delay = bridge.MQTT_RECONNECT_MIN_DELAY
+    connected_before = False
+    while True:
+        try:
+            async with aiomqtt.Client(bridge.MQTT_SERVER, bridge.MQTT_PORT, username=bridge.MQTT_USERNAME,
+                                      password=bridge.MQTT_PASSWORD, keepalive=60) as client:
+                if connected_before:
+                    metrics.RECONNECTS.inc()
+                connected_before = True
+                delay = bridge.MQTT_RECONNECT_MIN_DELAY
+                loop = asyncio.get_running_loop()
+                device_tags.publish = lambda topic, payload: loop.create_task(client.publish(topic, payload))
+                await client.subscribe([(subscription, 0) for subscription in subscriptions])
+                log.info("Connected", extra=fields(server=bridge.MQTT_SERVER,
+                                                   subscriptions=",".join(subscriptions)))
+                on_message = bridge.on_message
+                async for message in client.messages:
+                    try:
+                        on_message(None, None, Message(message.topic.value, message.payload, message.retain))
+                    except Exception:
+                        # on_message handles decoding errors itself, anything else must not end ingestion
+                        if error_sampler():
+                            log.exception("Failed to handle message", extra=fields(topic=message.topic.value))
+        except aiomqtt.MqttError as e:
+            device_tags.publish = None
+            log.warning("MQTT connection failed", extra=fields(server=bridge.MQTT_SERVER, error=e, retry_in=delay))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, bridge.MQTT_RECONNECT_MAX_DELAY)
+
+
+async def poll_endpoint(session, inverter_ip, measurement_name, endpoint, interval):
+    """
+    Polls one endpoint of one inverter on a fixed grid (start + n * interval), skipping slots a slow poll missed.
+    """
+    url = f"http://{inverter_ip}/solar_api/v1/Get{endpoint}"
+    timeout = aiohttp.ClientTimeout(total=fronius.FRONIUS_TIMEOUT)
+    loop = asyncio.get_running_loop()
+    due = loop.time()
+    while True:
+        start = time.perf_counter()
+        try:
+            async with session.get(url, timeout=timeout) as response:
+                response.raise_for_status()
+                fronius_data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            log.warning("Error fetching data from Fronius API", extra=fields(url=url, error=e))
+            fronius_data = None
+        metrics.FRONIUS_POLL_SECONDS.observe(time.perf_counter() - start, inverter_ip, measurement_name)
+        if fronius_data and 'Body' in fronius_data and 'Data' in fronius_data['Body']:
+            try:
+                fronius.write_data_to_influxdb(measurement_name, fronius_data['Body']['Data'], inverter_ip)
+            except Exception:
+                if error_sampler():
+                    log.exception("Failed to write Fronius data", extra=fields(url=url))
+
+        due += interval
+        now = loop.time()
+        if due < now:
+            due += ((now - due) // interval + 1) * interval
+        await asyncio.sleep(due - now)
+
+
+async def run():
+    """
+    Runs the service until SIGINT/SIGTERM or until one of its tasks ends unexpectedly.
+
+    Returns:
+        The exit status, 1 if a task ended unexpectedly.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    failed = []
+
+    def task_done(task):
+        # The tasks loop forever, so one ending on its own means part of the service stopped working
+        if task.cancelled() or stopping.is_set():
+            return
+        log.error("Task ended unexpectedly, stopping the service", extra=fields(task=task.get_name()),
+                  exc_info=task.exception())
+        failed.append(task)
+        stopping.set()
+
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=120)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        write_api = LoopWriteApi(loop, session, f"http://{bridge.INFLUXDB_HOST}:{bridge.INFLUXDB_PORT}",
+                                 bridge.INFLUXDB_TOKEN)
+        # Both writers keep their own spool directory, so data spooled by the standalone scripts is replayed
+        bridge.writer = bridge.create_writer("mqtt", write_api)
+        fronius.writer = bridge.create_writer("fronius", write_api)
+        writers = [bridge.writer, fronius.writer]
+        for writer in writers:
+            writer.start()
+
+        tasks = []
+        if SERVICE_MQTT_ENABLED and bridge.MQTT_SERVER:
+            tasks.append(asyncio.create_task(run_mqtt(), name="mqtt"))
+        if SERVICE_FRONIUS_ENABLED:
+            for ip in fronius.FRONIUS_INVERTER_IPS:
+                for measurement_name, (endpoint, interval) in fronius.ENDPOINTS.items():
+                    tasks.append(asyncio.create_task(poll_endpoint(session, ip, measurement_name, endpoint, interval),
+                                                     name=f"fronius-{ip}-{measurement_name}"))
+        for task in tasks:
+            task.add_done_callback(task_done)
+        log.info("Service started", extra=fields(tasks=len(tasks)))
+
+        try:
+            await stopping.wait()
+        finally:
+            log.info("Shutting down")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            bridge.flush_ble(force=True)
+            # Draining blocks on writes that need the loop, so it runs in a thread while the loop keeps going
+            for writer in writers:
+                await loop.run_in_executor(None, writer.close)
+            device_tags.save()
+    return 1 if failed else 0
+
+
+def main():
+    if aiomqtt is None or aiohttp is None:
+        raise SystemExit("service.py needs aiomqtt and aiohttp: pip install aiomqtt aiohttp")
+    configure_logging(bridge.LOG_LEVEL)
+    if bridge.METRICS_PORT:
+        bridge.register_metrics()
+        metrics.start_http_server(bridge.METRICS_PORT)
+    raise SystemExit(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()
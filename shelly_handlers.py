@@ -0,0 +1,123 @@
+from ble import BleStage
+from components import COMPONENT_TAGS, ComponentRegistry
+from decoders import BLE_FIELDS, decoder
+from device_tags import DEVICE_RPC_SOURCE, device_tags
+from line_protocol import Template
+from topic_router import TopicRouter
+
+
+##
+# Message handlers. Each handler receives the topic split into its levels and the raw payload and returns the
+# records to write. Supporting a new device family means adding a handler here and registering it in build_router().
+##
+
+SHELLY_POWER = Template("shelly_power", COMPONENT_TAGS,
+                        ("output", "apower", "voltage", "current", "total_energy", "temperature_c", "temperature_f"))
+SHELLY_TEMPERATURE = Template("shelly_temperature", ("device_id", "sensor_id") + device_tags.tag_keys,
+                              ("temperature_c", "temperature_f"))
+SHELLY_HUMIDITY = Template("shelly_humidity", ("device_id", "sensor_id") + device_tags.tag_keys, ("humidity",))
+# One record per BLU advertisement with all of its values, tagged with the gateway that received it best
+BLE_SENSOR = Template("ble_sensor", ("address", "gateway") + device_tags.tag_keys, BLE_FIELDS[1:])
+TASMOTA_POWER = Template("shelly_power", ("device_id",) + device_tags.tag_keys, ("Verbrauch", "Lieferung", "Pges", "P_L1", "P_L2", "P_L3"))
+
+
+def temperature_values(payload):
+    _, temperature_c, temperature_f = decoder.temperature(payload)
+    return float(temperature_c), float(temperature_f)
+
+
+def humidity_values(payload):
+    humidity = decoder.humidity(payload)
+    # Whole percentages would otherwise be written as integers, conflicting with the float field
+    return (float(humidity) if humidity.__class__ is int else humidity,)
+
+
+def build_components():
+    """
+    Builds the registry of Gen2 component types written from ``<prefix>/status/<type>:<id>`` topics.
+
+    Supporting another component type means registering it here; every channel of it is handled.
+    """
+    components = ComponentRegistry()
+    components.register("switch", SHELLY_POWER, decoder.switch)
+    # Temperature keeps its sensor_id tag. Humidity only has one for ids other than 0 (e.g. add-on sensors from
+    # humidity:100), so the existing humidity:0 series continue
+    components.register("temperature", SHELLY_TEMPERATURE, temperature_values)
+    components.register("humidity", SHELLY_HUMIDITY, humidity_values, untagged_channel="0")
+    # Pro 3EM: per phase and total power, and the energy counters
+    components.register_fields("em", "shelly_em", {field: field for field in (
+        "a_current", "a_voltage", "a_act_power", "a_aprt_power", "a_pf", "a_freq",
+        "b_current", "b_voltage", "b_act_power", "b_aprt_power", "b_pf", "b_freq",
+        "c_current", "c_voltage", "c_act_power", "c_aprt_power", "c_pf", "c_freq",
+        "n_current", "total_current", "total_act_power", "total_aprt_power")})
+    components.register_fields("emdata", "shelly_emdata", {field: field for field in (
+        "a_total_act_energy", "a_total_act_ret_energy", "b_total_act_energy", "b_total_act_ret_energy",
+        "c_total_act_energy", "c_total_act_ret_energy", "total_act", "total_act_ret")})
+    # Pro EM and Pro 3EM in monophase mode: one meter per channel
+    components.register_fields("em1", "shelly_em1", {field: field for field in (
+        "current", "voltage", "act_power", "aprt_power", "pf", "freq")})
+    components.register_fields("em1data", "shelly_em1data", {field: field for field in (
+        "total_act_energy", "total_act_ret_energy")})
+    # Plus PM Mini
+    components.register_fields("pm1", "shelly_pm1", {
+        "voltage": "voltage", "current": "current", "apower": "apower", "freq": "freq",
+        "total_energy": "aenergy.total", "returned_energy": "ret_aenergy.total"})
+    components.register_fields("input", "shelly_input", {
+        "state": "state", "percent": "percent", "count": "counts.total", "freq": "freq"})
+    components.register_fields("cover", "shelly_cover", {
+        "state": "state", "apower": "apower", "voltage": "voltage", "current": "current", "pf": "pf",
+        "freq": "freq", "total_energy": "aenergy.total", "current_pos": "current_pos",
+        "target_pos": "target_pos", "temperature_c": "temperature.tC"})
+    # Battery powered devices like the Plus H&T
+    components.register_fields("devicepower", "shelly_devicepower", {
+        "battery_voltage": "battery.V", "battery_percent": "battery.percent", "external_power": "external.present"})
+    return components
+
+
+# Merges the copies of BLU advertisements relayed by several gateways. Metadata of BLU devices can only come from
+# the device cache file. The bridge flushes it periodically, so advertisements are written once traffic stops.
+ble_stage = BleStage(BLE_SENSOR)
+
+
+def handle_gen1_temperature(topic_parts, payload):
+    return [SHELLY_TEMPERATURE.record((topic_parts[1], None) + device_tags.tags(topic_parts[1], 1),
+                                      (float(payload), None))]
+
+
+def handle_gen1_humidity(topic_parts, payload):
+    return [SHELLY_HUMIDITY.record((topic_parts[1], None) + device_tags.tags(topic_parts[1], 1), (float(payload),))]
+
+
+def handle_tasmota_sensor(topic_parts, payload):
+    data = decoder.tasmota_sensor(payload)
+    if data is None:
+        return []
+
+    return [TASMOTA_POWER.record((topic_parts[1],) + device_tags.tags(topic_parts[1]), data)]
+
+
+def build_router():
+    """
+    Builds the topic router with all known device families registered.
+
+    Returns:
+        A ``TopicRouter`` mapping topic patterns to the handlers above.
+    """
+    router = TopicRouter()
+    # Shelly Gen2 devices publish to <prefix>/status/<type>:<id> and <prefix>/events/<source>
+    components = build_components()
+    for component_type in components.types():
+        router.register(f"shelly*/status/{component_type}:*", components.handle)
+    # BLU devices are relayed by any Gen2 device acting as BLE gateway
+    router.register("*/events/ble", ble_stage.handle)
+    # Shelly Gen1 devices publish one value per topic under shellies/<device_id>/<component>/
+    router.register("shellies/+/+/temperature", handle_gen1_temperature)
+    router.register("shellies/+/+/humidity", handle_gen1_humidity)
+    # Tasmota smart meter readers
+    router.register("tele/+/SENSOR", handle_tasmota_sensor)
+    # Device metadata for the tags, see device_tags
+    router.register("shelly*/online", device_tags.handle_online)
+    router.register("shellies/+/online", device_tags.handle_online)
+    router.register("shellies/announce", device_tags.handle_announce)
+    router.register(f"{DEVICE_RPC_SOURCE}/rpc", device_tags.handle_rpc_response)
+    return router
@@ -0,0 +1,531 @@
+import gzip
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from line_protocol import Record
+from structured_logging import Sampler, fields
+
+##
+# Sinks the bridge and the Fronius poller write their points to.
+#
+# A sink takes points with write() without blocking and writes them in batches from its own thread: start() starts
+# it, close() drains and stops it, stats() and queue_depth() report on it. SINKS selects the sinks of a process, a
+# comma separated list of:
+#   influx  InfluxDB v2 (influx_writer.BatchWriter), spooling to disk while InfluxDB is unavailable
+#   file    Rotating gzipped line protocol files in ARCHIVE_DIR, ready for bulk loading with `influx write`
+#   sqlite  One SQLite database per process in ARCHIVE_DIR, a table per measurement and a column per tag and field
+# Several sinks run side by side, e.g. SINKS=influx,file to keep a cheap raw archive next to InfluxDB. Without the
+# influx sink, neither influxdb_client nor a reachable InfluxDB is needed.
+##
+
+SINKS = os.getenv('SINKS', 'influx')
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_ROTATE_BYTES = int(os.getenv('ARCHIVE_ROTATE_BYTES', 64 * 1024 * 1024))  # Uncompressed bytes per file
+ARCHIVE_ROTATE_INTERVAL = float(os.getenv('ARCHIVE_ROTATE_INTERVAL', 3600))
+ARCHIVE_COMPRESS = os.getenv('ARCHIVE_COMPRESS', 'true').lower() in ('1', 'true', 'yes')
+
+log = logging.getLogger("sinks")
+# A bad value tends to repeat on every message of its device, so encoding failures are sampled
+invalid_sampler = Sampler(1000)
+
+
+def encode_lines(batch, buffer):
+    """
+    Encodes a batch of points as line protocol.
+
+    Points that can't be encoded (e.g. a field value that is a list) are skipped, so one bad payload doesn't cost
+    the rest of the batch.
+
+    Args:
+        batch: (point, timestamp) tuples, points without a time are stamped with the timestamp.
+        buffer: The bytearray the lines are written to, cleared first.
+
+    Returns:
+        The number of lines written and the number of points skipped.
+    """
+    del buffer[:]
+    lines = 0
+    invalid = 0
+    for point, timestamp in batch:
+        start = len(buffer)
+        try:
+            if isinstance(point, Record):
+                if point.time is None:
+                    point.time = timestamp
+                written = point.encode_into(buffer)
+            else:
+                if point._time is None:
+                    point.time(timestamp)
+                line = point.to_line_protocol()
+                if line:
+                    buffer += line.encode()
+                written = bool(line)
+        except Exception as e:
+            del buffer[start:]
+            invalid += 1
+            if invalid_sampler():
+                template = getattr(point, "template", None)
+                log.warning("Skipping point that can't be encoded", extra=fields(
+                    measurement=template.measurement if template is not None else getattr(point, "_name", None),
+                    values=getattr(point, "fields", None), error=e))
+            continue
+        if written:
+            buffer += b'\n'
+            lines += 1
+    return lines, invalid
+
+
+class QueuedSink:
+    """
+    Base of the sinks: batches points off the caller's thread.
+
+    Points are put on a bounded in-memory queue and a background thread hands them to ``_write`` in batches, either
+    when ``batch_size`` points are waiting or when ``flush_interval`` seconds have passed since the first point of
+    the batch arrived. When the queue is full new points are dropped (and counted) instead of blocking the caller,
+    so a slow sink never stalls the MQTT network thread.
+    """
+    name = "sink"
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue=10000, report_interval=60.0):
+        """
+        Args:
+            batch_size: Maximum number of points per batch.
+            flush_interval: Maximum time in seconds a point waits before it is flushed.
+            max_queue: Maximum number of points buffered in memory.
+            report_interval: Seconds between queue depth / flush latency reports, 0 to disable.
+        """
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._report_interval = report_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closing = threading.Event()
+        self._thread = None
+
+        self.points_written = 0
+        self.points_dropped = 0
+        self.points_invalid = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def start(self):
+        """
+        Starts the background flush thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+
+    def write(self, point):
+        """
+        Queues a point for writing without blocking.
+
+        Args:
+            point: The ``Point`` or ``Record`` to write. It is stamped with the current time if it has none.
+
+        Returns:
+            True if the point was queued, False if the queue was full and the point was dropped.
+        """
+        try:
+            self._queue.put_nowait((point, time.time_ns()))
+            return True
+        except queue.Full:
+            self.points_dropped += 1
+            return False
+
+    def queue_depth(self):
+        """
+        Returns the number of points waiting to be written.
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        Returns a snapshot of the sink counters.
+        """
+        return {
+            "queue_depth": self.queue_depth(),
+            "points_written": self.points_written,
+            "points_dropped": self.points_dropped,
+            "points_invalid": self.points_invalid,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    def close(self, timeout=10.0):
+        """
+        Stops the flush thread after draining all queued points.
+
+        Args:
+            timeout: Maximum time in seconds to wait for the queue to drain.
+        """
+        self._closing.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            # Never started, drain on the calling thread
+            self._drain()
+
+    def _backlog_due(self):
+        # Whether there is older data to catch up on, so the thread shouldn't wait for new points
+        return False
+
+    def _after_flush(self, backlog_due):
+        pass
+
+    def _write(self, batch, **options):
+        # Writes a batch of (point, timestamp) tuples, implemented by the sinks
+        raise NotImplementedError
+
+    def _flush(self, batch, **options):
+        start = time.perf_counter()
+        try:
+            self._write(batch, **options)
+        except Exception as e:
+            self.flush_errors += 1
+            log.warning("Error writing batch", extra=fields(sink=self.name, points=len(batch), error=e))
+        finally:
+            self.flushes += 1
+            self.last_flush_latency = time.perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+    def _run(self):
+        next_report = time.monotonic() + self._report_interval
+        while not self._closing.is_set():
+            try:
+                backlog_due = self._backlog_due()
+                # Don't wait for new points while there is a backlog to catch up on
+                batch = self._collect(block=not backlog_due)
+                if batch:
+                    self._flush(batch)
+                self._after_flush(backlog_due)
+                if self._report_interval and time.monotonic() >= next_report:
+                    next_report += self._report_interval
+                    self._report()
+            except Exception:
+                # The thread is the only one writing, it must outlive whatever went wrong with one batch
+                log.exception("Unexpected error in sink thread", extra=fields(sink=self.name))
+                self._closing.wait(self._flush_interval)
+        try:
+            self._drain()
+        except Exception:
+            log.exception("Unexpected error draining sink", extra=fields(sink=self.name))
+        self._report()
+
+    def _collect(self, block=True):
+        # Wait for the first point, then gather until the batch is full or the interval is up
+        try:
+            if block:
+                batch = [self._queue.get(timeout=self._flush_interval)]
+            else:
+                batch = [self._queue.get_nowait()]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + (self._flush_interval if block else 0)
+        while len(batch) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and not self._closing.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self._batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+
+    def _report(self):
+        log.info("Sink", extra=fields(sink=self.name, **self.stats()))
+
+
+class LineProtocolFileSink(QueuedSink):
+    """
+    Appends points as line protocol to files rotated by size and age.
+
+    Files are named ``<prefix>-<UTC start time>.lp`` (``.lp.gz`` compressed) and only written by this sink, so
+    finished files can be moved or loaded while it runs. A compressed file is flushed after every batch, so a crash
+    loses at most the batch being written.
+    """
+    name = "file"
+
+    def __init__(self, directory, prefix, rotate_bytes=ARCHIVE_ROTATE_BYTES, rotate_interval=ARCHIVE_ROTATE_INTERVAL,
+                 compress=ARCHIVE_COMPRESS, **kwargs):
+        """
+        Args:
+            directory: The directory the files are written to.
+            prefix: Start of the file names, every sink writing to the same directory needs its own.
+            rotate_bytes: Uncompressed bytes after which a new file is started.
+            rotate_interval: Seconds after which a new file is started.
+            compress: Whether files are gzip compressed.
+            **kwargs: Batching options of ``QueuedSink``.
+        """
+        super().__init__(**kwargs)
+        self._directory = directory
+        self._prefix = prefix
+        self._rotate_bytes = rotate_bytes
+        self._rotate_interval = rotate_interval
+        self._compress = compress
+        self._file = None
+        self._file_bytes = 0
+        self._file_deadline = 0.0
+        self._buffer = bytearray()
+        self.files = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def stats(self):
+        stats = super().stats()
+        stats["files"] = self.files
+        return stats
+
+    def close(self, timeout=10.0):
+        super().close(timeout)
+        self._close_file()
+
+    def _open_file(self):
+        stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        path = os.path.join(self._directory, f"{self._prefix}-{stamp}.lp" + (".gz" if self._compress else ""))
+        self._file = gzip.open(path, "ab") if self._compress else open(path, "ab")
+        self._file_bytes = 0
+        self._file_deadline = time.monotonic() + self._rotate_interval
+        self.files += 1
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch):
+        lines, invalid = encode_lines(batch, self._buffer)
+        self.points_invalid += invalid
+        if not lines:
+            return
+        if self._file is not None and (self._file_bytes >= self._rotate_bytes
+                                       or time.monotonic() >= self._file_deadline):
+            self._close_file()
+        if self._file is None:
+            self._open_file()
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._file_bytes += len(self._buffer)
+        self.points_written += lines
+
+
+# Value types sqlite3 can bind
+_SQLITE_TYPES = (type(None), bool, int, float, str, bytes)
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class SqliteSink(QueuedSink):
+    """
+    Writes points to a SQLite database, a table per measurement with a column per tag and field.
+
+    Tables and columns are created as measurements and keys show up. Values keep their type (SQLite columns
+    without a declared type store integers, floats, booleans as 0/1 and strings as they are), time is in
+    nanoseconds since the epoch. Each batch is inserted in one transaction, with one ``executemany`` per
+    measurement and key set.
+    """
+    name = "sqlite"
+
+    def __init__(self, path, **kwargs):
+        """
+        Args:
+            path: The database file.
+            **kwargs: Batching options of ``QueuedSink``.
+        """
+        super().__init__(**kwargs)
+        self._path = path
+        self._connection = None
+        self._columns = {}
+        self._statements = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def close(self, timeout=10.0):
+        super().close(timeout)
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _connect(self):
+        # Created on the flush thread, which is the only one using it
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        for (table,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+            self._columns[table] = {row[1] for row in connection.execute(f"PRAGMA table_info({_quote(table)})")}
+        return connection
+
+    def _statement(self, measurement, keys):
+        # The INSERT for a measurement and key set, creating the table and missing columns first
+        statement_key = (measurement, keys)
+        try:
+            return self._statements[statement_key]
+        except KeyError:
+            pass
+        table = _quote(measurement)
+        columns = self._columns.get(measurement)
+        if columns is None:
+            self._connection.execute(f"CREATE TABLE {table} (time INTEGER NOT NULL)")
+            columns = self._columns[measurement] = {"time"}
+        for key in keys:
+            if key not in columns:
+                self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {_quote(key)}")
+                columns.add(key)
+        statement = (f"INSERT INTO {table} (time, {', '.join(_quote(key) for key in keys)}) "
+                     f"VALUES ({', '.join('?' * (len(keys) + 1))})")
+        self._statements[statement_key] = statement
+        return statement
+
+    def _write(self, batch):
+        if self._connection is None:
+            self._connection = self._connect()
+        # Rows grouped by measurement and key set, records of a template share both
+        groups = {}
+        rows_built = 0
+        for point, timestamp in batch:
+            try:
+                if isinstance(point, Record):
+                    template = point.template
+                    if point.time is None:
+                        point.time = timestamp
+                    group_key = (template.measurement, template.tag_keys + template.field_keys)
+                    row = (point.time,) + tuple(point.tags) + tuple(point.fields)
+                else:
+                    if point._time is None:
+                        point.time(timestamp)
+                    keys = tuple(point._tags) + tuple(point._fields)
+                    group_key = (point._name, keys)
+                    row = (point._time,) + tuple(point._tags.values()) + tuple(point._fields.values())
+                for value in row:
+                    if value.__class__ not in _SQLITE_TYPES:
+                        raise TypeError(f"Unsupported value {value!r}")
+            except Exception as e:
+                # Checked per point, so one bad value doesn't fail the whole transaction
+                self.points_invalid += 1
+                if invalid_sampler():
+                    log.warning("Skipping point that can't be stored", extra=fields(sink=self.name, error=e))
+                continue
+            groups.setdefault(group_key, []).append(row)
+            rows_built += 1
+
+        try:
+            with self._connection:
+                for (measurement, keys), rows in groups.items():
+                    self._connection.executemany(self._statement(measurement, keys), rows)
+        except sqlite3.Error:
+            # Tables or columns created in the failed transaction are gone, start over from the database's schema
+            self._connection.close()
+            self._connection = None
+            self._columns.clear()
+            self._statements.clear()
+            raise
+        self.points_written += rows_built
+
+
+class FanOut:
+    """
+    Writes every point to several sinks.
+
+    Points are stamped before they are handed on, so all sinks store the same time.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def write(self, point):
+        if isinstance(point, Record):
+            if point.time is None:
+                point.time = time.time_ns()
+        elif point._time is None:
+            point.time(time.time_ns())
+        written = False
+        for sink in self.sinks:
+            written = sink.write(point) or written
+        return written
+
+    def close(self, timeout=10.0):
+        for sink in self.sinks:
+            sink.close(timeout)
+
+    def queue_depth(self):
+        return max(sink.queue_depth() for sink in self.sinks)
+
+    @property
+    def points_written(self):
+        return sum(sink.points_written for sink in self.sinks)
+
+    @property
+    def points_dropped(self):
+        return sum(sink.points_dropped for sink in self.sinks)
+
+    def stats(self):
+        """
+        Returns the counters of all sinks added up, latencies are the slowest sink's.
+        """
+        stats = {}
+        for sink in self.sinks:
+            for key, value in sink.stats().items():
+                if "latency" in key or key == "queue_depth":
+                    stats[key] = max(stats.get(key, value), value)
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+
+def create_sinks(names, prefix, influx_factory, **kwargs):
+    """
+    Creates the sinks of a writer.
+
+    Args:
+        names: Comma separated sink names, see SINKS.
+        prefix: Name of the writer (e.g. ``mqtt``), used for the archive file names.
+        influx_factory: Function creating the InfluxDB sink, only called if it is selected.
+        **kwargs: Batching options of ``QueuedSink`` for the archive sinks.
+
+    Returns:
+        The sink, or a ``FanOut`` if several are selected.
+    """
+    sinks = []
+    for name in (name.strip() for name in names.split(",")):
+        if not name:
+            continue
+        if name == "influx":
+            sinks.append(influx_factory())
+        elif name == "file":
+            sinks.append(LineProtocolFileSink(ARCHIVE_DIR, prefix, **kwargs))
+        elif name == "sqlite":
+            sinks.append(SqliteSink(os.path.join(ARCHIVE_DIR, f"{prefix}.sqlite"), **kwargs))
+        else:
+            raise ValueError(f"Unknown sink {name!r}, expected influx, file or sqlite")
+    if not sinks:
+        raise ValueError("No sink configured, set SINKS")
+    return sinks[0] if len(sinks) == 1 else FanOut(sinks)
@@ -0,0 +1,253 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from structured_logging import fields
+
+log = logging.getLogger("spool")
+
+_LENGTH = struct.Struct("<I")
+_SUFFIX = ".spool"
+
+
+def _segment_numbers(directory):
+    return sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(directory)
+                  if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+
+
+def adopt_segments(source, target):
+    """
+    Moves the segments of one spool directory behind those of another, so a ``Spool`` of ``target`` replays them.
+
+    Neither directory may have a ``Spool`` open while segments are moved.
+
+    Args:
+        source: The directory whose segments are taken over. Left empty.
+        target: The directory receiving them. Created if missing.
+
+    Returns:
+        The number of segments moved.
+    """
+    if not os.path.isdir(source):
+        return 0
+    os.makedirs(target, exist_ok=True)
+    existing = _segment_numbers(target)
+    number = existing[-1] + 1 if existing else 0
+    moved = 0
+    for old in _segment_numbers(source):
+        os.replace(os.path.join(source, f"{old:020d}{_SUFFIX}"), os.path.join(target, f"{number:020d}{_SUFFIX}"))
+        number += 1
+        moved += 1
+    if moved:
+        log.info("Adopted spooled data", extra=fields(source=source, target=target, segments=moved))
+    return moved
+
+
+class Spool:
+    """
+    Append-only on-disk queue of line protocol batches.
+
+    Batches are appended to numbered segment files as length-prefixed records.  A segment is closed once it grows
+    past ``segment_bytes`` and a new one is started.  Replay reads the oldest segment through a read-only memory
+    map and hands out as many consecutive batches as fit in one large write; a segment is deleted once it has
+    been replayed completely.  When the spool grows past ``max_bytes`` the oldest segments are dropped.
+
+    A batch that was written successfully but not yet committed (e.g. the process died in between) is replayed
+    again after a restart.  That is harmless for InfluxDB, since every line carries its timestamp and rewriting
+    the same series and timestamp overwrites the point with identical values.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        """
+        Args:
+            directory: Directory the segment files are kept in. Created if missing.
+            segment_bytes: Size after which a segment is closed and a new one started.
+            max_bytes: Maximum total size of all segments before the oldest are dropped.
+        """
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Segments left over from a previous run are replayed first
+        self._segments = _segment_numbers(directory)
+        self._sizes = {number: os.path.getsize(self._path(number)) for number in self._segments}
+        self._writer = None
+        self._writer_number = None
+        self._read_number = None
+        self._read_map = None
+        self._read_offset = 0
+
+        self.batches_spooled = 0
+        self.batches_replayed = 0
+        self.bytes_dropped = 0
+        self.segments_dropped = 0
+
+    def pending_bytes(self):
+        """
+        Returns the number of bytes waiting to be replayed.
+        """
+        with self._lock:
+            return sum(self._sizes.values()) - self._read_offset
+
+    def segment_count(self):
+        """
+        Returns the number of segment files on disk.
+        """
+        with self._lock:
+            return len(self._segments)
+
+    def __bool__(self):
+        with self._lock:
+            return bool(self._segments)
+
+    def stats(self):
+        """
+        Returns a snapshot of the spool counters.
+        """
+        return {
+            "pending_bytes": self.pending_bytes(),
+            "segments": self.segment_count(),
+            "batches_spooled": self.batches_spooled,
+            "batches_replayed": self.batches_replayed,
+            "bytes_dropped": self.bytes_dropped,
+            "segments_dropped": self.segments_dropped,
+        }
+
+    def append(self, data):
+        """
+        Appends one batch to the newest segment.
+
+        Args:
+            data: Line protocol bytes, each line terminated with a newline.
+        """
+        with self._lock:
+            if self._writer is None or self._sizes[self._writer_number] >= self._segment_bytes:
+                self._open_segment()
+            self._writer.write(_LENGTH.pack(len(data)))
+            self._writer.write(data)
+            self._writer.flush()
+            self._sizes[self._writer_number] += _LENGTH.size + len(data)
+            self.batches_spooled += 1
+            self._enforce_limit()
+
+    def peek(self, max_bytes):
+        """
+        Reads the oldest batches without removing them.
+
+        Args:
+            max_bytes: Maximum size of the returned data. At least one batch is returned even if it is larger.
+
+        Returns:
+            A tuple of the concatenated line protocol data, the number of batches in it and an opaque position to
+            pass to ``commit`` once the data has been written, or None if the spool is empty.
+        """
+        with self._lock:
+            if not self._open_reader():
+                return None
+            data = bytearray()
+            batches = 0
+            offset = self._read_offset
+            size = len(self._read_map)
+            while offset + _LENGTH.size <= size:
+                (length,) = _LENGTH.unpack_from(self._read_map, offset)
+                end = offset + _LENGTH.size + length
+                if end > size or (data and len(data) + length > max_bytes):
+                    break
+                data += self._read_map[offset + _LENGTH.size:end]
+                batches += 1
+                offset = end
+            if not batches:
+                # Truncated record from an interrupted write, skip the rest of the segment
+                self._finish_segment()
+                return self.peek(max_bytes) if self._segments else None
+            return bytes(data), batches, (self._read_number, offset, batches)
+
+    def commit(self, position):
+        """
+        Removes the batches returned by ``peek`` once they have been written.
+
+        Args:
+            position: The position returned by ``peek``.
+        """
+        number, offset, batches = position
+        with self._lock:
+            if number != self._read_number:
+                # The segment was dropped in the meantime
+                return
+            self.batches_replayed += batches
+            self._read_offset = offset
+            if offset >= len(self._read_map):
+                self._finish_segment()
+
+    def close(self):
+        """
+        Closes the open segment files. Pending batches stay on disk for the next run.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._read_map is not None:
+                self._read_map.close()
+                self._read_map = None
+
+    def _path(self, number):
+        return os.path.join(self._directory, f"{number:020d}{_SUFFIX}")
+
+    def _open_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+        number = self._segments[-1] + 1 if self._segments else 0
+        self._writer = open(self._path(number), "ab")
+        self._writer_number = number
+        self._segments.append(number)
+        self._sizes[number] = 0
+
+    def _open_reader(self):
+        if self._read_map is not None:
+            return True
+        if not self._segments:
+            return False
+        number = self._segments[0]
+        if number == self._writer_number:
+            # Never read the segment that is still being appended to
+            self._writer.close()
+            self._writer = None
+            self._writer_number = None
+        if self._sizes[number] == 0:
+            self._finish_segment(number)
+            return self._open_reader()
+        with open(self._path(number), "rb") as f:
+            self._read_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._read_number = number
+        self._read_offset = 0
+        return True
+
+    def _finish_segment(self, number=None):
+        if number is None or number == self._read_number:
+            number = self._read_number
+            if self._read_map is not None:
+                self._read_map.close()
+                self._read_map = None
+            self._read_number = None
+            self._read_offset = 0
+        self._segments.remove(number)
+        del self._sizes[number]
+        os.remove(self._path(number))
+
+    def _enforce_limit(self):
+        while sum(self._sizes.values()) > self._max_bytes and len(self._segments) > 1:
+            number = self._segments[0]
+            dropped = self._sizes[number]
+            if number == self._read_number:
+                dropped -= self._read_offset
+                self._finish_segment()
+            else:
+                self._finish_segment(number)
+            self.bytes_dropped += dropped
+            self.segments_dropped += 1
+            log.warning("Spool full, dropped oldest data", extra=fields(max_bytes=self._max_bytes, dropped=dropped))
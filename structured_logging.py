@@ -0,0 +1,73 @@
+import itertools
+import logging
+import sys
+
+
+##
+# key=value (logfmt) logging with sampling for messages logged on the hot path.
+#
+#   log.info("connected", extra=fields(server=MQTT_SERVER, rc=rc))
+#   time=2024-06-05T12:59:05 level=info logger=bridge msg="connected" server=10.0.0.2 rc=Success
+##
+
+def _quote(value):
+    value = str(value)
+    if value and not any(c in value for c in ' "=\n'):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+def fields(**kwargs):
+    """
+    Wraps key/value pairs for the ``extra`` argument of a logging call.
+    """
+    return {"fields": kwargs}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as ``time=... level=... logger=... msg="..." key=value ...``.
+    """
+
+    def format(self, record):
+        parts = [f"time={self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}",
+                 f"level={record.levelname.lower()}",
+                 f"logger={record.name}",
+                 f"msg={_quote(record.getMessage())}"]
+        for key, value in getattr(record, "fields", {}).items():
+            parts.append(f"{key}={_quote(value)}")
+        if record.exc_info:
+            parts.append(f"exc={_quote(self.formatException(record.exc_info))}")
+        return " ".join(parts)
+
+
+class Sampler:
+    """
+    Lets one in every ``every`` events through, starting with the first.
+
+    Used in front of per-message log calls so they can stay enabled without turning into per-message stdout I/O.
+    """
+
+    def __init__(self, every):
+        """
+        Args:
+            every: Sampling period, 1 logs every event and 0 none.
+        """
+        self._every = every
+        self._counter = itertools.count()
+
+    def __call__(self):
+        if self._every <= 0:
+            return False
+        return next(self._counter) % self._every == 0
+
+
+def configure_logging(level="INFO"):
+    """
+    Sends structured log lines of ``level`` and above to stdout.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(StructuredFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
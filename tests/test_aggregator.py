@@ -0,0 +1,108 @@
+from aggregator import Aggregator, parse_windows
+from line_protocol import Template
+
+POWER = Template("shelly_power", ("device_id",), ("apower", "aenergy_total"))
+GAUGES = {("shelly_power", "apower")}
+COUNTERS = {("shelly_power", "aenergy_total")}
+# A window start, 1 hour past the epoch
+T = 3600
+
+
+def power(apower, energy, device="a"):
+    return POWER.record((device,), (apower, energy))
+
+
+def values(record):
+    return dict(zip(record.template.field_keys, record.fields))
+
+
+def test_parse_windows():
+    assert parse_windows("30s, 1m,15m,1h,1d") == [("30s", 30), ("1m", 60), ("15m", 900), ("1h", 3600),
+                                                  ("1d", 86400)]
+    assert parse_windows("") == []
+
+
+def test_windows_are_aligned_to_the_epoch():
+    aggregator = Aggregator([("1m", 60), ("15m", 900)], GAUGES, COUNTERS)
+    assert aggregator.add(power(10, 100), now=T + 61.5) == []
+    assert aggregator.add(power(30, 101), now=T + 119) == []
+    closed = aggregator.flush_expired(now=T + 900)
+    by_measurement = {record.template.measurement: record for record in closed}
+    assert set(by_measurement) == {"shelly_power_1m", "shelly_power_15m"}
+    # Stamped with the window start, not the first sample
+    assert by_measurement["shelly_power_1m"].time == (T + 60) * 1000000000
+    assert by_measurement["shelly_power_15m"].time == T * 1000000000
+    assert by_measurement["shelly_power_1m"].tags == ("a",)
+
+
+def test_window_emitted_when_the_next_one_starts():
+    aggregator = Aggregator([("1m", 60)], GAUGES, COUNTERS)
+    assert aggregator.add(power(10, 100), now=T) == []
+    assert aggregator.add(power(40, 100), now=T + 30) == []
+    assert aggregator.add(power(20, 100), now=T + 59.9) == []
+
+    # The first record of the next window closes the previous one
+    (record,) = aggregator.add(power(5, 100), now=T + 60)
+    assert record.time == T * 1000000000
+    assert values(record) == {"apower_min": 10, "apower_max": 40, "apower_mean": 70 / 3, "apower_last": 20,
+                              "aenergy_total_delta": 0, "aenergy_total_last": 100}
+    # The next window only has its own samples
+    assert aggregator.flush_expired(now=T + 119) == []
+    (record,) = aggregator.flush_expired(now=T + 120)
+    assert record.time == (T + 60) * 1000000000
+    assert values(record)["apower_min"] == values(record)["apower_max"] == 5
+    # Nothing left to emit
+    assert aggregator.flush_expired(now=T + 1000) == []
+    assert aggregator.stats()["records_emitted"] == 2
+
+
+def test_flush_expired_closes_idle_series_only():
+    aggregator = Aggregator([("1m", 60)], GAUGES, COUNTERS)
+    aggregator.add(power(1, 100, "idle"), now=T + 10)
+    aggregator.add(power(2, 100, "busy"), now=T + 10)
+    assert aggregator.add(power(3, 100, "busy"), now=T + 70)[0].tags == ("busy",)
+    # The idle series' window is over, the busy series' current one isn't
+    (record,) = aggregator.flush_expired(now=T + 70)
+    assert record.tags == ("idle",)
+    assert values(record)["apower_last"] == 1
+
+
+def test_counter_deltas_across_windows_and_resets():
+    aggregator = Aggregator([("1m", 60)], GAUGES, COUNTERS)
+    aggregator.add(power(0, 100), now=T)
+    aggregator.add(power(0, 103), now=T + 30)
+    # The increase since the last value of the previous window counts for the new window
+    (first,) = aggregator.add(power(0, 110), now=T + 60)
+    assert values(first)["aenergy_total_delta"] == 3
+    assert values(first)["aenergy_total_last"] == 103
+    # A counter going down is a reset (e.g. a reboot), the new value is the increase
+    aggregator.add(power(0, 4), now=T + 90)
+    aggregator.add(power(0, 6), now=T + 100)
+    (second,) = aggregator.flush_expired(now=T + 120)
+    assert values(second)["aenergy_total_delta"] == 7 + 4 + 2
+    assert values(second)["aenergy_total_last"] == 6
+
+
+def test_ignores_missing_and_non_numeric_values():
+    aggregator = Aggregator([("1m", 60)], GAUGES, COUNTERS)
+    aggregator.add(power(None, 100), now=T)
+    aggregator.add(power(True, None), now=T + 1)
+    (record,) = aggregator.flush_expired(now=T + 60)
+    assert values(record)["apower_min"] is None
+    assert values(record)["aenergy_total_last"] == 100
+    assert aggregator.stats()["samples"] == 1
+    # Records of other templates, and of templates without aggregated fields, are ignored
+    other = Template("shelly_temperature", ("device_id",), ("temperature_c",))
+    assert aggregator.add(other.record(("a",), (21.5,)), now=T) == []
+    assert aggregator.add("not a record", now=T) == []
+    assert aggregator.stats()["series"] == 1
+
+
+def test_max_series():
+    aggregator = Aggregator([("1m", 60)], GAUGES, COUNTERS, max_series=2)
+    for device in ("a", "b", "c", "d"):
+        aggregator.add(power(1, 100, device), now=T)
+    # Series already aggregated keep going past the cutoff, new ones are rejected
+    aggregator.add(power(2, 100, "a"), now=T + 1)
+    assert aggregator.stats() == {"series": 2, "samples": 6, "records_emitted": 0, "series_rejected": 2}
+    assert sorted(record.tags for record in aggregator.flush_expired(now=T + 60)) == [("a",), ("b",)]
@@ -0,0 +1,123 @@
+import pytest
+
+from ble import BleStage
+from decoders import BLE_FIELDS
+from line_protocol import Template
+
+TEMPLATE = Template("ble_sensor", ("address", "gateway"), BLE_FIELDS[1:])
+ADDRESS = "7c:c6:b6:00:00:01"
+
+
+class NoTags:
+    def tags(self, address):
+        return ()
+
+
+def advertisement(pid, rssi=-70, address=ADDRESS, temperature=None, humidity=None, motion=None, button=None,
+                  window=None, battery=None):
+    values = dict(address=address, encryption=False, BTHome_version=2, pid=pid, battery=battery,
+                  temperature=temperature, humidity=humidity, motion=motion, button=button, window=window, rssi=rssi)
+    return tuple(values.get(field) for field in BLE_FIELDS)
+
+
+def create_stage(**kwargs):
+    kwargs = {"merge_window": 0.5, "dedup_window": 30, "min_interval": 0, "max_entries": 100, **kwargs}
+    return BleStage(TEMPLATE, tags=NoTags(), **kwargs)
+
+
+def values(record):
+    return dict(zip(TEMPLATE.field_keys, record.fields))
+
+
+def test_merges_copies_and_keeps_strongest_gateway():
+    stage = create_stage()
+    stage.add("gw-1", advertisement(1, rssi=-80, temperature=21), now=100.0)
+    stage.add("gw-2", advertisement(1, rssi=-60, humidity=48), now=100.1)
+    stage.add("gw-3", advertisement(1, rssi=-75, battery=90), now=100.2)
+    # Still within the merge window of the first copy
+    assert stage.flush(now=100.49) == []
+
+    (record,) = stage.flush(now=100.5)
+    assert record.tags == (ADDRESS, "gw-2")
+    merged = values(record)
+    assert (merged["temperature"], merged["humidity"], merged["battery"], merged["rssi"]) == (21.0, 48.0, 90, -60)
+    # Written as floats, like the other temperature and humidity series
+    assert merged["temperature"].__class__ is float
+    assert stage.stats()["advertisements"] == 1
+    assert stage.stats()["copies_merged"] == 2
+
+
+def test_drops_late_copies_within_dedup_window():
+    stage = create_stage()
+    stage.add("gw-1", advertisement(1), now=100.0)
+    assert len(stage.flush(now=101.0)) == 1
+    # A gateway relaying the same advertisement late, after its merge window
+    stage.add("gw-2", advertisement(1), now=105.0)
+    assert stage.flush(now=106.0) == []
+    assert stage.stats()["duplicates_dropped"] == 1
+    # The pid counter wraps around, past the window the same pid is a new advertisement
+    stage.add("gw-1", advertisement(1), now=130.0)
+    assert len(stage.flush(now=131.0)) == 1
+
+
+def test_rate_limit_lets_events_through():
+    stage = create_stage(min_interval=10)
+    stage.add("gw", advertisement(1, temperature=21), now=100.0)
+    stage.add("gw", advertisement(2, temperature=22), now=102.0)
+    assert [values(record)["pid"] for record in stage.flush(now=103.0)] == [1]
+    assert stage.stats()["rate_limited"] == 1
+
+    # Button presses are written every time
+    stage.add("gw", advertisement(3, button=1), now=104.0)
+    stage.add("gw", advertisement(4, button=1), now=105.0)
+    # Motion and window states when they change, not when they repeat
+    stage.add("gw", advertisement(5, motion=1), now=106.0)
+    stage.add("gw", advertisement(6, motion=1), now=107.0)
+    stage.add("gw", advertisement(7, motion=1, window=1), now=108.0)
+    assert [values(record)["pid"] for record in stage.flush(now=110.0)] == [3, 4, 5, 7]
+
+    # Periodic readings are written again once the interval is over
+    stage.add("gw", advertisement(8, motion=1, window=1), now=118.0)
+    assert [values(record)["pid"] for record in stage.flush(now=119.0)] == [8]
+
+
+def test_pending_advertisements_are_bounded():
+    stage = create_stage(max_entries=3)
+    for pid in range(5):
+        stage.add("gw", advertisement(pid), now=100.0)
+    # Past max_entries the oldest ones are written before their merge window is over
+    assert [values(record)["pid"] for record in stage.flush(now=100.0)] == [0, 1]
+    assert stage.stats()["pending"] == 3
+    assert [values(record)["pid"] for record in stage.flush(now=100.0, force=True)] == [2, 3, 4]
+
+
+def test_dedup_state_is_bounded():
+    stage = create_stage(max_entries=3)
+    for pid in range(5):
+        stage.add("gw", advertisement(pid), now=100.0)
+    stage.flush(now=101.0)
+    # The oldest keys were forgotten, so their copies aren't recognized anymore while the newest ones are
+    stage.add("gw", advertisement(0), now=102.0)
+    stage.add("gw", advertisement(4), now=102.0)
+    assert [values(record)["pid"] for record in stage.flush(now=103.0)] == [0]
+    assert stage.stats()["duplicates_dropped"] == 1
+
+
+def test_rate_limit_state_is_bounded():
+    stage = create_stage(min_interval=10, max_entries=2)
+    for i, address in enumerate(["a", "b", "c"]):
+        stage.add("gw", advertisement(1, address=address), now=100.0 + i)
+    assert len(stage.flush(now=103.0)) == 3
+    # Adding the third address reset the state, "a" is rate limited no more while "c" still is
+    stage.add("gw", advertisement(2, address="a"), now=104.0)
+    stage.add("gw", advertisement(2, address="c"), now=104.0)
+    assert [record.tags[0] for record in stage.flush(now=105.0)] == ["a"]
+
+
+def test_rejects_invalid_values():
+    stage = create_stage()
+    with pytest.raises(ValueError):
+        stage.add("gw", advertisement(1, rssi="strong"), now=100.0)
+    with pytest.raises(TypeError):
+        stage.add("gw", advertisement(1, temperature={"c": 21}), now=100.0)
+    assert stage.flush(now=101.0, force=True) == []
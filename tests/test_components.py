@@ -0,0 +1,24 @@
+from shelly_handlers import build_router
+
+
+def lines(router, topic, payload):
+    match = router.route(topic)
+    return [record.to_line_protocol() for record in match.handler(match.parts, payload)]
+
+
+def test_humidity_sensors_have_their_own_series():
+    router = build_router()
+    # humidity:0 keeps the series it always had, other ids (e.g. add-on sensors) get a sensor_id tag. Whole
+    # percentages are floats like the rest of the series, without the integer suffix
+    assert lines(router, "shellyplusht-c049ef8b3a10/status/humidity:0", b'{"id":0,"rh":54.2}') == [
+        "shelly_humidity,device_id=shellyplusht-c049ef8b3a10 humidity=54.2"]
+    assert lines(router, "shellyplusht-c049ef8b3a10/status/humidity:100", b'{"id":100,"rh":61}') == [
+        "shelly_humidity,device_id=shellyplusht-c049ef8b3a10,sensor_id=100 humidity=61"]
+    assert lines(router, "shellies/shellyht-6A2B9C/sensor/humidity", b"48.5") == [
+        "shelly_humidity,device_id=shellyht-6A2B9C humidity=48.5"]
+
+
+def test_temperature_keeps_sensor_id():
+    router = build_router()
+    assert lines(router, "shellyplusht-c049ef8b3a10/status/temperature:0", b'{"id":0,"tC":21.5,"tF":70.7}') == [
+        "shelly_temperature,device_id=shellyplusht-c049ef8b3a10,sensor_id=0 temperature_c=21.5,temperature_f=70.7"]
@@ -0,0 +1,93 @@
+from dedup import DeadbandFilter, parse_deadbands
+from line_protocol import Template
+
+POWER = Template("shelly_power", ("device_id",), ("apower", "voltage", "output"))
+HUMIDITY = Template("shelly_humidity", ("device_id",), ("humidity",))
+
+
+def power(apower, voltage=230.0, output=True, device="a"):
+    return POWER.record((device,), (apower, voltage, output))
+
+
+def humidity(value, device="a"):
+    return HUMIDITY.record((device,), (value,))
+
+
+def passed(dedup, records, start=0.0, step=1.0):
+    return [dedup.allow(record, now=start + i * step) for i, record in enumerate(records)]
+
+
+def test_parse_deadbands():
+    assert parse_deadbands("shelly_power.apower=5, humidity=2%,voltage=0.5") == {
+        "shelly_power.apower": (5.0, 0.0), "humidity": (0.0, 0.02), "voltage": (0.5, 0.0)}
+    assert parse_deadbands(None) == {}
+
+
+def test_absolute_deadband():
+    dedup = DeadbandFilter(parse_deadbands("shelly_power.apower=5"))
+    assert passed(dedup, [power(100), power(105), power(95), power(105.5), power(94)]) == [
+        True, False, False, True, True]
+    # Other fields without a band are only suppressed when they're equal
+    assert passed(dedup, [power(94, voltage=230.1), power(94, output=False)], start=10) == [True, True]
+
+
+def test_relative_deadband():
+    dedup = DeadbandFilter(parse_deadbands("humidity=2%"))
+    # 2% of the last written value: 1.0 of 50, 0.2 of 10
+    assert passed(dedup, [humidity(50), humidity(51), humidity(49), humidity(51.1)]) == [True, False, False, True]
+    assert passed(dedup, [humidity(10, "b"), humidity(10.2, "b"), humidity(10.3, "b")]) == [True, False, True]
+
+
+def test_qualified_deadband_applies_to_its_measurement_only():
+    dedup = DeadbandFilter(parse_deadbands("shelly_power.apower=5,humidity=1"))
+    other = Template("shelly_em", ("device_id",), ("apower",))
+    assert passed(dedup, [other.record(("a",), (100,)), other.record(("a",), (101,))]) == [True, True]
+    assert passed(dedup, [humidity(50), humidity(50.5)]) == [True, False]
+
+
+def test_slow_drift_is_written_once_it_adds_up():
+    dedup = DeadbandFilter(parse_deadbands("apower=5"))
+    # Every step is within the band, but compared with the last written value the drift gets out of it
+    assert passed(dedup, [power(100 + 2 * i) for i in range(7)]) == [True, False, False, True, False, False, True]
+
+
+def test_heartbeat_after_max_silence():
+    dedup = DeadbandFilter(max_silence=300.0)
+    assert dedup.allow(power(100), now=1000.0)
+    assert not dedup.allow(power(100), now=1299.0)
+    assert dedup.allow(power(100), now=1300.0)
+    # The heartbeat restarts the silence
+    assert not dedup.allow(power(100), now=1599.0)
+    assert dedup.allow(power(100), now=1600.0)
+
+
+def test_type_changes_pass():
+    dedup = DeadbandFilter(parse_deadbands("apower=5"))
+    assert passed(dedup, [power(1), power(True), power("1"), power(None), power(None), power(1)]) == [
+        True, True, True, True, False, True]
+
+
+def test_series_are_independent():
+    dedup = DeadbandFilter()
+    assert passed(dedup, [power(100, device="a"), power(100, device="b"), power(100, device="a")]) == [
+        True, True, False]
+    assert dedup.stats() == {"series": 2, "records_passed": 2, "records_suppressed": 1, "fields_suppressed": 3,
+                             "retained_suppressed": 0}
+    # Anything that isn't a Record is let through
+    assert dedup.allow("not a record")
+
+
+def test_suppress_retained():
+    dedup = DeadbandFilter()
+    topic = "shellyplus1pm-a8032ab12345/status/switch:0"
+    # The first retained message is the only state there is, resends on resubscription repeat it
+    assert not dedup.suppress_retained(topic, True)
+    assert dedup.suppress_retained(topic, True)
+    assert dedup.suppress_retained(topic, True)
+    # Live messages always pass
+    assert not dedup.suppress_retained(topic, False)
+    # A topic first seen live still drops the retained copy the broker sends after a reconnect
+    other = "shellyplus1pm-a8032ab12345/status/sys"
+    assert not dedup.suppress_retained(other, False)
+    assert dedup.suppress_retained(other, True)
+    assert dedup.stats()["retained_suppressed"] == 3
@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_creates_no_sinks(tmp_path):
+    # The service and the workers import both scripts and build writers of their own, importing must not leave
+    # InfluxDB clients and spools behind
+    env = dict(os.environ, SINKS="influx,file,sqlite", SPOOL_DIR=str(tmp_path / "spool"),
+               ARCHIVE_DIR=str(tmp_path / "archive"), DEVICE_CACHE_FILE="", INFLUXDB_HOST="127.0.0.1")
+    code = "import main, fronius_influx; assert main.writer is None and fronius_influx.writer is None"
+    subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path), env=dict(env, PYTHONPATH=ROOT), check=True)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,128 @@
+import threading
+import time
+
+from influx_writer import BatchWriter
+from line_protocol import Template
+from spool import Spool
+
+TEMPLATE = Template("m", ("device",), ("v",))
+
+
+class WriteError(Exception):
+    def __init__(self, status=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+class FakeWriteApi:
+    """
+    Records the lines written, failing while ``down`` is set and answering 413 for requests over ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.lock = threading.Lock()
+        self.lines = []
+        self.requests = 0
+        self.down = False
+        self.max_bytes = max_bytes
+
+    def write(self, bucket, org, record):
+        with self.lock:
+            self.requests += 1
+            if self.down:
+                raise WriteError(503)
+            if self.max_bytes is not None and len(record) > self.max_bytes:
+                raise WriteError(413)
+            self.lines.extend(record.decode().splitlines())
+
+    def values(self):
+        with self.lock:
+            return [int(line.split(" ")[1][2:-1]) for line in self.lines]
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def record(value):
+    return TEMPLATE.record(("a",), (value,), 1_000_000_000 + value)
+
+
+def create_writer(write_api, spool, **kwargs):
+    return BatchWriter(write_api, bucket="bucket", org="org", batch_size=10, flush_interval=0.01,
+                       report_interval=0, spool=spool, retry_interval=0.05, max_retry_interval=0.05, **kwargs)
+
+
+def test_spools_while_down_and_replays_in_order(tmp_path):
+    write_api = FakeWriteApi()
+    spool = Spool(str(tmp_path))
+    writer = create_writer(write_api, spool)
+    writer.start()
+    try:
+        for value in range(0, 20):
+            writer.write(record(value))
+        wait_for(lambda: len(write_api.values()) == 20)
+        assert writer.points_spooled == 0
+
+        # InfluxDB goes away: batches go to the spool instead of being lost
+        write_api.down = True
+        for value in range(20, 50):
+            writer.write(record(value))
+        wait_for(lambda: writer.points_spooled == 30)
+        assert spool.pending_bytes() > 0
+
+        # Back again: the spool is replayed before anything newer is written directly
+        write_api.down = False
+        for value in range(50, 60):
+            writer.write(record(value))
+        wait_for(lambda: len(write_api.values()) == 60 and not spool)
+        for value in range(60, 70):
+            writer.write(record(value))
+        wait_for(lambda: len(write_api.values()) == 70)
+    finally:
+        writer.close()
+
+    assert write_api.values() == list(range(70))
+    assert writer.points_rejected == 0
+    assert writer.points_written == 70
+
+
+def test_splits_requests_that_are_too_large(tmp_path):
+    # Room for about 4 lines per request, a batch has 10 and replays up to 4 MiB
+    write_api = FakeWriteApi(max_bytes=100)
+    spool = Spool(str(tmp_path))
+    writer = create_writer(write_api, spool)
+    writer.start()
+    try:
+        write_api.down = True
+        for value in range(40):
+            writer.write(record(value))
+        wait_for(lambda: writer.points_spooled == 40)
+        write_api.down = False
+        wait_for(lambda: len(write_api.values()) == 40 and not spool)
+        for value in range(40, 80):
+            writer.write(record(value))
+        wait_for(lambda: len(write_api.values()) == 80)
+    finally:
+        writer.close()
+
+    assert write_api.values() == list(range(80))
+    assert writer.points_rejected == 0
+    # Replays stay below the size that was too large
+    assert writer._replay_bytes <= 100
+
+
+def test_drops_single_line_that_is_too_large():
+    write_api = FakeWriteApi(max_bytes=100)
+    writer = create_writer(write_api, None)
+    writer.start()
+    try:
+        writer.write(TEMPLATE.record(("a" * 200,), (1,), 1))
+        writer.write(record(2))
+        wait_for(lambda: write_api.values() == [2])
+    finally:
+        writer.close()
+    assert writer.points_rejected == 1
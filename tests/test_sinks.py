@@ -0,0 +1,200 @@
+import gzip
+import sqlite3
+import time
+
+import pytest
+
+import sinks
+from line_protocol import Template
+from sinks import FanOut, LineProtocolFileSink, SqliteSink, create_sinks
+
+POWER = Template("shelly_power", ("device_id",), ("apower", "voltage", "output", "source"))
+TEMPERATURE = Template("shelly_temperature", ("device_id", "sensor_id"), ("temperature_c",))
+
+
+def power(apower, time=None, device="a"):
+    return POWER.record((device,), (apower, 230.5, True, "init"), time)
+
+
+def write_batch(sink, *points):
+    # Hands one batch to the sink on the calling thread, the way its flush thread does
+    sink._flush([(point, time.time_ns()) for point in points])
+
+
+def rows(path, query):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(query).fetchall()
+    finally:
+        connection.close()
+
+
+class Clock:
+    """
+    The time module, with file name stamps one second apart so every new file gets its own name.
+    """
+
+    def __init__(self):
+        self.seconds = 1_700_000_000
+
+    def gmtime(self):
+        self.seconds += 1
+        return time.gmtime(self.seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def read_files(directory, compress):
+    paths = sorted(directory.iterdir())
+    opener = gzip.open if compress else open
+    contents = []
+    for path in paths:
+        with opener(path, "rb") as f:
+            contents.append(f.read().decode())
+    return contents
+
+
+def test_sqlite_creates_tables_and_columns(tmp_path):
+    path = str(tmp_path / "db" / "mqtt.sqlite")
+    sink = SqliteSink(path)
+    write_batch(sink, power(5, 1), TEMPERATURE.record(("a", "0"), (21.5,), 2))
+    # A key showing up later gets its column
+    wider = Template("shelly_power", ("device_id", "phase"), ("apower", "pf"))
+    write_batch(sink, wider.record(("b", "a"), (7, 0.9), 3))
+    sink.close()
+
+    assert sink.points_written == 3
+    assert rows(path, "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name") == [
+        ("shelly_power",), ("shelly_temperature",)]
+    assert [row[1] for row in rows(path, "PRAGMA table_info(shelly_power)")] == [
+        "time", "device_id", "apower", "voltage", "output", "source", "phase", "pf"]
+    assert rows(path, "SELECT time, device_id, apower, phase, pf FROM shelly_power ORDER BY time") == [
+        (1, "a", 5, None, None), (3, "b", 7, "a", 0.9)]
+
+    # Known tables and columns are picked up again by a new sink
+    sink = SqliteSink(path)
+    write_batch(sink, wider.record(("c", "b"), (8, 1.0), 4))
+    sink.close()
+    assert sink.flush_errors == 0
+    assert rows(path, "SELECT count(*) FROM shelly_power") == [(3,)]
+
+
+def test_sqlite_keeps_value_types(tmp_path):
+    path = str(tmp_path / "mqtt.sqlite")
+    sink = SqliteSink(path)
+    write_batch(sink, POWER.record(("a",), (5, 230.5, True, "init"), 1), POWER.record(("a",), (None,) * 4, 2))
+    sink.close()
+    assert rows(path, "SELECT typeof(time), typeof(apower), typeof(voltage), typeof(output), typeof(source) "
+                      "FROM shelly_power ORDER BY time") == [
+        ("integer", "integer", "real", "integer", "text"), ("integer", "null", "null", "null", "null")]
+    assert rows(path, "SELECT apower, voltage, output, source FROM shelly_power WHERE time = 1") == [
+        (5, 230.5, 1, "init")]
+
+
+def test_sqlite_writes_points(tmp_path):
+    influxdb_client = pytest.importorskip("influxdb_client")
+    path = str(tmp_path / "fronius.sqlite")
+    sink = SqliteSink(path)
+    point = influxdb_client.Point("fronius").tag("inverter", "1").field("PAC", 1200.5).time(10)
+    write_batch(sink, point)
+    sink.close()
+    assert rows(path, "SELECT time, inverter, PAC FROM fronius") == [(10, "1", 1200.5)]
+
+
+def test_sqlite_skips_bad_points(tmp_path):
+    path = str(tmp_path / "mqtt.sqlite")
+    sink = SqliteSink(path)
+    write_batch(sink, power(1, 1), POWER.record(("a",), ([1, 2], 230.0, True, "init"), 2), power(3, 3))
+    sink.close()
+    assert (sink.points_written, sink.points_invalid, sink.flush_errors) == (2, 1, 0)
+    assert rows(path, "SELECT time FROM shelly_power ORDER BY time") == [(1,), (3,)]
+
+
+def test_sqlite_rebuilds_schema_after_error(tmp_path):
+    path = str(tmp_path / "mqtt.sqlite")
+    sink = SqliteSink(path)
+    write_batch(sink, power(1, 1))
+    # The table the sink knows about goes away behind its back
+    connection = sqlite3.connect(path)
+    connection.execute("DROP TABLE shelly_power")
+    connection.commit()
+    connection.close()
+
+    write_batch(sink, power(2, 2))
+    assert sink.flush_errors == 1
+    # The next batch starts over from the database's schema and creates the table again
+    write_batch(sink, power(3, 3))
+    sink.close()
+    assert sink.flush_errors == 1
+    assert sink.points_written == 2
+    assert rows(path, "SELECT time, apower FROM shelly_power") == [(3, 3)]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_file_sink_rotates_by_size(tmp_path, monkeypatch, compress):
+    monkeypatch.setattr(sinks, "time", Clock())
+    sink = LineProtocolFileSink(str(tmp_path), "mqtt", rotate_bytes=50, rotate_interval=3600, compress=compress)
+    lines = [power(i, i).to_line_protocol() + "\n" for i in range(6)]
+    # Two lines are over rotate_bytes, so every batch after the first starts a new file
+    for i in range(0, 6, 2):
+        write_batch(sink, power(i, i), power(i + 1, i + 1))
+    sink.close()
+
+    assert sink.files == 3
+    assert sink.points_written == 6
+    suffix = ".lp.gz" if compress else ".lp"
+    assert all(path.name.startswith("mqtt-") and path.name.endswith(suffix) for path in tmp_path.iterdir())
+    assert read_files(tmp_path, compress) == ["".join(lines[i:i + 2]) for i in range(0, 6, 2)]
+
+
+def test_file_sink_rotates_by_age(tmp_path, monkeypatch):
+    monkeypatch.setattr(sinks, "time", Clock())
+    sink = LineProtocolFileSink(str(tmp_path), "mqtt", rotate_bytes=1 << 20, rotate_interval=3600, compress=False)
+    write_batch(sink, power(1, 1))
+    write_batch(sink, power(2, 2))
+    # Past the interval
+    sink._file_deadline = 0.0
+    write_batch(sink, power(3, 3))
+    sink.close()
+    assert sink.files == 2
+    assert [content.count("\n") for content in read_files(tmp_path, False)] == [2, 1]
+
+
+def test_file_sink_skips_bad_points(tmp_path):
+    sink = LineProtocolFileSink(str(tmp_path), "mqtt", compress=False)
+    write_batch(sink, power(1, 1), POWER.record(("a",), ([1, 2], 230.0, True, "init"), 2), power(3, 3))
+    # Nothing to write, no file
+    write_batch(sink, POWER.record(("a",), (None,) * 4, 4))
+    sink.close()
+    assert (sink.points_written, sink.points_invalid, sink.files) == (2, 1, 1)
+
+
+def test_fan_out_stamps_one_time_for_all_sinks(tmp_path):
+    path = str(tmp_path / "mqtt.sqlite")
+    fan_out = FanOut([LineProtocolFileSink(str(tmp_path / "files"), "mqtt", compress=False), SqliteSink(path)])
+    before = time.time_ns()
+    record = power(1)
+    assert fan_out.write(record)
+    stamped = POWER.record(("b",), (2, 230.0, False, "init"), 42)
+    assert fan_out.write(stamped)
+    fan_out.close()
+
+    assert before <= record.time <= time.time_ns()
+    assert stamped.time == 42
+    (content,) = read_files(tmp_path / "files", False)
+    assert [int(line.split(" ")[-1]) for line in content.splitlines()] == [record.time, 42]
+    assert rows(path, "SELECT time FROM shelly_power ORDER BY device_id") == [(record.time,), (42,)]
+    assert fan_out.points_written == 4
+    assert fan_out.stats()["points_written"] == 4
+
+
+def test_create_sinks(tmp_path, monkeypatch):
+    monkeypatch.setattr(sinks, "ARCHIVE_DIR", str(tmp_path))
+    assert isinstance(create_sinks("file", "mqtt", None), LineProtocolFileSink)
+    fan_out = create_sinks("file, sqlite", "mqtt", None)
+    assert [sink.name for sink in fan_out.sinks] == ["file", "sqlite"]
+    with pytest.raises(ValueError):
+        create_sinks("kafka", "mqtt", None)
+    with pytest.raises(ValueError):
+        create_sinks(" ", "mqtt", None)
@@ -0,0 +1,124 @@
+import os
+
+from spool import Spool
+
+_LENGTH = 4
+
+
+def batches(count, prefix="m"):
+    return [f"{prefix} v={i}i\n".encode() for i in range(count)]
+
+
+def drain(spool, max_bytes=1024):
+    replayed = []
+    while (peeked := spool.peek(max_bytes)) is not None:
+        data, count, position = peeked
+        replayed.append(data)
+        spool.commit(position)
+    return b"".join(replayed)
+
+
+def test_replays_in_order_across_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    written = batches(30)
+    for batch in written:
+        spool.append(batch)
+    assert spool.segment_count() > 3
+    assert spool.pending_bytes() == sum(_LENGTH + len(batch) for batch in written)
+
+    # Small peeks still hand out at least one batch each
+    assert drain(spool, max_bytes=1) == b"".join(written)
+    assert spool.pending_bytes() == 0
+    assert spool.segment_count() == 0
+    assert not spool
+    assert spool.stats()["batches_replayed"] == len(written)
+    assert os.listdir(tmp_path) == []
+
+
+def test_appends_while_replaying(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    first, second = batches(10, "a"), batches(10, "b")
+    for batch in first:
+        spool.append(batch)
+    data, _, position = spool.peek(40)
+    spool.commit(position)
+    for batch in second:
+        spool.append(batch)
+    assert data + drain(spool) == b"".join(first + second)
+
+
+def test_skips_truncated_last_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    written = batches(5)
+    for batch in written:
+        spool.append(batch)
+    spool.close()
+    # An interrupted write: a length prefix promising more than what made it to disk
+    (path,) = tmp_path.iterdir()
+    with open(path, "ab") as f:
+        f.write((100).to_bytes(_LENGTH, "little") + b"m v=")
+
+    spool = Spool(str(tmp_path))
+    assert drain(spool) == b"".join(written)
+    assert spool.segment_count() == 0
+
+
+def test_drops_oldest_data_over_max_bytes(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100, max_bytes=300)
+    written = batches(100)
+    for batch in written:
+        spool.append(batch)
+    total = sum(_LENGTH + len(batch) for batch in written)
+
+    stats = spool.stats()
+    assert stats["pending_bytes"] <= 300
+    assert stats["segments_dropped"] > 0
+    assert stats["bytes_dropped"] + stats["pending_bytes"] == total
+    # What's left are the newest batches, in order
+    replayed = drain(spool)
+    assert len(replayed) == stats["pending_bytes"] - _LENGTH * replayed.count(b"\n")
+    assert b"".join(written).endswith(replayed)
+
+
+def test_drops_rest_of_segment_being_replayed(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100, max_bytes=300)
+    written = batches(60)
+    for batch in written[:10]:
+        spool.append(batch)
+    data, count, position = spool.peek(30)
+    spool.commit(position)
+    pending = spool.pending_bytes()
+    for batch in written[10:]:
+        spool.append(batch)
+
+    stats = spool.stats()
+    total = sum(_LENGTH + len(batch) for batch in written)
+    replayed_bytes = sum(_LENGTH + len(batch) for batch in written[:count])
+    assert pending == sum(_LENGTH + len(batch) for batch in written[:10]) - replayed_bytes
+    assert stats["bytes_dropped"] + stats["pending_bytes"] + replayed_bytes == total
+    # The segment being replayed was dropped too, counting only what wasn't replayed yet
+    assert stats["segments_dropped"] > 0
+    assert b"".join(written).endswith(drain(spool))
+
+
+def test_peek_and_commit_across_restart(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    written = batches(20)
+    for batch in written:
+        spool.append(batch)
+    segments = spool.segment_count()
+
+    # The first segment is replayed completely and deleted, the second only partly, the third peeked but not
+    # committed, as when the process dies before the write it was peeked for succeeds
+    data, count, position = spool.peek(64)
+    spool.commit(position)
+    assert spool.segment_count() == segments - 1
+    data, second, position = spool.peek(1)
+    spool.commit(position)
+    spool.peek(1024)
+    spool.close()
+
+    # A segment that wasn't replayed completely is replayed again from its start, rewriting points is harmless
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    assert spool.segment_count() == segments - 1
+    assert drain(spool) == b"".join(written[count:])
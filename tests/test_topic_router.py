@@ -0,0 +1,129 @@
+import pytest
+
+from topic_router import TopicRouter, covers, to_subscription
+
+PATTERNS = [
+    "shellyplus1pm-a8032ab12345/status/switch:0",
+    "shelly*/status/switch:*",
+    "+/status/switch:0",
+    "+/status/+",
+    "shellies/#",
+    "shellies/+/relay/0",
+    "tele/+/SENSOR",
+    "zigbee/#",
+]
+
+
+def create_router(patterns=PATTERNS):
+    router = TopicRouter()
+    for pattern in patterns:
+        router.register(pattern, pattern)
+    return router
+
+
+@pytest.mark.parametrize("topic, pattern", [
+    # Literal levels win over globs, globs over +, + over #
+    ("shellyplus1pm-a8032ab12345/status/switch:0", "shellyplus1pm-a8032ab12345/status/switch:0"),
+    ("shellyplus1pm-ffffffffffff/status/switch:0", "shelly*/status/switch:*"),
+    ("shellyplus1pm-ffffffffffff/status/switch:1", "shelly*/status/switch:*"),
+    ("pro4pm/status/switch:0", "+/status/switch:0"),
+    ("pro4pm/status/switch:1", "+/status/+"),
+    ("shellies/shelly1-AB12/relay/0", "shellies/+/relay/0"),
+    ("shellies/shelly1-AB12/relay/1", "shellies/#"),
+    ("tele/meter/SENSOR", "tele/+/SENSOR"),
+    # A more specific level that leads nowhere falls back to the wider ones
+    ("shellyplus1pm-a8032ab12345/status/switch:1", "shelly*/status/switch:*"),
+    ("shellyplus1pm-a8032ab12345/status/sys", "+/status/+"),
+    # # matches its parent level and any depth below
+    ("zigbee", "zigbee/#"),
+    ("zigbee/bridge/state", "zigbee/#"),
+    ("shellies", "shellies/#"),
+    # No match
+    ("tele/meter/STATE", None),
+    ("pro4pm/status", None),
+    ("pro4pm/status/switch:0/extra", None),
+])
+def test_route(topic, pattern):
+    match = create_router().route(topic)
+    if pattern is None:
+        assert match is None
+    else:
+        assert match.pattern == pattern
+        assert match.handler == pattern
+        assert match.parts == topic.split("/")
+
+
+def test_match_carries_delivering_subscription():
+    router = create_router()
+    assert router.route("shellyplus1pm-a8032ab12345/status/switch:0").subscription == "+/status/+"
+    assert router.route("shellies/shelly1-AB12/relay/0").subscription == "shellies/#"
+    assert router.route("tele/meter/SENSOR").subscription == "tele/+/SENSOR"
+
+
+def test_caches_matches_and_misses():
+    router = create_router()
+    walks = []
+    walk = router._walk
+
+    def counting_walk(node, parts, depth):
+        if depth == 0:
+            walks.append(parts)
+        return walk(node, parts, depth)
+    router._walk = counting_walk
+
+    assert router.route("tele/meter/STATE") is None
+    assert router.route("tele/meter/STATE") is None
+    first = router.route("tele/meter/SENSOR")
+    assert router.route("tele/meter/SENSOR") is first
+    assert walks == [["tele", "meter", "STATE"], ["tele", "meter", "SENSOR"]]
+
+    # Registering a pattern drops cached decisions, misses included
+    router.register("tele/+/STATE", "tele/+/STATE")
+    assert router.route("tele/meter/STATE").pattern == "tele/+/STATE"
+
+
+def test_cache_is_bounded():
+    router = TopicRouter(cache_size=2)
+    router.register("+/status/+", "handler")
+    for i in range(5):
+        router.route(f"device-{i}/status/sys")
+    assert len(router._cache) <= 2
+
+
+def test_hash_must_be_last():
+    with pytest.raises(ValueError):
+        TopicRouter().register("shellies/#/relay", "handler")
+
+
+@pytest.mark.parametrize("pattern, subscription", [
+    ("shelly*/status/switch:*", "+/status/+"),
+    ("shellyplus1pm-a8032ab12345/status/switch:0", "shellyplus1pm-a8032ab12345/status/switch:0"),
+    ("tele/+/SENSOR", "tele/+/SENSOR"),
+    ("shellies/#", "shellies/#"),
+])
+def test_to_subscription(pattern, subscription):
+    assert to_subscription(pattern) == subscription
+
+
+@pytest.mark.parametrize("wider, other, expected", [
+    ("+/status/+", "+/status/switch:0", True),
+    ("+/status/+", "pro4pm/status/switch:0", True),
+    ("+/status/switch:0", "+/status/+", False),
+    ("shellies/#", "shellies/+/relay/0", True),
+    ("shellies/#", "shellies", True),
+    ("#", "tele/+/SENSOR", True),
+    ("+/#", "shellies/#", True),
+    ("+/+", "shellies/#", False),
+    ("+/status/+", "+/status", False),
+    ("+/status", "+/status/+", False),
+    ("tele/+/SENSOR", "tele/+/SENSOR", True),
+])
+def test_covers(wider, other, expected):
+    assert covers(wider, other) is expected
+
+
+def test_subscriptions_leave_out_covered_filters():
+    # Registration order is kept, filters covered by wider ones and duplicates are left out
+    assert create_router().subscriptions() == ["+/status/+", "shellies/#", "tele/+/SENSOR", "zigbee/#"]
+    assert create_router(["+/status/switch:0", "shelly*/status/switch:0", "+/events/ble"]).subscriptions() == [
+        "+/status/switch:0", "+/events/ble"]
@@ -0,0 +1,146 @@
+"""
+Runs worker processes against the stand-in broker of benchmarks.stub_mqtt.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+from benchmarks.stub_mqtt import StubBroker
+from spool import Spool
+from workers import adopt_spools, dispatch_key, supervise, worker_index, worker_main
+
+WORKERS = 2
+# An odd number, so round-robin delivery would split every device's messages between the workers
+DEVICES = [f"shellyplus1pm-{i:012x}" for i in range(7)]
+MESSAGES_PER_DEVICE = 50
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def read_power(directory):
+    # (worker, device_id) -> [(time, apower)] of the shelly_power lines the workers' file sinks wrote
+    series = {}
+    for path in glob.glob(os.path.join(directory, "mqtt-*.lp")):
+        worker = int(os.path.basename(path).split("-")[1])
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 3 or not line.endswith("\n"):
+                    continue
+                measurement, *tags = parts[0].split(",")
+                if measurement != "shelly_power":
+                    continue
+                device_id = dict(tag.split("=") for tag in tags)["device_id"]
+                apower = dict(value.split("=") for value in parts[1].split(","))["apower"]
+                series.setdefault((worker, device_id), []).append((int(parts[2]), float(apower.rstrip("i"))))
+    return series
+
+
+def slow_worker_main(index, *args):
+    # Worker 0 falls behind, so consecutive messages of a device would be handled out of order across workers
+    if index == 0:
+        import main as bridge
+        handle = bridge.on_message
+
+        def on_message(client, userdata, msg):
+            time.sleep(0.005)
+            handle(client, userdata, msg)
+        bridge.on_message = on_message
+    worker_main(index, *args)
+
+
+def run_supervisor(count):
+    supervise(count, target=slow_worker_main)
+
+
+def test_dispatch_key():
+    assert dispatch_key("shellyplus1pm-a8032ab12345/status/switch:0", b"") == "shellyplus1pm-a8032ab12345"
+    assert dispatch_key("shellyplus1pm-a8032ab12345/online", b"true") == "shellyplus1pm-a8032ab12345"
+    assert dispatch_key("shellies/shellyht-6A2B9C/sensor/temperature", b"21.5") == "shellyht-6A2B9C"
+    assert dispatch_key("tele/meter/SENSOR", b"{}") == "meter"
+    # Copies relayed by different gateways go to the same worker
+    payload = json.dumps({"payload": {"address": "7c:c6:b6:00:00:01", "pid": 7}}).encode()
+    assert dispatch_key("shellyplus1pm-1/events/ble", payload) == dispatch_key("shellyplus1pm-2/events/ble", payload)
+    assert dispatch_key("shellyplus1pm-1/events/ble", payload) == "7c:c6:b6:00:00:01"
+    assert dispatch_key("shellyplus1pm-1/events/ble", b"not json") == "shellyplus1pm-1"
+    # Metadata every worker needs
+    assert dispatch_key("shellies/announce", b"{}") is None
+    assert dispatch_key("shellyqtt/rpc", b"{}") is None
+
+
+def test_workers_keep_device_order(tmp_path, monkeypatch):
+    broker = StubBroker().start()
+    # Read by the supervisor and worker processes when they import the bridge. Deduplication and roll-ups stay on
+    monkeypatch.setenv("MQTT_SERVER", "127.0.0.1")
+    monkeypatch.setenv("MQTT_PORT", str(broker.port))
+    monkeypatch.setenv("SINKS", "file")
+    monkeypatch.setenv("ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setenv("ARCHIVE_COMPRESS", "false")
+    monkeypatch.setenv("SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setenv("DEVICE_CACHE_FILE", "")
+    monkeypatch.setenv("METRICS_PORT", "0")
+    monkeypatch.setenv("INFLUXDB_FLUSH_INTERVAL", "0.1")
+    monkeypatch.setenv("LOG_LEVEL", "WARNING")
+
+    total = len(DEVICES) * MESSAGES_PER_DEVICE
+    supervisor = multiprocessing.get_context("spawn").Process(target=run_supervisor, args=(WORKERS,))
+    supervisor.start()
+    try:
+        wait_for(lambda: broker.subscription_count("+/status/+") == 1)
+        # As fast as possible: the slow worker builds a backlog while the other one keeps up
+        for n in range(MESSAGES_PER_DEVICE):
+            for device in DEVICES:
+                # Flips back and forth, a worker seeing every other message would take it for an unchanged value
+                broker.publish(f"{device}/status/switch:0", json.dumps({"id": 0, "apower": n % 2}).encode())
+        wait_for(lambda: sum(map(len, read_power(str(tmp_path / "archive")).values())) == total)
+    finally:
+        supervisor.terminate()
+        supervisor.join(60)
+        broker.stop()
+    assert supervisor.exitcode is not None
+
+    series = read_power(str(tmp_path / "archive"))
+    # Every device was handled by the worker it hashes to, and both workers got devices
+    assert sorted(device for _, device in series) == DEVICES
+    assert {worker for worker, _ in series} == set(range(WORKERS))
+    for (worker, device), points in series.items():
+        assert worker == worker_index(device, WORKERS), device
+        # Every value written and stamped in arrival order
+        assert [apower for _, apower in sorted(points)] == [n % 2 for n in range(MESSAGES_PER_DEVICE)], device
+
+
+def test_worker_zero_adopts_orphaned_spools(tmp_path):
+    def spool_batches(name, *batches):
+        spool = Spool(str(tmp_path / name))
+        for batch in batches:
+            spool.append(batch)
+        spool.close()
+
+    # Left by single-process mode, by worker 0 itself, by a worker still running and by one no longer started
+    spool_batches("mqtt", b"single 1\n", b"single 2\n")
+    spool_batches("mqtt-0", b"worker0 1\n")
+    spool_batches("mqtt-1", b"worker1 1\n")
+    spool_batches("mqtt-2", b"worker2 1\n")
+
+    assert adopt_spools(str(tmp_path), 2) == 2
+
+    spool = Spool(str(tmp_path / "mqtt-0"))
+    replayed = bytearray()
+    while (batch := spool.peek(1024)) is not None:
+        data, _, position = batch
+        replayed += data
+        spool.commit(position)
+    spool.close()
+    assert replayed == b"worker0 1\nsingle 1\nsingle 2\nworker2 1\n"
+    assert Spool(str(tmp_path / "mqtt")).segment_count() == 0
+    assert Spool(str(tmp_path / "mqtt-1")).segment_count() == 1
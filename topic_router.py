@@ -0,0 +1,206 @@
+import re
+from collections import namedtuple
+from fnmatch import translate
+
+# The result of routing a topic: the registered handler, the pattern it was registered with, the topic split
+# into its levels (so handlers don't have to split it again) and the MQTT subscription that delivers it.
+Match = namedtuple("Match", ["handler", "pattern", "parts", "subscription"])
+
+
+def to_subscription(pattern):
+    """
+    Converts a router pattern to the narrowest valid MQTT subscription filter covering it.
+
+    MQTT wildcards must occupy a whole level, so levels containing a glob (``shelly*``) become ``+``.
+
+    Args:
+        pattern: A pattern as passed to ``TopicRouter.register``.
+
+    Returns:
+        The MQTT subscription filter.
+    """
+    return "/".join('+' if _is_glob(level) else level for level in pattern.split('/'))
+
+
+def covers(subscription, other):
+    """
+    Checks whether every topic matched by one MQTT subscription filter is also matched by another.
+
+    Args:
+        subscription: The possibly wider filter.
+        other: The filter to check.
+
+    Returns:
+        True if ``subscription`` matches everything ``other`` matches.
+    """
+    levels = subscription.split('/')
+    other_levels = other.split('/')
+    for i, level in enumerate(levels):
+        if level == '#':
+            return True
+        if i >= len(other_levels):
+            return False
+        if level == '+':
+            if other_levels[i] == '#':
+                return False
+        elif level != other_levels[i]:
+            return False
+    return len(levels) == len(other_levels)
+
+
+def _is_glob(level):
+    return '*' in level or '?' in level or '[' in level
+
+
+class _Node:
+    __slots__ = ("literal", "globs", "plus", "hash", "route")
+
+    def __init__(self):
+        self.literal = {}
+        self.globs = []
+        self.plus = None
+        self.hash = None
+        self.route = None
+
+
+class TopicRouter:
+    """
+    Maps MQTT topic patterns to handlers.
+
+    Patterns are split into levels and stored in a trie.  A level can be a literal (``status``), an MQTT single
+    level wildcard (``+``), a trailing multi level wildcard (``#``) or a glob inside a level (``shelly*``,
+    ``temperature:*``).  When several patterns match, literal levels win over globs, globs over ``+`` and ``+``
+    over ``#``.
+
+    Routing decisions are cached per exact topic string, including misses, so the trie is only walked the first
+    time a topic is seen.
+    """
+
+    def __init__(self, cache_size=65536):
+        """
+        Args:
+            cache_size: Maximum number of topics kept in the decision cache before it is reset.
+        """
+        self._root = _Node()
+        self._cache = {}
+        self._cache_size = cache_size
+        self._patterns = []
+        self._subscription_for = {}
+
+    def register(self, pattern, handler):
+        """
+        Registers a handler for a topic pattern.
+
+        Args:
+            pattern: The topic pattern, e.g. ``"shelly*/status/switch:0"`` or ``"tele/+/SENSOR"``.
+            handler: Callable invoked as ``handler(topic_parts, payload)`` for matching messages.
+        """
+        levels = pattern.split('/')
+        node = self._root
+        for i, level in enumerate(levels):
+            if level == '#':
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level of a pattern: {pattern}")
+                node.hash = (pattern, handler)
+                break
+            if level == '+':
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+            elif _is_glob(level):
+                for glob, child in node.globs:
+                    if glob.pattern == translate(level):
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.globs.append((re.compile(translate(level)), child))
+                    node = child
+            else:
+                node = node.literal.setdefault(level, _Node())
+        else:
+            node.route = (pattern, handler)
+
+        self._patterns.append(pattern)
+        self._cache.clear()
+        self._subscription_for = {}
+
+    def patterns(self):
+        """
+        Returns the registered patterns in registration order.
+        """
+        return list(self._patterns)
+
+    def subscriptions(self):
+        """
+        Returns the MQTT subscription filters needed to receive every routable topic.
+
+        Filters that are covered by a wider filter (``+/status/humidity:0`` by ``+/status/+``) are left out.
+        """
+        filters = []
+        for pattern in self._patterns:
+            subscription = to_subscription(pattern)
+            if subscription not in filters:
+                filters.append(subscription)
+        return [f for f in filters if not any(o != f and covers(o, f) for o in filters)]
+
+    def _subscription(self, pattern):
+        # The filter a message matching the pattern arrives through
+        try:
+            return self._subscription_for[pattern]
+        except KeyError:
+            subscription = to_subscription(pattern)
+            for candidate in self.subscriptions():
+                if covers(candidate, subscription):
+                    subscription = candidate
+                    break
+            self._subscription_for[pattern] = subscription
+            return subscription
+
+    def route(self, topic):
+        """
+        Finds the handler for a topic.
+
+        Args:
+            topic: The MQTT topic of the message.
+
+        Returns:
+            A ``Match`` for the topic, or None if no registered pattern matches.
+        """
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+
+        parts = topic.split('/')
+        found = self._walk(self._root, parts, 0)
+        match = Match(found[1], found[0], parts, self._subscription(found[0])) if found else None
+
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[topic] = match
+        return match
+
+    def _walk(self, node, parts, depth):
+        if depth == len(parts):
+            if node.route is not None:
+                return node.route
+            # "a/#" also matches "a" itself
+            return node.hash
+
+        level = parts[depth]
+        child = node.literal.get(level)
+        if child is not None:
+            found = self._walk(child, parts, depth + 1)
+            if found:
+                return found
+        for glob, child in node.globs:
+            if glob.match(level):
+                found = self._walk(child, parts, depth + 1)
+                if found:
+                    return found
+        if node.plus is not None:
+            found = self._walk(node.plus, parts, depth + 1)
+            if found:
+                return found
+        return node.hash
@@ -0,0 +1,316 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+import metrics
+from decoders import decoder
+from device_tags import device_tags
+from line_protocol import Record
+from spool import adopt_segments
+from structured_logging import Sampler, configure_logging, fields
+
+##
+# Multi-process ingestion mode.
+#
+# The supervisor process keeps the only MQTT connection and dispatches every message to one of several worker
+# processes, each with its own writer and spool, so JSON decoding / point building spreads over several cores.
+#
+# Messages are dispatched by device: a hash of the device id in the topic (the advertised address for BLU events,
+# which reach the bridge through several gateways) picks the worker, and each worker handles its queue in order. All
+# messages of a device are therefore handled by the same worker in the order they arrived, which keeps the stateful
+# stages right: deduplication compares a value with the device's last written one, roll-ups see every sample of
+# their series and copies of a BLE advertisement are merged. Device metadata responses go to every worker. Points
+# are stamped with the time the supervisor received their message, not when a busy worker gets to it.
+#
+# MQTT v5 shared subscriptions ($share/<group>/<filter>) aren't used for this: brokers like Mosquitto hand out
+# messages round-robin, which splits a device's messages over workers that each see only part of its series.
+#
+# Spooled data of directories no worker writes to is replayed by worker 0: it moves the segments of the single
+# process spool (SPOOL_DIR/mqtt) and of workers beyond MQTT_WORKERS into its own spool when it starts. Going back
+# to a single process doesn't do the reverse, so wait for the workers' spools to drain or move their segments
+# into SPOOL_DIR/mqtt with spool.adopt_segments first.
+##
+
+MQTT_CLIENT_ID = os.getenv('MQTT_CLIENT_ID', 'shellyqtt')
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 10000))  # Messages waiting per worker before dropping
+WORKER_REPORT_INTERVAL = float(os.getenv('WORKER_REPORT_INTERVAL', 60))
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', 5))
+
+log = logging.getLogger("workers")
+drop_sampler = Sampler(1000)
+error_sampler = Sampler(1000)
+
+
+class Message:
+    """
+    The attributes of ``paho.mqtt.client.MQTTMessage`` the bridge reads.
+    """
+    __slots__ = ("topic", "payload", "retain", "qos")
+
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.qos = 0
+
+
+class _ReceivedTime:
+    """
+    Wraps a worker's writer to stamp points with the time the supervisor received their message.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.time = None
+
+    def write(self, point):
+        if isinstance(point, Record):
+            if point.time is None:
+                point.time = self.time
+        elif point._time is None:
+            point.time(self.time)
+        return self.writer.write(point)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def dispatch_key(topic, payload):
+    """
+    Returns the key messages are dispatched by: the device id, or the address for BLU events.
+
+    Returns:
+        A string, or None for messages every worker needs.
+    """
+    if topic == device_tags.response_topic or topic == "shellies/announce":
+        return None
+    parts = topic.split("/")
+    if parts[0] in ("shellies", "tele") and len(parts) > 1:
+        return parts[1]
+    if len(parts) == 3 and parts[1] == "events" and parts[2] == "ble":
+        try:
+            data = decoder.ble_event(payload)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # Failing again in the worker, where it's counted
+            data = None
+        if data is not None and data[0] is not None:
+            return str(data[0])
+    return parts[0]
+
+
+def worker_index(key, count):
+    """
+    Maps a dispatch key to a worker, the same one in every run.
+    """
+    return zlib.crc32(key.encode()) % count
+
+
+def adopt_spools(spool_dir, count):
+    """
+    Moves the spooled data no worker would replay into worker 0's spool.
+
+    Args:
+        spool_dir: The SPOOL_DIR of the bridge.
+        count: The number of workers.
+
+    Returns:
+        The number of segments moved.
+    """
+    if not os.path.isdir(spool_dir):
+        return 0
+    target = os.path.join(spool_dir, "mqtt-0")
+    moved = 0
+    for name in sorted(os.listdir(spool_dir)):
+        number = name[len("mqtt-"):]
+        if name == "mqtt" or (name.startswith("mqtt-") and number.isdigit() and int(number) >= count):
+            moved += adopt_segments(os.path.join(spool_dir, name), target)
+    return moved
+
+
+def worker_main(index, counters, count, inbox, outbox):
+    """
+    Entry point of a worker process.
+
+    Args:
+        index: The worker number, used for the spool directory and the metrics port.
+        counters: Shared array of processed message counts, one slot per worker.
+        count: The number of workers.
+        inbox: Queue of (receive time, topic, payload, retain) tuples from the supervisor, None to stop.
+        outbox: Queue of (topic, payload) tuples the supervisor publishes, e.g. device metadata requests.
+    """
+    import main as bridge
+
+    configure_logging(bridge.LOG_LEVEL)
+    # Ctrl+C reaches the whole process group, the supervisor stops the workers once their queues are handled.
+    # SIGTERM from the supervisor is treated like Ctrl+C so queued points are drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if index == 0 and bridge.SPOOL_DIR:
+        adopt_spools(bridge.SPOOL_DIR, count)
+    writer = _ReceivedTime(bridge.create_writer(f"mqtt-{index}"))
+    bridge.writer = writer
+    writer.start()
+    # Every worker serves its own metrics, on the ports following the bridge's METRICS_PORT
+    if bridge.METRICS_PORT:
+        bridge.register_metrics()
+        metrics.start_http_server(bridge.METRICS_PORT + 1 + index)
+    device_tags.publish = lambda topic, payload: outbox.put((topic, payload))
+
+    try:
+        while True:
+            try:
+                item = inbox.get(timeout=1.0)
+            except queue.Empty:
+                # Write the BLE advertisements that were waiting for copies once traffic stops
+                bridge.flush_ble()
+                continue
+            if item is None:
+                break
+            writer.time, topic, payload, retain = item
+            try:
+                bridge.on_message(None, None, Message(topic, payload, retain))
+            except Exception:
+                # One bad message must not take the worker and its queue down
+                if error_sampler():
+                    log.exception("Failed to handle message", extra=fields(worker=index, topic=topic))
+            counters[index] += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bridge.flush_ble(force=True)
+        writer.close()
+        device_tags.save()
+
+
+def supervise(count, target=worker_main):
+    """
+    Receives the MQTT messages, dispatches them to ``count`` worker processes, restarts any that exit and reports
+    per-worker throughput.
+
+    Args:
+        count: The number of worker processes.
+        target: The worker entry point, see ``worker_main``.
+    """
+    import main as bridge
+
+    context = multiprocessing.get_context("spawn")
+    # Only worker i writes slot i, so no lock is needed
+    counters = context.Array('Q', count, lock=False)
+    inboxes = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(count)]
+    outbox = context.Queue()
+    dropped = [0] * count
+    processes = [None] * count
+    started = [0.0] * count
+    restarts = [0] * count
+    clients = []
+    stopping = threading.Event()
+
+    def start(index):
+        process = context.Process(target=target, args=(index, counters, count, inboxes[index], outbox),
+                                  name=f"shellyqtt-worker-{index}")
+        process.start()
+        processes[index] = process
+        started[index] = time.monotonic()
+
+    def put(index, item):
+        try:
+            inboxes[index].put_nowait(item)
+        except queue.Full:
+            dropped[index] += 1
+            if drop_sampler():
+                log.warning("Worker queue full, dropping message", extra=fields(worker=index, topic=item[1]))
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        if bridge.connected_before:
+            metrics.RECONNECTS.inc()
+        bridge.connected_before = True
+        subscriptions = bridge.router.subscriptions()
+        client.subscribe([(subscription, 0) for subscription in subscriptions])
+        log.info("Connected", extra=fields(server=bridge.MQTT_SERVER, rc=rc, subscriptions=",".join(subscriptions)))
+
+    def on_message(client, userdata, msg):
+        if stopping.is_set():
+            return
+        item = (time.time_ns(), msg.topic, msg.payload, msg.retain)
+        key = dispatch_key(msg.topic, msg.payload)
+        if key is None:
+            for index in range(count):
+                put(index, item)
+        else:
+            put(worker_index(key, count), item)
+
+    def create_client():
+        client = bridge.create_client(client_id=MQTT_CLIENT_ID)
+        client.on_connect = on_connect
+        client.on_message = on_message
+        clients[:] = [client]
+        return client
+
+    def publish_requests():
+        # Publishes what the workers hand back, device metadata requests go out on the supervisor's connection
+        while True:
+            topic, payload = outbox.get()
+            if clients:
+                clients[0].publish(topic, payload)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for index in range(count):
+            start(index)
+        threading.Thread(target=publish_requests, name="worker-requests", daemon=True).start()
+        threading.Thread(target=bridge.connect_forever, args=(create_client,), name="mqtt", daemon=True).start()
+        log.info("Started workers", extra=fields(count=count))
+
+        last_counts = [0] * count
+        last_report = time.monotonic()
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+
+            for index, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                # Don't restart a worker that keeps crashing right away in a tight loop
+                if now - started[index] < WORKER_RESTART_DELAY:
+                    continue
+                restarts[index] += 1
+                log.warning("Worker exited, restarting", extra=fields(
+                    worker=index, exitcode=process.exitcode, restarts=restarts[index]))
+                start(index)
+
+            if WORKER_REPORT_INTERVAL and now - last_report >= WORKER_REPORT_INTERVAL:
+                counts = list(counters)
+                elapsed = now - last_report
+                rates = [(count - last) / elapsed for count, last in zip(counts, last_counts)]
+                log.info("Worker throughput", extra=fields(
+                    total=f"{sum(rates):.1f}/s", dropped=sum(dropped),
+                    **{f"worker{index}": f"{rate:.1f}/s" for index, rate in enumerate(rates)}))
+                last_counts = counts
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Stop receiving, then let the workers handle what's queued before they drain their writers
+        stopping.set()
+        if clients:
+            clients[0].disconnect()
+        for index, process in enumerate(processes):
+            if process is not None and process.is_alive():
+                try:
+                    inboxes[index].put(None, timeout=5)
+                except queue.Full:
+                    process.terminate()
+        for process in processes:
+            if process is not None:
+                process.join(30)
+                if process.is_alive():
+                    process.terminate()
+                    process.join(15)
+        # Messages left for workers that are gone must not keep the supervisor from exiting
+        for inbox in inboxes:
+            inbox.cancel_join_thread()